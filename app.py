@@ -13,33 +13,412 @@
 :version: 1.0.0
 :license: MIT License
 """
-from flask import Flask, render_template, request, jsonify, session, Response
+from flask import Flask, render_template, request, jsonify, session, Response, send_file
 from flask_cors import CORS
 import json
+import base64
+import gzip
+import hashlib
 import os
 import uuid
 from datetime import datetime
 import sqlite3
 from werkzeug.utils import secure_filename
 import requests
+from requests.adapters import HTTPAdapter
+import urllib3
+from urllib.parse import urlsplit
 import threading
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import atexit
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import queue
+import asyncio
 import time
+import shutil
+import random
+import re
+import logging
+from functools import lru_cache
+from contextlib import contextmanager, asynccontextmanager, ExitStack
+from collections import deque, OrderedDict
+from itertools import islice
+from array import array
+from email.utils import parsedate_to_datetime
+from bisect import bisect_left
+
+try:
+    import httpx  # 可选依赖：HTTP/2 传输与 asyncio 引擎
+except ImportError:
+    httpx = None
+
+try:
+    import fcntl  # 模板库的跨进程文件锁（Windows 下不可用）
+except ImportError:
+    fcntl = None
 
 app = Flask(__name__)
 app.secret_key = 'your-secret-key-here'  # 在生产环境中应该使用环境变量
 CORS(app)
 
-# 线程锁用于文件写入
-write_lock = threading.Lock()
+# ================== 日志 ==================
+# 结构化日志，启动时通过环境变量配置：
+# - PROMPTFACTORY_LOG_LEVEL:  日志级别（默认 INFO；DEBUG 时才记录逐行明细）
+# - PROMPTFACTORY_LOG_FORMAT: json（默认，每行一个JSON对象）或 text
+# - PROMPTFACTORY_LOG_SAMPLE: 逐行日志采样率，每 N 行记录 1 行（默认 100，可被 api_config['log_sample_rate'] 覆盖）
+# - PROMPTFACTORY_LOG_MAX_FIELD: 单个字段最大长度，超出部分截断（默认 500 字符）
+LOG_LEVEL = os.environ.get('PROMPTFACTORY_LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('PROMPTFACTORY_LOG_FORMAT', 'json')
+LOG_SAMPLE_RATE = int(os.environ.get('PROMPTFACTORY_LOG_SAMPLE', 100))
+LOG_MAX_FIELD = int(os.environ.get('PROMPTFACTORY_LOG_MAX_FIELD', 500))
 
-# 数据库初始化
-def init_db():
-    conn = sqlite3.connect('projects.db')
-    cursor = conn.cursor()
-    
-    # 创建项目表
+logger = logging.getLogger('promptfactory')
+
+def truncate_log_value(value):
+    """截断过长的日志字段"""
+    if not isinstance(value, (str, int, float, bool, type(None))):
+        value = json.dumps(value, ensure_ascii=False, default=str)
+    if isinstance(value, str) and len(value) > LOG_MAX_FIELD:
+        return f'{value[:LOG_MAX_FIELD]}...(共{len(value)}字符)'
+    return value
+
+class JsonLogFormatter(logging.Formatter):
+    """JSON Lines 格式的日志"""
+
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'msg': record.getMessage()
+        }
+        for key, value in getattr(record, 'fields', {}).items():
+            entry[key] = truncate_log_value(value)
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+class TextLogFormatter(logging.Formatter):
+    """文本格式的日志（字段以 key=value 附在消息后）"""
+
+    def format(self, record):
+        line = f'{self.formatTime(record)} {record.levelname} {record.getMessage()}'
+        fields = getattr(record, 'fields', {})
+        if fields:
+            line += ' ' + ' '.join(f'{k}={truncate_log_value(v)}' for k, v in fields.items())
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+def configure_logging():
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonLogFormatter() if LOG_FORMAT == 'json' else TextLogFormatter())
+    logger.handlers[:] = [handler]
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+
+configure_logging()
+
+def log_event(level, message, **fields):
+    """记录一条结构化日志（级别未启用时不做任何格式化）"""
+    if logger.isEnabledFor(level):
+        logger.log(level, message, extra={'fields': fields})
+
+def log_sampled(api_config, idx):
+    """逐行日志采样：每 N 行记录 1 行"""
+    rate = int(api_config.get('log_sample_rate') or LOG_SAMPLE_RATE)
+    return rate <= 1 or idx % rate == 0
+# ================== End 日志 ==================
+
+# ================== 指标 ==================
+# 每行数据记录各阶段耗时（秒），写入 meta['timings']：
+# - queue_wait:    在执行引擎队列中等待工作线程/协程的时间
+# - render:        模板渲染与请求构建
+# - cache_lookup:  响应缓存查询
+# - throttle_wait: 等待限流控制器放行（含并发与令牌桶）
+# - http_ttfb:     发出请求到收到响应头（含建立连接；仅 requests 传输层可区分）
+# - http:          完整HTTP请求耗时（多次重试累加）
+# - parse:         响应JSON解析与结果提取
+# - write:         结果写入（后台任务的结果文件）
+# 按端点汇总为直方图，通过 /metrics 以 Prometheus 文本格式暴露；每个任务另有独立汇总，见 /api/processing-records/<id>/stats。
+# 实际发出的请求另从响应 usage 中记录提示词 token 数与命中服务端前缀缓存的 token 数（meta['prompt_tokens'] /
+# meta['cached_tokens']），汇总为 tokens.cached_ratio；响应缓存命中与去重复用的行不计入。
+METRIC_BUCKETS = (0.00001, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.075,
+                  0.1, 0.15, 0.2, 0.3, 0.5, 0.75, 1, 1.5, 2, 3, 5, 10, 30, 60, 120)
+
+def add_timing(meta, phase, seconds):
+    """累加一行数据某阶段的耗时"""
+    timings = meta.setdefault('timings', {})
+    timings[phase] = timings.get(phase, 0.0) + seconds
+
+def usage_tokens(usage):
+    """从响应 usage 中取 (提示词 token 数, 命中前缀缓存的 token 数)
+
+    兼容 OpenAI（prompt_tokens_details.cached_tokens）、DeepSeek（prompt_cache_hit_tokens）
+    与 Anthropic（input_tokens + cache_read_input_tokens）的字段。
+    """
+    usage = usage or {}
+    cached = ((usage.get('prompt_tokens_details') or {}).get('cached_tokens') or usage.get('prompt_cache_hit_tokens')
+              or usage.get('cache_read_input_tokens') or 0)
+    prompt = usage.get('prompt_tokens')
+    if prompt is None:
+        prompt = (usage.get('input_tokens') or 0) + (usage.get('cache_read_input_tokens') or 0) \
+            + (usage.get('cache_creation_input_tokens') or 0)
+    return prompt, cached
+
+def record_usage(meta, response_data):
+    """把响应 usage 中的提示词与缓存 token 数写入 meta"""
+    prompt, cached = usage_tokens(response_data.get('usage'))
+    if prompt:
+        meta['prompt_tokens'] = prompt
+        meta['cached_tokens'] = cached
+
+class Histogram:
+    """固定分桶的耗时直方图"""
+
+    def __init__(self):
+        self.counts = [0] * (len(METRIC_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(METRIC_BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """按分桶线性插值估算分位数"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                if i == len(METRIC_BUCKETS):
+                    return METRIC_BUCKETS[-1]
+                lower = METRIC_BUCKETS[i - 1] if i else 0.0
+                return lower + (METRIC_BUCKETS[i] - lower) * (rank - seen) / n
+            seen += n
+        return METRIC_BUCKETS[-1]
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.sum / self.count if self.count else None,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99)
+        }
+
+class PhaseMetrics:
+    """一组按阶段划分的耗时直方图与行数计数（线程安全）"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phases = {}
+        self.rows = {'success': 0, 'error': 0}
+        self.tokens = {'prompt': 0, 'cached': 0}
+        self.started_at = time.time()
+
+    def observe(self, phase, seconds):
+        with self.lock:
+            histogram = self.phases.get(phase)
+            if histogram is None:
+                histogram = self.phases[phase] = Histogram()
+            histogram.observe(seconds)
+
+    def observe_row(self, meta, error):
+        with self.lock:
+            self.rows['error' if error else 'success'] += 1
+            if meta.get('prompt_tokens'):
+                self.tokens['prompt'] += meta['prompt_tokens']
+                self.tokens['cached'] += meta.get('cached_tokens', 0)
+        for phase, seconds in meta.get('timings', {}).items():
+            self.observe(phase, seconds)
+
+    def cached_ratio(self):
+        """提示词 token 中命中服务端前缀缓存的比例，尚无 usage 时为 None"""
+        prompt = self.tokens['prompt']
+        return round(self.tokens['cached'] / prompt, 4) if prompt else None
+
+    def snapshot(self):
+        with self.lock:
+            rows = sum(self.rows.values())
+            elapsed = time.time() - self.started_at
+            return {
+                'rows': dict(self.rows),
+                'rows_per_second': round(rows / elapsed, 2) if elapsed > 0 else None,
+                'tokens': dict(self.tokens, cached_ratio=self.cached_ratio()),
+                'phases': {phase: histogram.summary() for phase, histogram in self.phases.items()}
+            }
+
+_endpoint_metrics = {}
+_endpoint_metrics_lock = threading.Lock()
+
+def metrics_endpoint(api_config, url=None):
+    """指标中的端点标签（scheme://host）；url 为实际请求的端点地址，缺省取 api_config 的地址"""
+    if not url:
+        url = api_config.get('api_url') or api_config.get('apiUrl')
+    if not url and api_config.get('endpoints'):
+        url = api_config['endpoints'][0].get('api_url') or api_config['endpoints'][0].get('apiUrl')
+    parts = urlsplit(url or '')
+    return f'{parts.scheme}://{parts.netloc}'
+
+def get_endpoint_metrics(api_config, url=None):
+    endpoint = metrics_endpoint(api_config, url)
+    with _endpoint_metrics_lock:
+        metrics = _endpoint_metrics.get(endpoint)
+        if metrics is None:
+            metrics = _endpoint_metrics[endpoint] = PhaseMetrics()
+        return metrics
+
+def render_prometheus_metrics():
+    lines = [
+        '# HELP promptfactory_phase_seconds 每行数据各处理阶段耗时',
+        '# TYPE promptfactory_phase_seconds histogram'
+    ]
+    rows = [
+        '# HELP promptfactory_rows_total 已处理行数',
+        '# TYPE promptfactory_rows_total counter'
+    ]
+    tokens = [
+        '# HELP promptfactory_prompt_tokens_total 实际请求的提示词 token 数，cached 为命中服务端前缀缓存的部分',
+        '# TYPE promptfactory_prompt_tokens_total counter'
+    ]
+    with _endpoint_metrics_lock:
+        endpoints = list(_endpoint_metrics.items())
+    for endpoint, metrics in endpoints:
+        with metrics.lock:
+            for status, n in metrics.rows.items():
+                rows.append(f'promptfactory_rows_total{{endpoint="{endpoint}",status="{status}"}} {n}')
+            for kind, n in metrics.tokens.items():
+                tokens.append(f'promptfactory_prompt_tokens_total{{endpoint="{endpoint}",kind="{kind}"}} {n}')
+            for phase, histogram in metrics.phases.items():
+                labels = f'endpoint="{endpoint}",phase="{phase}"'
+                cumulative = 0
+                for bound, n in zip(METRIC_BUCKETS, histogram.counts):
+                    cumulative += n
+                    lines.append(f'promptfactory_phase_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f'promptfactory_phase_seconds_bucket{{{labels},le="+Inf"}} {histogram.count}')
+                lines.append(f'promptfactory_phase_seconds_sum{{{labels}}} {histogram.sum}')
+                lines.append(f'promptfactory_phase_seconds_count{{{labels}}} {histogram.count}')
+    gauges = [
+        '# HELP promptfactory_concurrency_limit 端点当前并发上限（自适应并发）',
+        '# TYPE promptfactory_concurrency_limit gauge'
+    ]
+    limits = {}
+    for key, controller in list(_controllers.items()):
+        # 同一端点不同凭证的控制器合并
+        endpoint = metrics_endpoint({'api_url': key[0]})
+        limits[endpoint] = limits.get(endpoint, 0) + int(controller.limit)
+    for endpoint, limit in limits.items():
+        gauges.append(f'promptfactory_concurrency_limit{{endpoint="{endpoint}"}} {limit}')
+    outstanding_lines = [
+        '# HELP promptfactory_endpoint_outstanding 端点在途请求数',
+        '# TYPE promptfactory_endpoint_outstanding gauge'
+    ]
+    circuit_lines = [
+        '# HELP promptfactory_endpoint_circuit_open 端点处于熔断或半开状态的凭证数',
+        '# TYPE promptfactory_endpoint_circuit_open gauge'
+    ]
+    health_by_endpoint = {}
+    with _endpoint_lock:
+        healths = list(_endpoint_health.items())
+    for key, health in healths:
+        # 同一端点不同凭证合并：在途数求和，熔断数为熔断中的凭证个数
+        endpoint = metrics_endpoint({'api_url': key[0]})
+        outstanding, circuit_open = health_by_endpoint.get(endpoint, (0, 0))
+        health_by_endpoint[endpoint] = (outstanding + health.outstanding, circuit_open + int(health.state != 'closed'))
+    for endpoint, (outstanding, circuit_open) in health_by_endpoint.items():
+        outstanding_lines.append(f'promptfactory_endpoint_outstanding{{endpoint="{endpoint}"}} {outstanding}')
+        circuit_lines.append(f'promptfactory_endpoint_circuit_open{{endpoint="{endpoint}"}} {circuit_open}')
+    gauges += outstanding_lines + circuit_lines
+    gauges += [
+        '# HELP promptfactory_jobs_running 当前进程中正在执行的后台任务数',
+        '# TYPE promptfactory_jobs_running gauge',
+        f'promptfactory_jobs_running {len(_job_channels)}'
+    ]
+    return '\n'.join(lines + rows + tokens + gauges) + '\n'
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Prometheus 文本格式的指标"""
+    return Response(render_prometheus_metrics(), mimetype='text/plain; version=0.0.4')
+# ================== End 指标 ==================
+
+# ================== 数据库访问层 ==================
+# 所有对 projects.db 的访问都通过 get_db() 从连接池借出连接，close() 时归还而不是真正关闭，
+# 连接上的预编译语句缓存因此在请求之间得以复用。连接统一使用 WAL 模式（读写互不阻塞）与 busy_timeout。
+DB_PATH = os.environ.get('PROMPTFACTORY_DB', 'projects.db')
+DB_BUSY_TIMEOUT = 30  # 秒
+DB_POOL_SIZE = 16
+DB_STATEMENT_CACHE = 256
+
+class PooledConnection:
+    """从连接池借出的连接，用法与 sqlite3.Connection 相同"""
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def close(self):
+        """归还连接（未提交的事务会被回滚）"""
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._pool.release(conn)
+
+class ConnectionPool:
+    """SQLite 连接池（连接可跨线程借用，同一时刻只被一个线程使用）"""
+
+    def __init__(self, path, size=DB_POOL_SIZE):
+        self.path = path
+        self.size = size
+        self.idle = queue.LifoQueue()
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=DB_BUSY_TIMEOUT, check_same_thread=False, cached_statements=DB_STATEMENT_CACHE)
+        conn.execute(f'PRAGMA busy_timeout = {DB_BUSY_TIMEOUT * 1000}')
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        return conn
+
+    def acquire(self):
+        try:
+            conn = self.idle.get_nowait()
+        except queue.Empty:
+            conn = self.connect()
+        return PooledConnection(self, conn)
+
+    def release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            conn.close()
+            return
+        if self.idle.qsize() < self.size:
+            self.idle.put(conn)
+        else:
+            conn.close()
+
+_db_pool = ConnectionPool(DB_PATH)
+
+def get_db():
+    """借出一个数据库连接，用完后调用 close() 归还"""
+    return _db_pool.acquire()
+
+def _add_missing_columns(cursor, table, columns):
+    """为旧版本数据库补齐缺失的列（仅在基础迁移中使用一次）"""
+    cursor.execute(f"PRAGMA table_info({table})")
+    existing = {row[1] for row in cursor.fetchall()}
+    for column, column_type in columns:
+        if column not in existing:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+
+def _migrate_base_schema(cursor):
+    """基础表结构；引入迁移机制之前创建的数据库在此补齐后续添加的列"""
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS projects (
             id TEXT PRIMARY KEY,
@@ -51,13 +430,9 @@ def init_db():
             updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
-    # 检查并添加 prompt_template 字段（兼容老库）
-    cursor.execute("PRAGMA table_info(projects)")
-    columns = [row[1] for row in cursor.fetchall()]
-    if 'prompt_template' not in columns:
-        cursor.execute("ALTER TABLE projects ADD COLUMN prompt_template TEXT")
+    _add_missing_columns(cursor, 'projects', [('prompt_template', 'TEXT')])
     
-    # 创建处理记录表
+    # 处理记录表（同步处理记录与后台任务共用）
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS processing_records (
             id TEXT PRIMARY KEY,
@@ -68,11 +443,35 @@ def init_db():
             error_count INTEGER,
             status TEXT,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            job_config TEXT,
+            processed_count INTEGER,
+            retry_count INTEGER,
+            result_id TEXT,
+            heartbeat_at REAL,
+            error_message TEXT,
+            updated_at TIMESTAMP,
+            cache_hits INTEGER,
+            cache_misses INTEGER,
+            dedup_count INTEGER,
+            stats TEXT,
             FOREIGN KEY (project_id) REFERENCES projects (id)
         )
     ''')
+    _add_missing_columns(cursor, 'processing_records', [
+        ('job_config', 'TEXT'),
+        ('processed_count', 'INTEGER'),
+        ('retry_count', 'INTEGER'),
+        ('result_id', 'TEXT'),
+        ('heartbeat_at', 'REAL'),
+        ('error_message', 'TEXT'),
+        ('updated_at', 'TIMESTAMP'),
+        ('cache_hits', 'INTEGER'),
+        ('cache_misses', 'INTEGER'),
+        ('dedup_count', 'INTEGER'),
+        ('stats', 'TEXT')
+    ])
     
-    # 创建全局提示词模板表
+    # 全局提示词模板表
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS prompt_templates (
             id TEXT PRIMARY KEY,
@@ -83,42 +482,200 @@ def init_db():
             updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
-    
-    conn.commit()
-    conn.close()
+
+# 数据库迁移：(版本号, 说明, SQL语句列表或 fn(cursor))，按版本号顺序执行，已执行的版本记录在 PRAGMA user_version 中。
+# 修改表结构时只追加新的迁移，不要修改已发布的迁移。
+SCHEMA_MIGRATIONS = [
+    (1, '基础表结构', _migrate_base_schema),
+    (2, '列表与任务领取查询的索引', [
+        'CREATE INDEX IF NOT EXISTS idx_records_project_created ON processing_records (project_id, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_records_created ON processing_records (created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_records_status_heartbeat ON processing_records (status, heartbeat_at)',
+        'CREATE INDEX IF NOT EXISTS idx_projects_updated ON projects (updated_at)',
+        'CREATE INDEX IF NOT EXISTS idx_templates_updated ON prompt_templates (updated_at)'
+    ]),
+    (3, '键集分页索引（排序列 + id）', [
+        'DROP INDEX IF EXISTS idx_records_project_created',
+        'DROP INDEX IF EXISTS idx_records_created',
+        'DROP INDEX IF EXISTS idx_projects_updated',
+        'DROP INDEX IF EXISTS idx_templates_updated',
+        'CREATE INDEX IF NOT EXISTS idx_records_project_created ON processing_records (project_id, created_at, id)',
+        'CREATE INDEX IF NOT EXISTS idx_records_created ON processing_records (created_at, id)',
+        'CREATE INDEX IF NOT EXISTS idx_records_status_created ON processing_records (status, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_projects_updated ON projects (updated_at, id)',
+        'CREATE INDEX IF NOT EXISTS idx_templates_updated ON prompt_templates (updated_at, id)'
+    ]),
+    (4, '提供商批处理任务', [
+        '''CREATE TABLE IF NOT EXISTS provider_batches (
+            id TEXT PRIMARY KEY,
+            api_base TEXT NOT NULL,
+            input_sha256 TEXT NOT NULL,
+            input_file_id TEXT,
+            request_count INTEGER,
+            status TEXT,
+            completed_count INTEGER DEFAULT 0,
+            failed_count INTEGER DEFAULT 0,
+            output_file_id TEXT,
+            error_file_id TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_provider_batches_input ON provider_batches (api_base, input_sha256)',
+        'CREATE INDEX IF NOT EXISTS idx_provider_batches_created ON provider_batches (created_at, id)'
+    ]),
+    (5, '增量处理的指纹索引', [
+        '''CREATE TABLE IF NOT EXISTS row_fingerprints (
+            project_id TEXT NOT NULL,
+            fingerprint TEXT NOT NULL,
+            output TEXT,
+            job_id TEXT,
+            created_at REAL,
+            PRIMARY KEY (project_id, fingerprint)
+        )''',
+        'ALTER TABLE processing_records ADD COLUMN reused_count INTEGER'
+    ]),
+    (6, '实际发出的请求数', [
+        'ALTER TABLE processing_records ADD COLUMN sent_count INTEGER'
+    ]),
+    (7, '指纹索引的配置哈希与淘汰索引', [
+        'ALTER TABLE row_fingerprints ADD COLUMN config_hash TEXT',
+        'CREATE INDEX IF NOT EXISTS idx_row_fingerprints_created ON row_fingerprints (project_id, created_at)'
+    ])
+]
+
+def migrate_db(conn):
+    """执行尚未应用的迁移（多进程同时启动时由写锁保证只执行一次）"""
+    cursor = conn.cursor()
+    for version, description, step in SCHEMA_MIGRATIONS:
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            current = cursor.execute('PRAGMA user_version').fetchone()[0]
+            if version <= current:
+                conn.rollback()
+                continue
+            if callable(step):
+                step(cursor)
+            else:
+                for sql in step:
+                    cursor.execute(sql)
+            cursor.execute(f'PRAGMA user_version = {version}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        log_event(logging.INFO, '数据库迁移完成', version=version, description=description)
+
+# 数据库初始化
+def init_db():
+    conn = get_db()
+    try:
+        migrate_db(conn)
+    finally:
+        conn.close()
 
 # 初始化数据库
 init_db()
+# ================== End 数据库访问层 ==================
 
 @app.route('/')
 def index():
     return render_template('index.html')
 
+# ================== 分页 ==================
+# 列表接口使用键集分页：按 (排序列, id) 倒序，游标为上一页最后一行的 (排序列, id)。
+# 响应体仍为数组，存在下一页时通过 X-Next-Cursor 响应头返回游标，请求时以 ?cursor= 传回。
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+def encode_cursor(sort_value, row_id):
+    return base64.urlsafe_b64encode(json.dumps([sort_value, row_id]).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    try:
+        sort_value, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return sort_value, row_id
+    except Exception:
+        raise ValueError('无效的分页游标')
+
+def parse_datetime_arg(name):
+    """解析日期参数（YYYY-MM-DD 或 ISO 格式），返回与 created_at 可比较的字符串"""
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value).strftime('%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        raise ValueError(f'无效的日期参数 {name}: {value}')
+
+def page_query(base_sql, where, params, sort_column, row_to_dict):
+    """执行键集分页查询，返回带 X-Next-Cursor 响应头的 JSON 数组响应
+
+    base_sql 为不含 WHERE/ORDER BY 的 SELECT 语句，结果行的最后两列须为 (排序列, id)。
+    """
+    try:
+        limit = min(max(int(request.args.get('limit', DEFAULT_PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify({'error': 'limit 参数必须是整数'}), 400
+    where, params = list(where), list(params)
+    cursor_arg = request.args.get('cursor')
+    if cursor_arg:
+        try:
+            sort_value, row_id = decode_cursor(cursor_arg)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        where.append(f'({sort_column} < ? OR ({sort_column} = ? AND id < ?))')
+        params += [sort_value, sort_value, row_id]
+    sql = base_sql
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    sql += f' ORDER BY {sort_column} DESC, id DESC LIMIT ?'
+    conn = get_db()
+    rows = conn.execute(sql, (*params, limit + 1)).fetchall()
+    conn.close()
+    response = jsonify([row_to_dict(row) for row in rows[:limit]])
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        response.headers['X-Next-Cursor'] = encode_cursor(last[-2], last[-1])
+    return response
+
+def record_filters():
+    """处理记录的筛选条件：project_id、status（逗号分隔）、since、until（不含）"""
+    where, params = [], []
+    project_id = request.args.get('project_id')
+    if project_id:
+        where.append('project_id = ?')
+        params.append(project_id)
+    statuses = [s for s in request.args.get('status', '').split(',') if s]
+    if statuses:
+        where.append(f"status IN ({', '.join('?' * len(statuses))})")
+        params += statuses
+    since = parse_datetime_arg('since')
+    if since:
+        where.append('created_at >= ?')
+        params.append(since)
+    until = parse_datetime_arg('until')
+    if until:
+        where.append('created_at < ?')
+        params.append(until)
+    return where, params
+# ================== End 分页 ==================
+
 @app.route('/api/projects', methods=['GET'])
 def get_projects():
-    """获取所有项目列表"""
-    conn = sqlite3.connect('projects.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT id, name, description, api_config, created_at, updated_at 
-        FROM projects 
-        ORDER BY updated_at DESC
-    ''')
-    
-    projects = []
-    for row in cursor.fetchall():
-        projects.append({
+    """获取项目列表（按更新时间倒序分页）"""
+    def to_dict(row):
+        return {
             'id': row[0],
             'name': row[1],
             'description': row[2],
             'api_config': json.loads(row[3]) if row[3] else None,
             'created_at': row[4],
             'updated_at': row[5]
-        })
-    
-    conn.close()
-    return jsonify(projects)
+        }
+    return page_query(
+        'SELECT id, name, description, api_config, created_at, updated_at, id FROM projects',
+        [], [], 'updated_at', to_dict
+    )
 
 @app.route('/api/projects', methods=['POST'])
 def create_project():
@@ -126,11 +683,11 @@ def create_project():
     data = request.json
     if not data.get('name'):
         return jsonify({'error': '项目名称不能为空'}), 400
-    if not data.get('api_config', {}).get('api_url'):
+    if not has_api_endpoint(data.get('api_config', {})):
         return jsonify({'error': 'API URL 不能为空'}), 400
     try:
         project_id = str(uuid.uuid4())
-        conn = sqlite3.connect('projects.db')
+        conn = get_db()
         cursor = conn.cursor()
         cursor.execute('''
             INSERT INTO projects (id, name, description, api_config, prompt_template)
@@ -159,7 +716,7 @@ def create_project():
 @app.route('/api/projects/<project_id>', methods=['GET'])
 def get_project(project_id):
     """获取单个项目详情"""
-    conn = sqlite3.connect('projects.db')
+    conn = get_db()
     cursor = conn.cursor()
     
     cursor.execute('''
@@ -189,10 +746,10 @@ def update_project(project_id):
     data = request.json
     if not data.get('name'):
         return jsonify({'error': '项目名称不能为空'}), 400
-    if not data.get('api_config', {}).get('api_url'):
+    if not has_api_endpoint(data.get('api_config', {})):
         return jsonify({'error': 'API URL 不能为空'}), 400
     try:
-        conn = sqlite3.connect('projects.db')
+        conn = get_db()
         cursor = conn.cursor()
         cursor.execute('''
             UPDATE projects 
@@ -217,7 +774,7 @@ def update_project(project_id):
 @app.route('/api/projects/<project_id>', methods=['DELETE'])
 def delete_project(project_id):
     """删除项目"""
-    conn = sqlite3.connect('projects.db')
+    conn = get_db()
     cursor = conn.cursor()
     
     cursor.execute('DELETE FROM projects WHERE id = ?', (project_id,))
@@ -226,6 +783,7 @@ def delete_project(project_id):
         conn.close()
         return jsonify({'error': '项目不存在'}), 404
     
+    cursor.execute('DELETE FROM row_fingerprints WHERE project_id = ?', (project_id,))
     conn.commit()
     conn.close()
     
@@ -236,7 +794,7 @@ def process_file(project_id):
     """处理文件"""
     try:
         # 获取项目配置
-        conn = sqlite3.connect('projects.db')
+        conn = get_db()
         cursor = conn.cursor()
         
         cursor.execute('SELECT api_config FROM projects WHERE id = ?', (project_id,))
@@ -251,97 +809,85 @@ def process_file(project_id):
         
         # 获取上传的文件
         if 'file' not in request.files:
-            print("DEBUG: 没有找到文件字段")
-            print(f"DEBUG: 请求文件字段: {list(request.files.keys())}")
+            log_event(logging.DEBUG, '没有找到文件字段', files=list(request.files.keys()))
             return jsonify({'error': '没有上传文件'}), 400
         
         file = request.files['file']
         if file.filename == '':
-            print("DEBUG: 文件名为空")
+            log_event(logging.DEBUG, '文件名为空')
             return jsonify({'error': '没有选择文件'}), 400
         
-        print(f"DEBUG: 接收到文件: {file.filename}")
+        log_event(logging.DEBUG, '接收到文件', file_name=file.filename)
         
-        # 读取文件内容
+        # 校验并统计行数（逐行读取，不把整个文件载入内存）
         try:
-            content = file.read().decode('utf-8')
-            print(f"DEBUG: 文件内容长度: {len(content)}")
+            total_lines = count_jsonl_rows(file.stream, validate=True)
+        except ValueError as e:
+            log_event(logging.DEBUG, '文件校验失败', error=str(e))
+            return jsonify({'error': str(e)}), 400
         except Exception as e:
-            print(f"DEBUG: 文件读取失败: {e}")
+            log_event(logging.WARNING, '文件读取失败', error=str(e))
             return jsonify({'error': f'文件读取失败: {str(e)}'}), 400
         
-        lines = content.split('\n')
-        print(f"DEBUG: 文件行数: {len(lines)}")
-        
-        # 解析JSONL
-        data = []
-        for i, line in enumerate(lines):
-            if line.strip():
-                try:
-                    json_obj = json.loads(line)
-                    data.append(json_obj)
-                except json.JSONDecodeError as e:
-                    print(f"DEBUG: 第{i+1}行JSON解析失败: {e}")
-                    return jsonify({'error': f'第{i+1}行JSON格式错误: {str(e)}'}), 400
-        
-        print(f"DEBUG: 成功解析 {len(data)} 行数据")
+        log_event(logging.DEBUG, '文件解析完成', total_lines=total_lines)
         
         # 获取处理参数
         prompt_template = request.form.get('prompt_template', '')
         result_field_name = request.form.get('result_field_name', 'response')
         max_workers = int(request.form.get('max_workers', 10))
-        
-        print(f"DEBUG: 提示词模板长度: {len(prompt_template)}")
-        print(f"DEBUG: 结果字段名: {result_field_name}")
-        print(f"DEBUG: 最大工作线程数: {max_workers}")
+        engine = request.form.get('engine', 'thread')
+        if engine not in ENGINES:
+            return jsonify({'error': f'不支持的执行引擎: {engine}'}), 400
+        if engine == 'batch':
+            return jsonify({'error': '批处理API模式耗时较长，请使用后台任务（process-stream）提交'}), 400
         
         # 检查API配置
-        api_url = api_config.get('api_url') or api_config.get('apiUrl')
-        if not api_url:
-            print("DEBUG: API URL未配置")
+        if not has_api_endpoint(api_config):
             return jsonify({'error': '请先配置API URL'}), 400
         
-        print(f"DEBUG: API URL: {api_url}")
+        # 模板只编译一次，并用首行数据校验变量
+        prompt_template = compile_template(prompt_template)
+        warning = template_warning(prompt_template, first_jsonl_row(file.stream))
+        if warning:
+            log_event(logging.WARNING, warning, project_id=project_id)
+        log_event(logging.INFO, '开始同步处理', project_id=project_id, file_name=file.filename, total_lines=total_lines,
+                  template_length=len(prompt_template.source), result_field=result_field_name, max_workers=max_workers, engine=engine)
         
-        # 使用线程池处理数据
-        processed_data = []
-        error_count = 0
+        # 使用执行引擎处理数据（结果按原始行顺序保存，死信重跑成功的行会覆盖首轮的错误结果）
+        processed_data = [None] * total_lines
+        errors = {}
+        metrics = PhaseMetrics()
         
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            futures = {
-                executor.submit(call_llm_api, item, prompt_template, api_config, result_field_name): idx
-                for idx, item in enumerate(data)
-            }
-            
-            for future in as_completed(futures):
-                try:
-                    processed_item, error = future.result()
-                    processed_data.append(processed_item)
-                    if error:
-                        error_count += 1
-                        print(f"DEBUG: 处理错误: {error}")
-                except Exception as e:
-                    error_count += 1
-                    print(f"处理任务异常：{e}")
+        def on_result(idx, item, processed_item, error, meta):
+            metrics.observe_row(meta, error)
+            processed_data[idx] = processed_item
+            if error:
+                errors[idx] = error
+            else:
+                errors.pop(idx, None)
+        
+        run_with_dead_letter(engine, iter_jsonl(file.stream), prompt_template, api_config, result_field_name, max_workers, on_result)
+        error_count = len(errors)
         
-        print(f"DEBUG: 处理完成，成功: {len(processed_data) - error_count}, 失败: {error_count}")
+        log_event(logging.INFO, '同步处理完成', project_id=project_id, success=len(processed_data) - error_count, error=error_count)
         
         # 保存处理记录
         record_id = str(uuid.uuid4())
-        conn = sqlite3.connect('projects.db')
+        conn = get_db()
         cursor = conn.cursor()
         
         cursor.execute('''
-            INSERT INTO processing_records (id, project_id, file_name, total_lines, success_count, error_count, status)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
+            INSERT INTO processing_records (id, project_id, file_name, total_lines, success_count, error_count, status, stats)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
         ''', (
             record_id,
             project_id,
             file.filename,
-            len(data),
+            total_lines,
             len(processed_data) - error_count,
             error_count,
-            'completed'
+            'completed',
+            json.dumps(metrics.snapshot())
         ))
         
         conn.commit()
@@ -350,40 +896,24 @@ def process_file(project_id):
         return jsonify({
             'record_id': record_id,
             'processed_data': processed_data,
-            'total_lines': len(data),
+            'total_lines': total_lines,
             'success_count': len(processed_data) - error_count,
             'error_count': error_count
         })
         
     except Exception as e:
-        print(f"DEBUG: 处理文件异常: {e}")
+        logger.exception('处理文件异常')
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/processing-records', methods=['GET'])
 def get_processing_records():
-    """获取处理记录"""
-    project_id = request.args.get('project_id')
-    
-    conn = sqlite3.connect('projects.db')
-    cursor = conn.cursor()
-    
-    if project_id:
-        cursor.execute('''
-            SELECT id, project_id, file_name, total_lines, success_count, error_count, status, created_at
-            FROM processing_records 
-            WHERE project_id = ?
-            ORDER BY created_at DESC
-        ''', (project_id,))
-    else:
-        cursor.execute('''
-            SELECT id, project_id, file_name, total_lines, success_count, error_count, status, created_at
-            FROM processing_records 
-            ORDER BY created_at DESC
-        ''')
-    
-    records = []
-    for row in cursor.fetchall():
-        records.append({
+    """获取处理记录（按创建时间倒序分页，可按 project_id/status/since/until 筛选）"""
+    try:
+        where, params = record_filters()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    def to_dict(row):
+        return {
             'id': row[0],
             'project_id': row[1],
             'file_name': row[2],
@@ -391,11 +921,71 @@ def get_processing_records():
             'success_count': row[4],
             'error_count': row[5],
             'status': row[6],
-            'created_at': row[7]
-        })
+            'created_at': row[7],
+            'processed_count': row[8],
+            'result_id': row[9],
+            'error_message': row[10]
+        }
+    return page_query(
+        '''SELECT id, project_id, file_name, total_lines, success_count, error_count, status, created_at,
+                  processed_count, result_id, error_message, created_at, id
+           FROM processing_records''',
+        where, params, 'created_at', to_dict
+    )
+
+SUMMARY_INTERVALS = {
+    'hour': '%Y-%m-%d %H:00',
+    'day': '%Y-%m-%d',
+    'week': '%Y-W%W',
+    'month': '%Y-%m'
+}
+
+@app.route('/api/processing-records/summary', methods=['GET'])
+def get_processing_summary():
+    """处理记录汇总：总数、各状态数量、成功率，以及按时间段（interval=hour/day/week/month）的趋势"""
+    try:
+        where, params = record_filters()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    interval = request.args.get('interval', 'day')
+    if interval not in SUMMARY_INTERVALS:
+        return jsonify({'error': f'不支持的时间粒度: {interval}'}), 400
+    where_sql = ' WHERE ' + ' AND '.join(where) if where else ''
+    
+    def success_rate(success, error):
+        return round(success / (success + error), 4) if success + error else None
     
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute(f'''
+        SELECT status, COUNT(*), COALESCE(SUM(total_lines), 0), COALESCE(SUM(success_count), 0), COALESCE(SUM(error_count), 0)
+        FROM processing_records{where_sql}
+        GROUP BY status
+    ''', params)
+    by_status = {}
+    totals = {'records': 0, 'rows': 0, 'success': 0, 'error': 0}
+    for status, records, rows, success, error in cursor.fetchall():
+        by_status[status] = records
+        totals['records'] += records
+        totals['rows'] += rows
+        totals['success'] += success
+        totals['error'] += error
+    totals['success_rate'] = success_rate(totals['success'], totals['error'])
+    cursor.execute(f'''
+        SELECT strftime(?, created_at) AS period, COUNT(*), COALESCE(SUM(success_count), 0), COALESCE(SUM(error_count), 0)
+        FROM processing_records{where_sql}
+        GROUP BY period
+        ORDER BY period
+    ''', (SUMMARY_INTERVALS[interval], *params))
+    series = [{
+        'period': period,
+        'records': records,
+        'success': success,
+        'error': error,
+        'success_rate': success_rate(success, error)
+    } for period, records, success, error in cursor.fetchall()]
     conn.close()
-    return jsonify(records)
+    return jsonify({'totals': totals, 'by_status': by_status, 'interval': interval, 'series': series})
 
 @app.route('/api/test-prompt', methods=['POST'])
 def test_prompt():
@@ -410,7 +1000,7 @@ def test_prompt():
             return jsonify({'error': '缺少必要参数'}), 400
         
         # 获取项目配置
-        conn = sqlite3.connect('projects.db')
+        conn = get_db()
         cursor = conn.cursor()
         
         cursor.execute('SELECT api_config FROM projects WHERE id = ?', (project_id,))
@@ -424,337 +1014,3800 @@ def test_prompt():
         conn.close()
         
         # 调用API进行测试
-        processed_item, error = call_llm_api(test_data, prompt_template, api_config, 'response')
-        
-        # 使用相同的变量替换函数来渲染提示词
-        import re
-        def replace_variables(template, data):
-            """智能变量替换函数 - 使用更精确的匹配规则"""
-            def replace_match(match):
-                var_name = match.group(1)
-                if var_name in data:
-                    return str(data[var_name])
-                else:
-                    # 如果变量不存在，保持原样
-                    return match.group(0)
-            
-            # 使用更精确的正则表达式：
-            # 1. 匹配{{变量名}}格式，其中变量名只能包含字母、数字、下划线
-            # 2. 确保{{和}}之间没有空格
-            # 3. 避免匹配转义的大括号
-            pattern = r'\{\{([a-zA-Z_][a-zA-Z0-9_]*)\}\}'
-            return re.sub(pattern, replace_match, template)
+        # 测试时总是请求实时结果（仍写入缓存）
+        api_config['response_cache'] = 'refresh' if response_cache_mode(api_config) else False
+        
+        # 与批处理共用同一渲染器
+        template = compile_template(prompt_template)
+        rendered_prompt = template.render(test_data)
+        missing_variables = template.missing_variables(test_data)
         
-        rendered_prompt = replace_variables(prompt_template, test_data)
+        if data.get('stream') and api_config.get('stream'):
+            # 项目启用流式响应时以SSE逐块推送生成中的输出（delta / reset 事件），最后推送 done 事件
+            return Response(stream_test_prompt(test_data, template, api_config, rendered_prompt, missing_variables),
+                            mimetype='text/event-stream')
+        processed_item, error = call_llm_api(test_data, template, api_config, 'response')
         
         if error:
             return jsonify({
                 'success': False,
                 'error': error,
-                'rendered_prompt': rendered_prompt
+                'rendered_prompt': rendered_prompt,
+                'missing_variables': missing_variables
             })
         else:
             return jsonify({
                 'success': True,
                 'response': processed_item.get('response', ''),
-                'rendered_prompt': rendered_prompt
+                'rendered_prompt': rendered_prompt,
+                'missing_variables': missing_variables
             })
             
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-def call_llm_api(data_item, prompt_template, api_config, result_field_name):
-    """调用大模型API"""
-    try:
-        import re
-        
-        # 使用正则表达式精确匹配{{变量名}}格式，避免误处理其他大括号
-        def replace_variables(template, data):
-            """智能变量替换函数 - 使用更精确的匹配规则"""
-            def replace_match(match):
-                var_name = match.group(1)
-                if var_name in data:
-                    return str(data[var_name])
-                else:
-                    # 如果变量不存在，保持原样
-                    return match.group(0)
-            
-            # 使用更精确的正则表达式：
-            # 1. 匹配{{变量名}}格式，其中变量名只能包含字母、数字、下划线
-            # 2. 确保{{和}}之间没有空格
-            # 3. 避免匹配转义的大括号
-            pattern = r'\{\{([a-zA-Z_][a-zA-Z0-9_]*)\}\}'
-            return re.sub(pattern, replace_match, template)
-        
-        # 构建用户提示词
-        try:
-            user_prompt = replace_variables(prompt_template, data_item)
-            print(f"DEBUG: 原始模板: {prompt_template}")
-            print(f"DEBUG: 数据项: {data_item}")
-            print(f"DEBUG: 渲染后提示词: {user_prompt}")
-        except Exception as e:
-            raise ValueError(f"模板渲染失败: {str(e)}")
-        
-        # 构建请求头
-        headers = {
-            "Content-Type": "application/json"
-        }
-        
-        # 处理API URL - 支持前端和后端的字段名
-        api_url = api_config.get('api_url') or api_config.get('apiUrl')
-        if not api_url:
-            raise ValueError("API URL未配置")
-        
-        # 处理认证信息 - 支持多种认证方式
-        if api_config.get('apiKey'):
-            headers["Authorization"] = f"Bearer {api_config['apiKey']}"
-        elif api_config.get('auth_token'):
-            headers["X-Auth-Token"] = api_config['auth_token']
-        elif api_config.get('authorization'):
-            headers["Authorization"] = api_config['authorization']
-        
-        # 构建请求体 - 修复消息格式
-        payload = {
-            "model": api_config.get('modelName', 'gpt-4'),
-            "messages": [
-                {
-                    "role": "user",
-                    "content": user_prompt
-                }
-            ],
-            "temperature": api_config.get('temperature', 0.3),
-            "max_tokens": api_config.get('max_tokens') or api_config.get('maxTokens', 16384),
-            "stream": False
-        }
-        
-        # 发送请求
-        response = requests.post(
-            api_url, 
-            headers=headers, 
-            json=payload, 
-            verify=api_config.get('verify_ssl', True),
-            timeout=api_config.get('timeout', 30)
-        )
-        response.raise_for_status()
-        
-        # 解析响应
-        response_data = response.json()
-        if 'choices' in response_data and len(response_data['choices']) > 0:
-            result = response_data['choices'][0]['message']['content']
+def stream_test_prompt(test_data, template, api_config, rendered_prompt, missing_variables):
+    """在后台线程中调用API，将增量输出转为SSE事件"""
+    events = queue.Queue()
+    def on_delta(delta):
+        events.put({'type': 'reset'} if delta is None else {'type': 'delta', 'text': delta})
+    def run():
+        processed_item, error = call_llm_api(test_data, template, api_config, 'response', on_delta=on_delta)
+        events.put({
+            'type': 'done',
+            'success': not error,
+            'response': processed_item.get('response', ''),
+            'error': error,
+            'rendered_prompt': rendered_prompt,
+            'missing_variables': missing_variables
+        })
+    threading.Thread(target=run, daemon=True).start()
+    while True:
+        event = events.get()
+        yield sse_format(event)
+        if event['type'] == 'done':
+            return
+
+# ================== HTTP 传输层 ==================
+# 按端点（scheme + host + 证书校验 + 协议）共享连接池，同一批任务的所有行复用 keep-alive 连接，
+# 避免每行数据都重新进行 TCP/TLS 握手。asyncio 引擎的连接池绑定事件循环，每次运行按端点创建（AsyncTransports）
+DEFAULT_POOL_MAXSIZE = 10
+
+class HttpTransport:
+    """单个API端点的共享连接池（线程安全）"""
+
+    def __init__(self, verify=True, pool_maxsize=DEFAULT_POOL_MAXSIZE, pool_block=False, http2=False, keepalive_expiry=60):
+        self.verify = verify
+        self.pool_maxsize = pool_maxsize
+        self.http2 = http2
+        if http2:
+            # httpx.Client 本身线程安全，连接数上限与连接池大小保持一致
+            self.client = httpx.Client(
+                http2=True,
+                verify=verify,
+                limits=httpx.Limits(
+                    max_connections=pool_maxsize,
+                    max_keepalive_connections=pool_maxsize,
+                    keepalive_expiry=keepalive_expiry
+                )
+            )
         else:
-            result = response_data.get('content', str(response_data))
-        
-        # 返回处理后的数据
-        processed_item = data_item.copy()
-        processed_item[result_field_name] = result
-        return processed_item, None
-        
-    except Exception as e:
-        # 返回错误信息
-        processed_item = data_item.copy()
-        processed_item[result_field_name] = f"错误: {str(e)}"
-        return processed_item, str(e)
+            self.client = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, pool_block=pool_block)
+            self.client.mount('http://', adapter)
+            self.client.mount('https://', adapter)
 
-# ================== 提示词模板工厂 API ==================
-TEMPLATE_FILE = os.path.join('data', 'prompt_templates.json')
+    def post(self, url, headers, payload, timeout):
+        if self.http2:
+            return self.client.post(url, headers=headers, json=payload, timeout=timeout)
+        return self.client.post(url, headers=headers, json=payload, verify=self.verify, timeout=timeout)
 
-def load_templates():
-    if not os.path.exists(TEMPLATE_FILE):
-        return []
-    with open(TEMPLATE_FILE, 'r', encoding='utf-8') as f:
+    @contextmanager
+    def stream(self, url, headers, payload, timeout):
+        """发送流式请求，产出 (response, 行迭代器)；timeout 为 (连接超时, 读取超时)"""
+        if self.http2:
+            with self.client.stream('POST', url, headers=headers, json=payload,
+                                    timeout=httpx.Timeout(timeout[1], connect=timeout[0])) as response:
+                yield response, response.iter_lines()
+            return
+        response = self.client.post(url, headers=headers, json=payload, verify=self.verify, timeout=timeout, stream=True)
         try:
-            return json.load(f)
-        except Exception:
-            return []
+            # 按字节分行，由调用方以UTF-8解码（text/event-stream 未声明编码时 requests 会按 ISO-8859-1 解码）
+            yield response, response.iter_lines(chunk_size=1024)
+        finally:
+            response.close()
 
-def save_templates(templates):
-    with write_lock:
-        with open(TEMPLATE_FILE, 'w', encoding='utf-8') as f:
-            json.dump(templates, f, ensure_ascii=False, indent=2)
+    def close(self):
+        self.client.close()
 
-@app.route('/api/prompt-templates', methods=['GET'])
-def get_prompt_templates():
-    """获取所有提示词模板"""
-    templates = load_templates()
-    return jsonify(templates)
+_transports = {}
+_transports_lock = threading.Lock()
 
-@app.route('/api/prompt-templates', methods=['POST'])
-def add_prompt_template():
-    """新增提示词模板"""
-    data = request.json
-    templates = load_templates()
-    new_template = {
-        'id': str(uuid.uuid4()),
-        'name': data.get('name', '未命名模板'),
-        'description': data.get('description', ''),
-        'content': data.get('content', '')
-    }
-    templates.append(new_template)
-    save_templates(templates)
-    return jsonify({'success': True, 'template': new_template})
+def transport_key(api_config, pool_size=None):
+    """返回 (连接池键 (scheme, host, 证书校验, HTTP/2), 连接池大小)"""
+    api_url = api_config.get('api_url') or api_config.get('apiUrl') or ''
+    parts = urlsplit(api_url)
+    verify = api_config.get('verify_ssl', True)
+    http2 = bool(api_config.get('http2', False))
+    if http2 and httpx is None:
+        log_event(logging.WARNING, '未安装 httpx[http2]，回退到 HTTP/1.1 连接池')
+        http2 = False
+    pool_maxsize = max(int(api_config.get('pool_maxsize') or DEFAULT_POOL_MAXSIZE), int(pool_size or 0))
+    return (parts.scheme, parts.netloc, verify, http2), pool_maxsize
 
-@app.route('/api/prompt-templates/<template_id>', methods=['DELETE'])
-def delete_prompt_template(template_id):
-    """删除指定ID的提示词模板"""
-    templates = load_templates()
-    new_templates = [tpl for tpl in templates if tpl['id'] != template_id]
-    if len(new_templates) == len(templates):
-        return jsonify({'success': False, 'error': '模板不存在'}), 404
-    save_templates(new_templates)
-    return jsonify({'success': True})
-# ================== End 提示词模板工厂 API ==================
+def get_transport(api_config, pool_size=None):
+    """获取（必要时创建）API端点对应的共享连接池
 
-# ========== 全局提示词模板API ==========
-@app.route('/api/templates', methods=['GET'])
-def get_templates():
-    """获取所有提示词模板"""
-    conn = sqlite3.connect('projects.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT id, name, description, content, created_at, updated_at FROM prompt_templates ORDER BY updated_at DESC')
-    templates = []
-    for row in cursor.fetchall():
-        templates.append({
-            'id': row[0],
-            'name': row[1],
-            'description': row[2],
-            'content': row[3],
-            'created_at': row[4],
-            'updated_at': row[5]
-        })
-    conn.close()
-    return jsonify(templates)
+    连接池大小取 api_config['pool_maxsize'] 与 pool_size（通常为 max_workers）中的较大值；
+    已有连接池容量不足时会按新容量重建。
+    """
+    key, pool_maxsize = transport_key(api_config, pool_size)
+    verify, http2 = key[2], key[3]
+    with _transports_lock:
+        transport = _transports.get(key)
+        if transport is None or transport.pool_maxsize < pool_maxsize:
+            kwargs = {
+                'verify': verify,
+                'pool_maxsize': pool_maxsize,
+                'pool_block': bool(api_config.get('pool_block', False)),
+                'keepalive_expiry': api_config.get('keepalive_expiry', 60)
+            }
+            try:
+                transport = HttpTransport(http2=http2, **kwargs)
+            except ImportError:
+                # 安装了 httpx 但缺少 h2 包
+                log_event(logging.WARNING, 'HTTP/2 需要安装 h2 包，回退到 HTTP/1.1 连接池')
+                transport = HttpTransport(**kwargs)
+            # 旧连接池不主动关闭，仍在使用它的请求完成后随引用释放
+            _transports[key] = transport
+        return transport
 
-@app.route('/api/templates', methods=['POST'])
-def create_template():
-    """新建提示词模板"""
-    data = request.json
-    template_id = str(uuid.uuid4())
-    conn = sqlite3.connect('projects.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO prompt_templates (id, name, description, content)
-        VALUES (?, ?, ?, ?)
-    ''', (
-        template_id,
-        data.get('name', '新模板'),
-        data.get('description', ''),
-        data.get('content', '')
-    ))
-    conn.commit()
-    conn.close()
-    return jsonify({'id': template_id, 'name': data.get('name', '新模板'), 'description': data.get('description', ''), 'content': data.get('content', '')})
+ASYNC_CLIENT_CONNECTIONS = 4
 
-@app.route('/api/templates/<template_id>', methods=['PUT'])
-def update_template(template_id):
-    """编辑提示词模板"""
-    data = request.json
-    conn = sqlite3.connect('projects.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        UPDATE prompt_templates SET name=?, description=?, content=?, updated_at=CURRENT_TIMESTAMP WHERE id=?
-    ''', (
-        data.get('name', ''),
-        data.get('description', ''),
-        data.get('content', ''),
-        template_id
-    ))
-    conn.commit()
-    conn.close()
-    return jsonify({'id': template_id, 'name': data.get('name', ''), 'description': data.get('description', ''), 'content': data.get('content', '')})
+class AsyncTransport:
+    """asyncio 引擎中单个API端点的连接池（绑定创建它的事件循环）
 
-@app.route('/api/templates/<template_id>', methods=['DELETE'])
-def delete_template(template_id):
-    """删除提示词模板"""
-    conn = sqlite3.connect('projects.db')
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM prompt_templates WHERE id=?', (template_id,))
-    conn.commit()
-    conn.close()
-    return jsonify({'success': True})
-# ========== End 全局提示词模板API ==========
+    httpcore 为请求分配连接时会遍历池内全部连接与排队请求，单个数百连接的连接池在高并发下会占满CPU，
+    因此拆分为多个各含 ASYNC_CLIENT_CONNECTIONS 个连接的 AsyncClient，每个请求交给在途请求最少的一个。
+    并发由限流控制器与引擎的协程数控制，连接池排队不设超时（排队超时不是端点故障，不应计入熔断）。
+    """
 
-def sse_format(data):
-    """格式化为SSE消息"""
-    import json
-    return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+    def __init__(self, verify=True, pool_maxsize=DEFAULT_POOL_MAXSIZE, http2=False, keepalive_expiry=60):
+        count = max(1, -(-pool_maxsize // ASYNC_CLIENT_CONNECTIONS))
+        per_client = -(-pool_maxsize // count)
+        limits = httpx.Limits(max_connections=per_client, max_keepalive_connections=per_client,
+                              keepalive_expiry=keepalive_expiry)
+        # 各 AsyncClient 共用一个SSL上下文（每次加载CA证书约需数十毫秒）
+        ssl_context = httpx.create_ssl_context(verify=verify)
+        self.clients = [httpx.AsyncClient(http2=http2, verify=ssl_context, limits=limits) for _ in range(count)]
+        self.inflight = [0] * count
 
-@app.route('/api/process-stream/<project_id>', methods=['POST'])
-def process_stream(project_id):
-    """SSE流式推送批量处理进度和日志"""
-    # 先把所有 request 相关数据取出来
-    prompt_template = request.form.get('prompt_template', '')
-    result_field_name = request.form.get('result_field_name', 'response')
-    max_workers = int(request.form.get('max_workers', 10))
-    file = request.files.get('file')
-    if not file:
-        def error_gen():
-            yield sse_format({'type': 'error', 'error': '未上传文件'})
-        return Response(error_gen(), mimetype='text/event-stream')
-    file_content = file.read().decode('utf-8')
-    def generate():
-        lines = file_content.split('\n')
-        data = []
-        for i, line in enumerate(lines):
-            if not line.strip():
-                continue
-            try:
-                data.append(json.loads(line))
-            except Exception as e:
-                yield sse_format({'type': 'error', 'line': i+1, 'error': f'第{i+1}行JSON解析失败: {str(e)}'})
-        if not data:
-            yield sse_format({'type': 'error', 'error': '文件中没有有效的JSON数据'})
-            return
-        # 获取项目API配置
-        conn = sqlite3.connect('projects.db')
-        cursor = conn.cursor()
-        cursor.execute('SELECT api_config FROM projects WHERE id = ?', (project_id,))
-        row = cursor.fetchone()
-        conn.close()
-        if not row:
-            yield sse_format({'type': 'error', 'error': '项目不存在'})
-            return
-        api_config = json.loads(row[0]) if row[0] else {}
-        total = len(data)
-        success_count = 0
-        error_count = 0
-        processed_count = 0
-        processed_data = []
-        def worker(idx, item, q):
+    @contextmanager
+    def _client(self):
+        n = min(range(len(self.clients)), key=self.inflight.__getitem__)
+        self.inflight[n] += 1
+        try:
+            yield self.clients[n]
+        finally:
+            self.inflight[n] -= 1
+
+    async def post(self, url, headers, payload, timeout):
+        with self._client() as client:
+            return await client.post(url, headers=headers, json=payload, timeout=httpx.Timeout(timeout, pool=None))
+
+    @asynccontextmanager
+    async def stream(self, url, headers, payload, timeout):
+        """发送流式请求，产出 response；timeout 为 (连接超时, 读取超时)"""
+        with self._client() as client:
+            async with client.stream('POST', url, headers=headers, json=payload,
+                                     timeout=httpx.Timeout(timeout[1], connect=timeout[0], pool=None)) as response:
+                yield response
+
+    async def aclose(self):
+        for client in self.clients:
+            await client.aclose()
+
+class AsyncTransports:
+    """一次 asyncio 引擎运行中各端点的连接池，按 verify_ssl / http2 / pool_maxsize / keepalive_expiry 分别创建"""
+
+    def __init__(self, pool_size):
+        self.pool_size = pool_size
+        self.transports = {}
+
+    def get(self, api_config):
+        key, pool_maxsize = transport_key(api_config, self.pool_size)
+        transport = self.transports.get(key)
+        if transport is None:
+            kwargs = {'verify': key[2], 'pool_maxsize': pool_maxsize, 'keepalive_expiry': api_config.get('keepalive_expiry', 60)}
             try:
-                processed_item, error = call_llm_api(item, prompt_template, api_config, result_field_name)
-                if error:
-                    q.put({'type': 'log', 'line': idx+1, 'status': 'error', 'output': '', 'error': error})
-                    return (item, error)
-                else:
-                    q.put({'type': 'log', 'line': idx+1, 'status': 'success', 'output': processed_item.get(result_field_name, ''), 'error': ''})
-                    return (processed_item, None)
-            except Exception as e:
-                q.put({'type': 'log', 'line': idx+1, 'status': 'error', 'output': '', 'error': str(e)})
-                return (item, str(e))
-        q = queue.Queue()
-        from concurrent.futures import ThreadPoolExecutor
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            futures = [executor.submit(worker, idx, item, q) for idx, item in enumerate(data)]
-            for i in range(total):
-                # 每次有日志就推送
-                log = q.get()
-                yield sse_format(log)
-                processed_count += 1
-                if log['status'] == 'success':
-                    success_count += 1
-                else:
-                    error_count += 1
-                # 推送进度
-                yield sse_format({'type': 'progress', 'current': processed_count, 'total': total, 'success': success_count, 'error': error_count})
-            # 收集结果
-            for f in futures:
-                res, err = f.result()
-                if not err:
-                    processed_data.append(res)
-        # 处理完成，推送最终结果
-        yield sse_format({'type': 'done', 'success': success_count, 'error': error_count, 'total': total, 'processed_data': processed_data})
-        return
-    return Response(generate(), mimetype='text/event-stream')
+                transport = AsyncTransport(http2=key[3], **kwargs)
+            except ImportError:
+                log_event(logging.WARNING, 'HTTP/2 需要安装 h2 包，回退到 HTTP/1.1 连接池')
+                transport = AsyncTransport(**kwargs)
+            self.transports[key] = transport
+        return transport
+
+    async def aclose(self):
+        for transport in self.transports.values():
+            await transport.aclose()
+# ================== End HTTP 传输层 ==================
+
+# ================== 自适应限流 ==================
+# 每个API端点（地址 + 凭证）一个控制器，由所有任务共享：
+# - 令牌桶限制 RPM/TPM（api_config: rpm_limit / tpm_limit，兼容页面上的 rate_limit 次/秒）
+# - AIMD 调整并发上限：成功时加性增长，429/503 或滚动延迟超过 latency_target 时乘性减小；
+#   429/503 只把上限降到天花板的 throttle_floor（默认10%）为止，与负载无关的零星限流不会把并发压到1
+# - 遵守 Retry-After：被限流的请求自己等待 Retry-After 后重发，不阻塞该端点上的其他请求
+# - 并发上限的天花板为 api_config['max_concurrency']；未配置时为当前各引擎运行（任务、死信重跑、变体）登记的并发数之和，
+#   每个运行自身的并发由引擎的工作线程/协程数限制，运行结束即撤销登记，不会压低其他任务的上限
+THROTTLE_STATUS = (429, 503)
+MAX_THROTTLE_RETRIES = 5
+DEFAULT_THROTTLE_FLOOR = 0.1
+
+def estimate_tokens(text):
+    """粗略估算文本token数（中英文混合按约2字符/token）"""
+    return len(text) // 2 + 1
+
+def parse_retry_after(value):
+    """解析 Retry-After 头（秒数或HTTP日期），返回等待秒数"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except Exception:
+        return None
+
+class TokenBucket:
+    """令牌桶：按每分钟配额匀速补充，允许透支（用实际用量校正预估）"""
+
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60.0
+        self.capacity = max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def wait_time(self, amount, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        need = min(amount, self.capacity)
+        return 0 if self.tokens >= need else (need - self.tokens) / self.rate
+
+    def consume(self, amount):
+        self.tokens -= amount
+
+def _wake_waiter(loop, waiter):
+    """唤醒 asyncio 引擎中等待名额的协程（可在任意线程调用）"""
+    def wake():
+        if not waiter.done():
+            waiter.set_result(None)
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is loop:
+        wake()
+        return
+    try:
+        loop.call_soon_threadsafe(wake)
+    except RuntimeError:
+        # 事件循环已关闭（所属任务已结束）
+        pass
+
+class EndpointController:
+    """单个API端点的并发与速率控制器（线程安全；线程等待条件变量，asyncio 协程等待 release 唤醒）"""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.inflight = 0
+        self.limit = float(DEFAULT_POOL_MAXSIZE)
+        self.min_concurrency = 1
+        self.max_concurrency = DEFAULT_POOL_MAXSIZE
+        self.configured_max = None
+        # 引擎运行登记的并发数：登记对象 -> 并发数
+        self.leases = {}
+        self.adaptive = True
+        self.latency_target = None
+        self.latencies = deque(maxlen=50)
+        self.throttle_floor = DEFAULT_THROTTLE_FLOOR
+        # 最近一次 429/503 的 Retry-After 到期时间，只用于多端点选择时优先避开
+        self.throttled_until = 0.0
+        self.last_decrease = 0.0
+        self.rpm_bucket = None
+        self.tpm_bucket = None
+        # 等待并发名额的协程：(事件循环, Future)
+        self.async_waiters = deque()
+
+    def configure(self, api_config):
+        """按项目配置更新限速、自适应参数与并发上限的天花板"""
+        with self.cond:
+            rpm = api_config.get('rpm_limit') or (api_config['rate_limit'] * 60 if api_config.get('rate_limit') else None)
+            tpm = api_config.get('tpm_limit')
+            if rpm and (self.rpm_bucket is None or self.rpm_bucket.rate != rpm / 60.0):
+                self.rpm_bucket = TokenBucket(rpm)
+            elif not rpm:
+                self.rpm_bucket = None
+            if tpm and (self.tpm_bucket is None or self.tpm_bucket.rate != tpm / 60.0):
+                self.tpm_bucket = TokenBucket(tpm)
+            elif not tpm:
+                self.tpm_bucket = None
+            self.adaptive = api_config.get('adaptive_concurrency', True)
+            self.latency_target = api_config.get('latency_target')
+            self.min_concurrency = int(api_config.get('min_concurrency', 1))
+            self.throttle_floor = float(api_config.get('throttle_floor', DEFAULT_THROTTLE_FLOOR))
+            self.configured_max = int(api_config['max_concurrency']) if api_config.get('max_concurrency') else None
+            self._update_ceiling(False)
+
+    @contextmanager
+    def lease(self, max_workers):
+        """登记一次引擎运行的并发数，退出时撤销"""
+        token = object()
+        with self.cond:
+            self.leases[token] = int(max_workers)
+            self._update_ceiling(True)
+        try:
+            yield self
+        finally:
+            with self.cond:
+                del self.leases[token]
+                self._update_ceiling(False)
+
+    def _update_ceiling(self, started):
+        self.max_concurrency = self.configured_max or sum(self.leases.values()) or DEFAULT_POOL_MAXSIZE
+        if started and (not self.adaptive or time.monotonic() - self.last_decrease > 60):
+            # 近期未被限流时新的运行直接从天花板起步；近期被限流过则保留学到的上限
+            self.limit = float(self.max_concurrency)
+        self.limit = min(max(self.limit, self.min_concurrency), self.max_concurrency)
+        self.cond.notify_all()
+        self._wake_async()
+
+    def _try_acquire(self, tokens):
+        """（持有锁时调用）尝试占用一个请求名额：成功返回0，并发名额已满返回 None，被限速时返回需等待的秒数"""
+        now = time.monotonic()
+        if self.inflight >= int(self.limit):
+            return None
+        for bucket, amount in ((self.rpm_bucket, 1), (self.tpm_bucket, tokens)):
+            if bucket:
+                wait = bucket.wait_time(amount, now)
+                if wait > 0:
+                    return wait
+        if self.rpm_bucket:
+            self.rpm_bucket.consume(1)
+        if self.tpm_bucket:
+            self.tpm_bucket.consume(tokens)
+        self.inflight += 1
+        return 0
+
+    def try_acquire(self, tokens):
+        """尝试占用一个请求名额，成功返回0，否则返回建议等待秒数"""
+        with self.cond:
+            wait = self._try_acquire(tokens)
+        return 0.05 if wait is None else wait
+
+    def acquire(self, tokens):
+        while True:
+            wait = self.try_acquire(tokens)
+            if not wait:
+                return
+            with self.cond:
+                self.cond.wait(timeout=min(wait, 1.0))
+
+    async def acquire_async(self, tokens):
+        """acquire 的 asyncio 版本：并发名额已满时挂起到有名额归还（不轮询），被限速时按需等待"""
+        loop = asyncio.get_running_loop()
+        while True:
+            waiter = None
+            with self.cond:
+                wait = self._try_acquire(tokens)
+                if wait is None:
+                    waiter = loop.create_future()
+                    self.async_waiters.append((loop, waiter))
+            if wait == 0:
+                return
+            if waiter is None:
+                await asyncio.sleep(min(wait, 1.0))
+                continue
+            # 兜底超时：被唤醒的协程在取得名额前被取消时，名额不会再唤醒其他协程
+            timer = loop.call_later(1.0, _wake_waiter, loop, waiter)
+            try:
+                await waiter
+            finally:
+                timer.cancel()
+
+    def _wake_async(self):
+        """（持有锁时调用）按空出的并发名额数依次唤醒等待中的协程，不全部唤醒争抢"""
+        free = int(self.limit) - self.inflight
+        while free > 0 and self.async_waiters:
+            loop, waiter = self.async_waiters.popleft()
+            if waiter.done():
+                continue
+            _wake_waiter(loop, waiter)
+            free -= 1
+
+    def release(self, status, latency, retry_after=None, estimated_tokens=0, used_tokens=None):
+        """归还名额并根据响应信号调整并发上限"""
+        with self.cond:
+            now = time.monotonic()
+            self.inflight -= 1
+            if self.tpm_bucket and used_tokens is not None:
+                # 用响应 usage 校正预估的token消耗
+                self.tpm_bucket.consume(used_tokens - estimated_tokens)
+            if status in THROTTLE_STATUS:
+                self.throttled_until = max(self.throttled_until, now + (retry_after if retry_after is not None else 1.0))
+                self._decrease(now, 0.5, max(1, int(self.max_concurrency * self.throttle_floor)))
+            elif status is not None and status < 400:
+                self.latencies.append(latency)
+                if self.latency_target and len(self.latencies) >= 10 and sorted(self.latencies)[len(self.latencies) // 2] > self.latency_target:
+                    self._decrease(now, 0.9)
+                elif self.adaptive:
+                    # 每个完整窗口约增加1个并发
+                    self.limit = min(self.max_concurrency, self.limit + 1.0 / max(self.limit, 1.0))
+            self.cond.notify_all()
+            self._wake_async()
+
+    def _decrease(self, now, factor, floor=1):
+        # 同一批在途请求的多个 429 只触发一次减半
+        if not self.adaptive or now - self.last_decrease < 1.0:
+            return
+        self.limit = max(self.min_concurrency, floor, min(self.limit, self.limit * factor))
+        self.last_decrease = now
+
+_controllers = {}
+_controllers_lock = threading.Lock()
+
+def get_controller(api_config):
+    """获取API端点（地址 + 凭证）对应的限流控制器，首次创建时按 api_config 配置"""
+    api_url = api_config.get('api_url') or api_config.get('apiUrl') or ''
+    key = (api_url, api_config.get('apiKey') or api_config.get('auth_token') or api_config.get('authorization'))
+    with _controllers_lock:
+        controller = _controllers.get(key)
+        created = controller is None
+        if created:
+            controller = _controllers[key] = EndpointController()
+    if created:
+        controller.configure(api_config)
+    return controller
+# ================== End 自适应限流 ==================
+
+# ================== 多端点负载均衡 ==================
+# api_config['endpoints'] 可配置多个端点/密钥，每项覆盖项目配置中的同名字段（api_url、apiKey、modelName、
+# rpm_limit、max_concurrency 等），weight 为权重（默认1）。同一池中的端点应当可以互相替代（同一模型）。
+# 未配置 endpoints 时整个 api_config 即唯一端点。
+# - load_balancing: 'least_outstanding'（默认，在途请求数/权重最小者）或 'weighted_round_robin'（平滑加权轮询）
+# - 熔断：连续 circuit_failure_threshold 次（默认5）网络错误或 5xx 后摘除端点，冷却 circuit_cooldown 秒（默认10，
+#   连续熔断时翻倍，最长300）后放行一个探测请求，成功则恢复，失败则继续熔断；
+#   所有端点都处于熔断中时请求直接失败（CircuitOpenError），不再发往故障端点（由死信重跑在任务末尾再试）
+# - 正被 429 限流（Retry-After 未到期）的端点在有其他可用端点时不参与选择
+CIRCUIT_MAX_COOLDOWN = 300
+
+class CircuitOpenError(Exception):
+    """所有端点都处于熔断中"""
+
+class EndpointHealth:
+    """单个端点（地址 + 凭证）的在途请求数与熔断状态，同一端点在所有任务间共享"""
+
+    def __init__(self):
+        self.outstanding = 0
+        self.failures = 0
+        self.trips = 0
+        self.state = 'closed'
+        self.open_until = 0.0
+        self.probing = False
+
+class Endpoint:
+    def __init__(self, config, weight, health):
+        self.config = config
+        self.weight = weight
+        self.health = health
+        self.url = config.get('api_url') or config.get('apiUrl') or ''
+        self.current_weight = 0.0
+
+_endpoint_health = {}
+_endpoint_pools = {}
+_endpoint_lock = threading.Lock()
+
+def endpoint_identity(config):
+    """端点标识（地址 + 凭证），与限流控制器的粒度一致"""
+    return (
+        config.get('api_url') or config.get('apiUrl') or '',
+        config.get('apiKey') or config.get('auth_token') or config.get('authorization')
+    )
+
+class EndpointPool:
+    """一个项目配置下的端点池（由 get_endpoint_pool 在 _endpoint_lock 内创建）"""
+
+    def __init__(self, api_config):
+        base = {k: v for k, v in api_config.items() if k != 'endpoints'}
+        entries = api_config.get('endpoints') or [{}]
+        self.strategy = api_config.get('load_balancing', 'least_outstanding')
+        self.failure_threshold = int(api_config.get('circuit_failure_threshold', 5))
+        self.cooldown = float(api_config.get('circuit_cooldown', 10))
+        self.endpoints = []
+        for entry in entries:
+            config = dict(base, **{k: v for k, v in entry.items() if k != 'weight'})
+            key = endpoint_identity(config)
+            health = _endpoint_health.get(key)
+            if health is None:
+                health = _endpoint_health[key] = EndpointHealth()
+            self.endpoints.append(Endpoint(config, max(float(entry.get('weight', 1)), 0.001), health))
+        # 请求构建、缓存键与去重键以第一个端点为准
+        self.primary = self.endpoints[0]
+
+    def _available(self, endpoint, now):
+        health = endpoint.health
+        if health.state == 'closed':
+            return True
+        if health.state == 'open' and now >= health.open_until and not health.probing:
+            return True
+        return False
+
+    def choose(self, exclude=None):
+        """选择一个端点并计入在途请求，用完后必须调用 release"""
+        with _endpoint_lock:
+            now = time.monotonic()
+            candidates = [e for e in self.endpoints if e is not exclude and self._available(e, now)]
+            if not candidates and exclude is not None and self._available(exclude, now):
+                candidates = [exclude]
+            unthrottled = [e for e in candidates if get_controller(e.config).throttled_until <= now]
+            candidates = unthrottled or candidates
+            if not candidates:
+                # 全部熔断（冷却中或探测请求尚未返回）：直接失败
+                raise CircuitOpenError('所有端点均已熔断，冷却后自动恢复')
+            if len(candidates) == 1:
+                endpoint = candidates[0]
+            elif self.strategy == 'weighted_round_robin':
+                total = 0.0
+                for e in candidates:
+                    e.current_weight += e.weight
+                    total += e.weight
+                endpoint = max(candidates, key=lambda e: e.current_weight)
+                endpoint.current_weight -= total
+            else:
+                endpoint = min(candidates, key=lambda e: (e.health.outstanding + 1) / e.weight)
+            health = endpoint.health
+            if health.state == 'open' and now >= health.open_until:
+                # 冷却结束，放行一个探测请求
+                health.state = 'half_open'
+                health.probing = True
+            health.outstanding += 1
+            return endpoint
+
+    def release(self, endpoint, healthy):
+        """归还在途请求并更新熔断状态；healthy 为 None 表示结果与端点健康无关（如被取消）"""
+        with _endpoint_lock:
+            health = endpoint.health
+            health.outstanding -= 1
+            if healthy is None:
+                if health.state == 'half_open':
+                    health.state, health.probing = 'open', False
+                return
+            if healthy:
+                health.failures = 0
+                if health.state != 'closed':
+                    log_event(logging.INFO, '端点恢复', endpoint=endpoint.url)
+                health.state, health.trips, health.probing = 'closed', 0, False
+                return
+            health.failures += 1
+            if health.state == 'half_open' or (health.state == 'closed' and health.failures >= self.failure_threshold):
+                health.trips += 1
+                cooldown = min(CIRCUIT_MAX_COOLDOWN, self.cooldown * 2 ** (health.trips - 1))
+                health.state, health.probing = 'open', False
+                health.open_until = time.monotonic() + cooldown
+                log_event(logging.WARNING, '端点熔断', endpoint=endpoint.url, failures=health.failures, cooldown=cooldown)
+
+    def concurrency(self):
+        """池内各端点当前并发上限之和"""
+        return sum(int(get_controller(e.config).limit) for e in self.endpoints)
+
+def get_endpoint_pool(api_config):
+    """获取项目配置对应的端点池（配置变化时重建，熔断状态按端点共享）"""
+    key = json.dumps(api_config, sort_keys=True, default=str)
+    # 查找、淘汰与创建在同一把锁内完成，并发任务不会各自创建端点池（EndpointPool 同时登记共享的端点健康状态）
+    with _endpoint_lock:
+        pool = _endpoint_pools.get(key)
+        if pool is None:
+            if len(_endpoint_pools) > 256:
+                _endpoint_pools.clear()
+            pool = _endpoint_pools[key] = EndpointPool(api_config)
+        return pool
+
+def has_api_endpoint(api_config):
+    """项目是否配置了至少一个API地址"""
+    return bool(api_config.get('api_url') or api_config.get('apiUrl')
+                or any(e.get('api_url') or e.get('apiUrl') for e in api_config.get('endpoints') or []))
+
+@contextmanager
+def prepare_endpoints(api_config, max_workers, sync_transport=True):
+    """引擎运行期间：按运行的并发数准备每个端点的连接池（sync_transport），按项目配置更新限流控制器并登记运行的并发数"""
+    with ExitStack() as stack:
+        for endpoint in get_endpoint_pool(api_config).endpoints:
+            if sync_transport:
+                get_transport(endpoint.config, max_workers)
+            controller = get_controller(endpoint.config)
+            controller.configure(endpoint.config)
+            stack.enter_context(controller.lease(max_workers))
+        yield
+# ================== End 多端点负载均衡 ==================
+
+# ================== 重试策略 ==================
+# api_config 字段：retry_max_attempts（含首次请求）、retry_backoff_base / retry_backoff_max（秒）、
+# retry_statuses（可重试的HTTP状态码）。网络错误与超时同样视为可重试。
+# 429/503 按 Retry-After（未提供时按指数退避）等待后重发，单独计入 MAX_THROTTLE_RETRIES，不消耗重试次数。
+DEFAULT_RETRY_STATUSES = [408, 429, 500, 502, 503, 504]
+
+class RetryPolicy:
+    """单行请求的重试策略（指数退避 + 全抖动）"""
+
+    def __init__(self, api_config):
+        self.max_attempts = max(1, int(api_config.get('retry_max_attempts', 3)))
+        self.backoff_base = float(api_config.get('retry_backoff_base', 1.0))
+        self.backoff_max = float(api_config.get('retry_backoff_max', 30.0))
+        self.statuses = set(api_config.get('retry_statuses', DEFAULT_RETRY_STATUSES))
+
+    def backoff(self, failures):
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (failures - 1)))
+
+def is_transient_error(exc):
+    """连接错误、超时等可重试的网络异常"""
+    if isinstance(exc, (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                        requests.exceptions.ChunkedEncodingError, StreamError)):
+        return True
+    return httpx is not None and isinstance(exc, httpx.TransportError)
+
+class RequestAttempts:
+    """一次API调用的请求循环状态：选择端点、归还限流名额，并决定是否重试及等待时长
+
+    每次请求前调用 choose() 选择端点（上一次失败的端点在有其他可用端点时不再选择），
+    on_response / on_exception 返回 None 表示结束（成功或不可重试），否则返回重试前需等待的秒数。
+    """
+
+    def __init__(self, api_config, estimated_tokens):
+        self.policy = RetryPolicy(api_config)
+        self.pool = get_endpoint_pool(api_config)
+        self.endpoint = None
+        self.controller = None
+        self.failed_endpoint = None
+        self.estimated_tokens = estimated_tokens
+        self.attempts = 0
+        self.failures = 0
+        self.throttles = 0
+        # 当前占用的资源：'endpoint'（已选择端点）、'request'（已取得限流名额）或 None
+        self.holding = None
+
+    def choose(self):
+        self.endpoint = self.pool.choose(exclude=self.failed_endpoint)
+        self.controller = get_controller(self.endpoint.config)
+        self.holding = 'endpoint'
+        return self.endpoint
+
+    def start(self):
+        self.attempts += 1
+        self.started = time.monotonic()
+        self.holding = 'request'
+
+    def on_response(self, response, response_data):
+        self.holding = None
+        status = response.status_code
+        retry_after = parse_retry_after(response.headers.get('Retry-After'))
+        self.controller.release(
+            status,
+            time.monotonic() - self.started,
+            retry_after=retry_after,
+            estimated_tokens=self.estimated_tokens,
+            used_tokens=(response_data.get('usage') or {}).get('total_tokens')
+        )
+        # 429/503 说明端点存活，由限流控制器处理，不计入熔断
+        healthy = status < 500 or status in THROTTLE_STATUS
+        self.pool.release(self.endpoint, healthy)
+        self.failed_endpoint = None if healthy else self.endpoint
+        if status < 400:
+            return None
+        if status in THROTTLE_STATUS and self.throttles < MAX_THROTTLE_RETRIES:
+            # 只有本请求等待 Retry-After，端点上的其他请求照常派发
+            self.throttles += 1
+            return retry_after if retry_after is not None else self.policy.backoff(self.throttles)
+        return self._retry_delay(status in self.policy.statuses)
+
+    def on_exception(self, exc):
+        self.holding = None
+        self.controller.release(None, time.monotonic() - self.started, estimated_tokens=self.estimated_tokens)
+        transient = is_transient_error(exc)
+        # 本地连接池排队超时与端点健康无关，不计入熔断
+        local = httpx is not None and isinstance(exc, httpx.PoolTimeout)
+        self.pool.release(self.endpoint, False if transient and not local else None)
+        self.failed_endpoint = self.endpoint if transient else None
+        delay = self._retry_delay(transient)
+        if delay is None:
+            raise exc
+        return delay
+
+    def on_cancel(self):
+        """请求被中止（任务取消）时归还占用的名额，不影响限流与熔断状态"""
+        if self.holding == 'request':
+            self.controller.release(None, time.monotonic() - self.started, estimated_tokens=self.estimated_tokens)
+        if self.holding:
+            self.pool.release(self.endpoint, None)
+        self.holding = None
+
+    def _retry_delay(self, retryable):
+        self.failures += 1
+        if not retryable or self.failures >= self.policy.max_attempts:
+            return None
+        return self.policy.backoff(self.failures)
+# ================== End 重试策略 ==================
+
+# ================== 响应缓存 ==================
+# 以 (渲染后的提示词, 模型, 温度, max_tokens, API地址) 的哈希为键缓存成功的API响应，
+# 同一文件 + 模板 + 模型重跑时直接命中，不再请求API。
+# api_config['response_cache']：true（读写缓存）、false（不使用）、'refresh'（跳过读取，只写入新结果）；
+# 未配置时仅在 temperature 为 0 时启用（温度大于0时同一提示词的输出本应不同，命中缓存会改变结果）。
+# 新结果先写入内存缓冲，每 CACHE_WRITE_BATCH 条（以及任务结束时）合并为一次事务提交；
+# 命中时只在内存中记录访问时间，随下一次提交批量写回，供按访问时间淘汰使用。
+CACHE_DB = os.environ.get('PROMPTFACTORY_CACHE_DB', 'llm_cache.db')
+CACHE_TTL = float(os.environ.get('PROMPTFACTORY_CACHE_TTL', 7 * 24 * 3600))
+CACHE_MAX_BYTES = int(os.environ.get('PROMPTFACTORY_CACHE_MAX_BYTES', 1024 ** 3))
+CACHE_EVICT_EVERY = 500
+CACHE_WRITE_BATCH = 100
+
+class ResponseCache:
+    """基于SQLite的LLM响应缓存（线程安全，每个线程使用独立连接），按TTL与总大小淘汰"""
+
+    def __init__(self, path, ttl, max_bytes):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.accessed = {}
+        self.puts = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _conn(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    response TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_responses_accessed_at ON responses (accessed_at)')
+            self.local.conn = conn
+        return conn
+
+    @staticmethod
+    def make_key(api_url, payload):
+        material = json.dumps({
+            'api_url': api_url,
+            'model': payload.get('model'),
+            'messages': payload.get('messages'),
+            'temperature': payload.get('temperature'),
+            'max_tokens': payload.get('max_tokens')
+        }, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """返回缓存的响应数据，未命中或已过期时返回 None"""
+        now = time.time()
+        with self.lock:
+            pending = self.pending.get(key)
+            if pending is not None:
+                self.hits += 1
+                return json.loads(pending[0])
+        row = self._conn().execute(
+            'SELECT response FROM responses WHERE key = ? AND created_at > ?',
+            (key, now - self.ttl)
+        ).fetchone()
+        with self.lock:
+            if not row:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.accessed[key] = now
+        return json.loads(row[0])
+
+    def put(self, key, response_data):
+        text = json.dumps(response_data, ensure_ascii=False)
+        with self.lock:
+            self.pending[key] = (text, time.time())
+            self.accessed.pop(key, None)
+            self.puts += 1
+            evict = self.puts % CACHE_EVICT_EVERY == 0
+            flush = len(self.pending) >= CACHE_WRITE_BATCH
+        if evict:
+            self.evict()
+        elif flush:
+            self.flush()
+
+    def flush(self):
+        """把缓冲中的新结果与访问时间合并为一次事务写入数据库"""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            accessed, self.accessed = self.accessed, {}
+        if not pending and not accessed:
+            return
+        conn = self._conn()
+        conn.executemany(
+            'INSERT OR REPLACE INTO responses (key, response, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)',
+            [(key, text, len(text), now, now) for key, (text, now) in pending.items()]
+        )
+        conn.executemany('UPDATE responses SET accessed_at = ? WHERE key = ?', [(now, key) for key, now in accessed.items()])
+        conn.commit()
+
+    def evict(self):
+        """写回缓冲后删除过期条目；总大小超过上限时按最近访问时间淘汰到上限的90%"""
+        self.flush()
+        conn = self._conn()
+        conn.execute('DELETE FROM responses WHERE created_at <= ?', (time.time() - self.ttl,))
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total > self.max_bytes:
+            excess = total - int(self.max_bytes * 0.9)
+            removed = 0
+            keys = []
+            for key, size in conn.execute('SELECT key, size FROM responses ORDER BY accessed_at'):
+                keys.append((key,))
+                removed += size
+                if removed >= excess:
+                    break
+            conn.executemany('DELETE FROM responses WHERE key = ?', keys)
+        conn.commit()
+
+    def stats(self):
+        self.flush()
+        conn = self._conn()
+        entries, size = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses').fetchone()
+        return {'entries': entries, 'bytes': size, 'hits': self.hits, 'misses': self.misses}
+
+    def clear(self):
+        with self.lock:
+            self.pending.clear()
+            self.accessed.clear()
+        conn = self._conn()
+        conn.execute('DELETE FROM responses')
+        conn.commit()
+
+response_cache = ResponseCache(CACHE_DB, CACHE_TTL, CACHE_MAX_BYTES)
+atexit.register(response_cache.flush)
+
+def response_cache_mode(api_config):
+    """返回项目的缓存模式；未配置时仅在 temperature 为 0 时启用"""
+    mode = api_config.get('response_cache')
+    if mode is None:
+        return float(api_config.get('temperature', 0.3)) == 0
+    return mode
+
+def lookup_cached_response(api_url, payload, api_config, meta):
+    """按配置查询响应缓存，返回 (缓存键, 缓存的响应数据)；不使用缓存时缓存键为 None"""
+    mode = response_cache_mode(api_config)
+    if not mode:
+        return None, None
+    key = ResponseCache.make_key(api_url, payload)
+    if mode != 'refresh':
+        cached = response_cache.get(key)
+        if cached is not None:
+            meta['cache'] = 'hit'
+            meta['attempts'] = 0
+            return key, cached
+    meta['cache'] = 'miss'
+    return key, None
+
+@app.route('/api/cache', methods=['GET'])
+def get_cache_stats():
+    """获取响应缓存统计"""
+    return jsonify(response_cache.stats())
+
+@app.route('/api/cache', methods=['DELETE'])
+def clear_cache():
+    """清空响应缓存"""
+    response_cache.clear()
+    return jsonify({'message': '缓存已清空'})
+# ================== End 响应缓存 ==================
+
+# ================== 提示词模板 ==================
+# 模板在每个任务开始时只解析一次，拆分为文本片段与变量槽位，逐行渲染时仅做字符串拼接。
+# 变量名只能包含字母、数字、下划线，且 {{ 与 }} 之间不能有空格；数据中不存在的变量保持原样。
+TEMPLATE_VARIABLE_PATTERN = re.compile(r'\{\{([a-zA-Z_][a-zA-Z0-9_]*)\}\}')
+
+class CompiledTemplate:
+    """预编译的提示词模板"""
+
+    def __init__(self, source):
+        self.source = source
+        self._parts = []
+        self._slots = []
+        pos = 0
+        for match in TEMPLATE_VARIABLE_PATTERN.finditer(source):
+            if match.start() > pos:
+                self._parts.append(source[pos:match.start()])
+            self._slots.append((len(self._parts), match.group(1), match.group(0)))
+            self._parts.append(match.group(0))
+            pos = match.end()
+        if pos < len(source):
+            self._parts.append(source[pos:])
+        self.variables = list(dict.fromkeys(name for _, name, _ in self._slots))
+
+    def render(self, data):
+        if not self._slots:
+            return self.source
+        parts = self._parts.copy()
+        for i, name, placeholder in self._slots:
+            if name in data:
+                parts[i] = str(data[name])
+        return ''.join(parts)
+
+    def missing_variables(self, sample):
+        """返回样例数据中不存在的变量"""
+        return [name for name in self.variables if name not in sample]
+
+@lru_cache(maxsize=64)
+def _compile_template_source(source):
+    return CompiledTemplate(source)
+
+def compile_template(template):
+    """编译提示词模板，已编译的模板原样返回（相同模板复用编译结果）"""
+    if isinstance(template, CompiledTemplate):
+        return template
+    return _compile_template_source(template)
+
+def template_warning(template, sample):
+    """用样例行校验模板变量，存在缺失变量时返回提示信息"""
+    missing = compile_template(template).missing_variables(sample or {})
+    if missing:
+        return f"以下模板变量在首行数据中不存在，将保持原样: {', '.join(missing)}"
+    return None
+
+def first_jsonl_row(fp):
+    """读取JSONL文件的首个有效行（读取后回到文件开头）"""
+    try:
+        return next(iter_jsonl(fp, lambda line_no, e: None), (0, None))[1]
+    finally:
+        fp.seek(0)
+# ================== End 提示词模板 ==================
+
+def auth_headers(api_config):
+    """认证请求头 - 支持多种认证方式"""
+    if api_config.get('apiKey'):
+        return {"Authorization": f"Bearer {api_config['apiKey']}"}
+    if api_config.get('auth_token'):
+        return {"X-Auth-Token": api_config['auth_token']}
+    if api_config.get('authorization'):
+        return {"Authorization": api_config['authorization']}
+    return {}
+
+def build_llm_request(data_item, prompt_template, api_config):
+    """构建大模型API请求，返回 (api_url, headers, payload)
+
+    prompt_template 可以是模板字符串或 CompiledTemplate。
+    """
+    # 构建用户提示词
+    try:
+        user_prompt = compile_template(prompt_template).render(data_item)
+    except Exception as e:
+        raise ValueError(f"模板渲染失败: {str(e)}")
+    
+    # 构建请求头
+    headers = {
+        "Content-Type": "application/json"
+    }
+    
+    # 处理API URL - 支持前端和后端的字段名
+    api_url = api_config.get('api_url') or api_config.get('apiUrl')
+    if not api_url:
+        raise ValueError("API URL未配置")
+    
+    headers.update(auth_headers(api_config))
+    
+    # 构建请求体 - 修复消息格式
+    payload = {
+        "model": api_config.get('modelName', 'gpt-4'),
+        "messages": [
+            {
+                "role": "user",
+                "content": user_prompt
+            }
+        ],
+        "temperature": api_config.get('temperature', 0.3),
+        "max_tokens": api_config.get('max_tokens') or api_config.get('maxTokens', 16384),
+        "stream": bool(api_config.get('stream', False))
+    }
+    if payload["stream"] and api_config.get('stream_include_usage', True):
+        # 流式响应默认不含 usage，需显式请求（用于限流控制器校正 token 用量）
+        payload["stream_options"] = {"include_usage": True}
+    return api_url, headers, payload
+
+def parse_llm_response(response_data):
+    """从API响应中提取模型输出"""
+    if 'choices' in response_data and len(response_data['choices']) > 0:
+        return response_data['choices'][0]['message']['content']
+    return response_data.get('content', str(response_data))
+
+# ================== 流式响应 ==================
+# api_config['stream'] 为 true 时以 stream:true 请求上游，逐块解析SSE（chat.completion.chunk）并拼接为
+# 与非流式响应相同结构的结果（缓存、解析逻辑不变）：
+# - first_token_timeout（秒，默认同 timeout）：发出请求到收到首个内容块的时限，同时作为相邻数据块的最长间隔
+# - total_timeout（秒，默认600）：整个生成过程的时限；长输出只要持续产出就不会因 timeout 被中断
+# 超时或流意外结束视为可重试的网络错误。调用方可传入 on_delta 实时获得增量文本。
+STREAM_TOTAL_TIMEOUT = 600
+
+class StreamError(Exception):
+    """流式响应超时或意外中断（可重试）"""
+
+def stream_timeouts(api_config):
+    """返回 (连接超时, 首个token超时, 总时长上限)"""
+    timeout = float(api_config.get('timeout', 30))
+    return (
+        timeout,
+        float(api_config.get('first_token_timeout') or timeout),
+        float(api_config.get('total_timeout') or STREAM_TOTAL_TIMEOUT)
+    )
+
+class StreamAccumulator:
+    """逐行解析上游SSE流并拼接模型输出"""
+
+    def __init__(self, first_token_timeout, total_timeout, on_delta=None):
+        self.started = time.monotonic()
+        self.first_token_timeout = first_token_timeout
+        self.total_timeout = total_timeout
+        self.on_delta = on_delta
+        self.parts = []
+        self.chars = 0
+        self.first_token_at = None
+        self.finish_reason = None
+        self.usage = None
+        self.info = {}
+        self.done = False
+
+    def feed(self, line):
+        if self.done:
+            return
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        # 空行、注释（保活）与 event/id 行忽略
+        if line.startswith('data:'):
+            data = line[5:].strip()
+            if data == '[DONE]':
+                self.done = True
+            else:
+                self._feed_chunk(json.loads(data))
+        now = time.monotonic()
+        if self.first_token_at is None and not self.done and now - self.started > self.first_token_timeout:
+            raise StreamError(f'首个token超时（{self.first_token_timeout:g}秒）')
+        if now - self.started > self.total_timeout:
+            raise StreamError(f'流式响应超过总时长（{self.total_timeout:g}秒），已接收{self.chars}字符')
+
+    def _feed_chunk(self, chunk):
+        if chunk.get('error'):
+            error = chunk['error']
+            raise ValueError(f"流式响应错误: {error.get('message', error) if isinstance(error, dict) else error}")
+        for key in ('id', 'model', 'created'):
+            if key in chunk:
+                self.info.setdefault(key, chunk[key])
+        if chunk.get('usage'):
+            self.usage = chunk['usage']
+        for choice in chunk.get('choices') or []:
+            if choice.get('index', 0) != 0:
+                continue
+            text = (choice.get('delta') or {}).get('content')
+            if text:
+                if self.first_token_at is None:
+                    self.first_token_at = time.monotonic()
+                self.parts.append(text)
+                self.chars += len(text)
+                if self.on_delta:
+                    self.on_delta(text)
+            if choice.get('finish_reason'):
+                self.finish_reason = choice['finish_reason']
+
+    def result(self):
+        """拼接后的响应（结构同非流式 chat.completion）"""
+        if not self.done and self.finish_reason is None:
+            raise StreamError(f'流式响应意外结束，已接收{self.chars}字符')
+        response_data = dict(self.info, object='chat.completion', choices=[{
+            'index': 0,
+            'message': {'role': 'assistant', 'content': ''.join(self.parts)},
+            'finish_reason': self.finish_reason
+        }])
+        if self.usage:
+            response_data['usage'] = self.usage
+        return response_data
+
+    def read_timeout_error(self, read_timeout):
+        """读取超时（socket 层面）转为带说明的 StreamError"""
+        if self.first_token_at is None:
+            return StreamError(f'首个token超时（{self.first_token_timeout:g}秒）')
+        return StreamError(f'流式响应中断：超过{read_timeout:g}秒未收到数据，已接收{self.chars}字符')
+
+    def record_timing(self, meta):
+        if self.first_token_at is not None:
+            add_timing(meta, 'first_token', self.first_token_at - self.started)
+
+def is_read_timeout(exc):
+    if isinstance(exc, requests.exceptions.ReadTimeout) or (httpx is not None and isinstance(exc, httpx.ReadTimeout)):
+        return True
+    # requests 在读取响应体时将 urllib3 的 ReadTimeoutError 包装为 ConnectionError
+    return isinstance(exc, requests.exceptions.ConnectionError) and bool(exc.args) \
+        and isinstance(exc.args[0], urllib3.exceptions.ReadTimeoutError)
+
+def stream_llm_request(transport, url, headers, payload, api_config, meta, on_delta=None, control=None):
+    """发送流式请求并逐块解析，返回 (response, 响应数据)；状态码为错误时响应数据为空
+
+    control 为任务控制（JobControl），任务取消时中止读取并关闭连接。
+    """
+    connect_timeout, first_token_timeout, total_timeout = stream_timeouts(api_config)
+    accumulator = StreamAccumulator(first_token_timeout, total_timeout, on_delta)
+    try:
+        with transport.stream(url, headers, payload, (connect_timeout, first_token_timeout)) as (response, lines):
+            if response.status_code >= 400:
+                return response, {}
+            # [DONE] 之后继续读到流结束，连接才能放回连接池复用
+            for line in lines:
+                if control is not None:
+                    control.check()
+                accumulator.feed(line)
+    except Exception as e:
+        if is_read_timeout(e):
+            raise accumulator.read_timeout_error(first_token_timeout) from e
+        raise
+    accumulator.record_timing(meta)
+    return response, accumulator.result()
+
+async def stream_llm_request_async(transport, url, headers, payload, api_config, meta, on_delta=None):
+    """stream_llm_request 的 asyncio 版本（AsyncTransport）"""
+    connect_timeout, first_token_timeout, total_timeout = stream_timeouts(api_config)
+    accumulator = StreamAccumulator(first_token_timeout, total_timeout, on_delta)
+    try:
+        async with transport.stream(url, headers, payload, (connect_timeout, first_token_timeout)) as response:
+            if response.status_code >= 400:
+                return response, {}
+            async for line in response.aiter_lines():
+                accumulator.feed(line)
+    except httpx.ReadTimeout as e:
+        raise accumulator.read_timeout_error(first_token_timeout) from e
+    accumulator.record_timing(meta)
+    return response, accumulator.result()
+# ================== End 流式响应 ==================
+
+def call_llm_api(data_item, prompt_template, api_config, result_field_name, meta=None, on_delta=None, control=None):
+    """调用大模型API
+
+    meta: 可选字典，用于回传调用元信息（attempts：尝试次数；requests：实际发出的HTTP请求数；cache：hit/miss；cancelled：因任务取消而中止）
+    on_delta: 流式模式下的增量文本回调；重试前以 None 调用，表示丢弃此前收到的部分输出
+    control: 任务控制（JobControl）；任务取消后不再发起新的尝试，流式读取与重试等待随即中止
+    """
+    meta = meta if meta is not None else {}
+    try:
+        started = time.perf_counter()
+        pool = get_endpoint_pool(api_config)
+        api_url, headers, payload = build_llm_request(data_item, prompt_template, pool.primary.config)
+        add_timing(meta, 'render', time.perf_counter() - started)
+        started = time.perf_counter()
+        cache_key, cached = lookup_cached_response(api_url, payload, api_config, meta)
+        add_timing(meta, 'cache_lookup', time.perf_counter() - started)
+        if cached is not None:
+            processed_item = data_item.copy()
+            processed_item[result_field_name] = parse_llm_response(cached)
+            return processed_item, None
+        state = RequestAttempts(api_config, estimate_tokens(payload['messages'][0]['content']))
+        
+        while True:
+            if control is not None:
+                control.check()
+            # 选择端点后发送请求（复用端点连接池，经端点的限流控制器调度）
+            endpoint = state.choose()
+            request_url, request_headers, request_payload = (api_url, headers, payload) if endpoint is pool.primary \
+                else build_llm_request(data_item, prompt_template, endpoint.config)
+            started = time.perf_counter()
+            state.controller.acquire(state.estimated_tokens)
+            add_timing(meta, 'throttle_wait', time.perf_counter() - started)
+            if on_delta and state.attempts:
+                on_delta(None)
+            state.start()
+            meta['attempts'] = meta['requests'] = state.attempts
+            meta['endpoint'] = endpoint.url
+            try:
+                started = time.perf_counter()
+                try:
+                    if request_payload['stream']:
+                        response, response_data = stream_llm_request(
+                            get_transport(endpoint.config), request_url, request_headers, request_payload,
+                            endpoint.config, meta, on_delta, control
+                        )
+                    else:
+                        response = get_transport(endpoint.config).post(
+                            request_url,
+                            request_headers,
+                            request_payload,
+                            timeout=endpoint.config.get('timeout', 30)
+                        )
+                finally:
+                    add_timing(meta, 'http', time.perf_counter() - started)
+                if isinstance(response, requests.Response):
+                    add_timing(meta, 'http_ttfb', response.elapsed.total_seconds())
+                if not request_payload['stream']:
+                    started = time.perf_counter()
+                    response_data = response.json() if response.status_code < 400 else {}
+                    add_timing(meta, 'parse', time.perf_counter() - started)
+            except Exception as e:
+                delay = state.on_exception(e)
+            else:
+                delay = state.on_response(response, response_data)
+                if delay is None:
+                    break
+            if control is not None:
+                control.sleep(delay)
+            else:
+                time.sleep(delay)
+        response.raise_for_status()
+        
+        # 解析响应
+        started = time.perf_counter()
+        result = parse_llm_response(response_data)
+        add_timing(meta, 'parse', time.perf_counter() - started)
+        record_usage(meta, response_data)
+        if cache_key:
+            response_cache.put(cache_key, response_data)
+        
+        # 返回处理后的数据
+        processed_item = data_item.copy()
+        processed_item[result_field_name] = result
+        return processed_item, None
+        
+    except JobCancelled as e:
+        meta['cancelled'] = True
+        processed_item = data_item.copy()
+        processed_item[result_field_name] = f"错误: {str(e)}"
+        return processed_item, str(e)
+    except Exception as e:
+        # 返回错误信息
+        processed_item = data_item.copy()
+        processed_item[result_field_name] = f"错误: {str(e)}"
+        return processed_item, str(e)
+
+# ================== JSONL 流式读取 ==================
+# 上传文件按块转存到磁盘后逐行解析，内存占用与文件大小无关，解析出第一行即可开始派发请求
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+def spool_upload(file, path):
+    """将上传文件按块写入 path（请求结束后上传流会被关闭，后台处理需要独立副本）"""
+    with open(path, 'wb') as f:
+        shutil.copyfileobj(file.stream, f, UPLOAD_CHUNK_SIZE)
+    return path
+
+def count_jsonl_rows(fp, validate=False):
+    """统计非空行数，validate=True 时同时校验每行JSON；完成后将文件指针移回开头"""
+    count = 0
+    for line_no, line in enumerate(fp, 1):
+        if not line.strip():
+            continue
+        if validate:
+            try:
+                json.loads(line)
+            except ValueError as e:
+                raise ValueError(f'第{line_no}行JSON格式错误: {str(e)}')
+        count += 1
+    fp.seek(0)
+    return count
+
+def iter_jsonl(fp, on_error=None):
+    """逐行解析二进制JSONL文件对象，产出 (行序号, 对象)
+
+    行序号只对有效行计数；解析失败的行回调 on_error(文件行号, 异常) 后跳过，未提供 on_error 时直接抛出。
+    """
+    idx = 0
+    for line_no, line in enumerate(fp, 1):
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError as e:
+            if on_error is None:
+                raise
+            on_error(line_no, e)
+            continue
+        yield idx, item
+        idx += 1
+# ================== End JSONL 流式读取 ==================
+
+# ================== 任务控制 ==================
+# 后台任务的暂停与取消：引擎派发每一行前检查控制状态（暂停时阻塞派发，已在途的行照常完成），
+# 取消后不再派发新行，请求循环不再发起新的尝试，重试等待、流式读取与 asyncio 引擎的在途请求随即中止；
+# 因取消而中止的行 meta['cancelled'] 为 True，不写入结果。
+JOB_CONTROL_POLL_INTERVAL = 0.2
+
+class JobCancelled(Exception):
+    """任务已取消"""
+
+class JobControl:
+    """任务的暂停/取消状态（线程安全；分片模式下传入进程间共享的 Event）
+
+    reset 为 False 时保留传入 Event 的当前状态（分片子进程包装父进程的 Event，暂停中的任务保持暂停），
+    只有创建控制的父进程把任务置为运行状态。
+    """
+
+    def __init__(self, cancel_event=None, run_event=None, reset=True):
+        self.cancel_event = cancel_event or threading.Event()
+        self.run_event = run_event or threading.Event()
+        if reset:
+            self.run_event.set()
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    @property
+    def paused(self):
+        return not self.run_event.is_set()
+
+    def cancel(self):
+        self.cancel_event.set()
+        self.run_event.set()
+
+    def pause(self):
+        if not self.cancelled:
+            self.run_event.clear()
+
+    def resume(self):
+        self.run_event.set()
+
+    def check(self):
+        if self.cancelled:
+            raise JobCancelled('任务已取消')
+
+    def wait_running(self):
+        """暂停期间阻塞，返回 False 表示任务已取消"""
+        self.run_event.wait()
+        return not self.cancelled
+
+    def sleep(self, seconds):
+        """可被取消打断的等待"""
+        self.cancel_event.wait(seconds)
+# ================== End 任务控制 ==================
+
+# ================== 批处理执行引擎 ==================
+# 所有引擎接受 (idx, item) 任务迭代器，每完成一行回调 on_result(idx, item, processed_item, error, meta)，
+# meta 为调用元信息（attempts 等）；可选的 on_partial(idx, delta) 接收流式模式下生成中的增量输出：
+# - thread: ThreadPoolExecutor，每行占用一个阻塞线程（默认）
+# - async:  单事件循环 + 按端点拆分的 httpx.AsyncClient，可支撑数千个在途请求（需安装 httpx）；
+#           读取任务与响应缓存的 SQLite 读写在线程中执行，不阻塞事件循环
+async def call_llm_api_async(transports, data_item, prompt_template, api_config, result_field_name, meta=None, on_delta=None):
+    """call_llm_api 的 asyncio 版本，渲染、重试与结果字段语义保持一致
+
+    transports 为本次引擎运行的 AsyncTransports。任务取消时由引擎取消协程（中止在途请求），占用的端点名额在此归还。
+    """
+    meta = meta if meta is not None else {}
+    try:
+        started = time.perf_counter()
+        pool = get_endpoint_pool(api_config)
+        api_url, headers, payload = build_llm_request(data_item, prompt_template, pool.primary.config)
+        add_timing(meta, 'render', time.perf_counter() - started)
+        started = time.perf_counter()
+        cache_key, cached = None, None
+        if response_cache_mode(api_config):
+            cache_key, cached = await asyncio.to_thread(lookup_cached_response, api_url, payload, api_config, meta)
+        add_timing(meta, 'cache_lookup', time.perf_counter() - started)
+        if cached is not None:
+            processed_item = data_item.copy()
+            processed_item[result_field_name] = parse_llm_response(cached)
+            return processed_item, None
+        state = RequestAttempts(api_config, estimate_tokens(payload['messages'][0]['content']))
+        try:
+            while True:
+                endpoint = state.choose()
+                request_url, request_headers, request_payload = (api_url, headers, payload) if endpoint is pool.primary \
+                    else build_llm_request(data_item, prompt_template, endpoint.config)
+                started = time.perf_counter()
+                await state.controller.acquire_async(state.estimated_tokens)
+                add_timing(meta, 'throttle_wait', time.perf_counter() - started)
+                if on_delta and state.attempts:
+                    on_delta(None)
+                state.start()
+                meta['attempts'] = meta['requests'] = state.attempts
+                meta['endpoint'] = endpoint.url
+                try:
+                    started = time.perf_counter()
+                    transport = transports.get(endpoint.config)
+                    try:
+                        if request_payload['stream']:
+                            response, response_data = await stream_llm_request_async(
+                                transport, request_url, request_headers, request_payload, endpoint.config, meta, on_delta
+                            )
+                        else:
+                            response = await transport.post(request_url, request_headers, request_payload,
+                                                            endpoint.config.get('timeout', 30))
+                    finally:
+                        add_timing(meta, 'http', time.perf_counter() - started)
+                    if not request_payload['stream']:
+                        started = time.perf_counter()
+                        response_data = response.json() if response.status_code < 400 else {}
+                        add_timing(meta, 'parse', time.perf_counter() - started)
+                except Exception as e:
+                    delay = state.on_exception(e)
+                else:
+                    delay = state.on_response(response, response_data)
+                    if delay is None:
+                        break
+                await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            state.on_cancel()
+            raise
+        response.raise_for_status()
+        started = time.perf_counter()
+        result = parse_llm_response(response_data)
+        add_timing(meta, 'parse', time.perf_counter() - started)
+        record_usage(meta, response_data)
+        if cache_key:
+            await asyncio.to_thread(response_cache.put, cache_key, response_data)
+        processed_item = data_item.copy()
+        processed_item[result_field_name] = result
+        return processed_item, None
+    except Exception as e:
+        processed_item = data_item.copy()
+        processed_item[result_field_name] = f"错误: {str(e)}"
+        return processed_item, str(e)
+
+def run_thread_engine(tasks, prompt_template, api_config, result_field_name, max_workers, on_result, on_partial=None, control=None):
+    """线程池引擎：调用线程读取任务写入有界队列，队列满时阻塞读取（背压），工作线程从队列取任务"""
+    pending = queue.Queue(maxsize=max_workers * 2)
+    
+    def worker():
+        while True:
+            task = pending.get()
+            if task is None:
+                return
+            (idx, item), enqueued = task
+            meta = {}
+            add_timing(meta, 'queue_wait', time.perf_counter() - enqueued)
+            on_delta = (lambda delta, idx=idx: on_partial(idx, delta)) if on_partial else None
+            processed_item, error = call_llm_api(item, prompt_template, api_config, result_field_name, meta, on_delta, control)
+            on_result(idx, item, processed_item, error, meta)
+    
+    with prepare_endpoints(api_config, max_workers), ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(worker) for _ in range(max_workers)]
+        try:
+            for task in tasks:
+                # 暂停时在此阻塞，取消后不再派发
+                if control is not None and not control.wait_running():
+                    break
+                pending.put((task, time.perf_counter()))
+        finally:
+            for _ in range(max_workers):
+                pending.put(None)
+        for future in futures:
+            future.result()
+
+def run_async_engine(tasks, prompt_template, api_config, result_field_name, max_workers, on_result, on_partial=None, control=None):
+    """asyncio 引擎：max_workers 为在途请求上限，在当前线程中运行独立的事件循环；任务取消时中止在途请求"""
+    if httpx is None:
+        raise RuntimeError("asyncio 引擎需要安装 httpx")
+    with prepare_endpoints(api_config, max_workers, sync_transport=False):
+        asyncio.run(_async_engine_main(tasks, prompt_template, api_config, result_field_name, max_workers, on_result, on_partial,
+                                       control))
+
+async def _async_engine_main(tasks, prompt_template, api_config, result_field_name, max_workers, on_result, on_partial=None,
+                             control=None):
+    loop = asyncio.get_running_loop()
+    # 读取线程把任务放入队列，槽位信号量限制已读取未派发的任务数（背压，同线程池引擎的有界队列）
+    pending = asyncio.Queue()
+    slots = threading.Semaphore(max_workers * 2)
+    stopped = threading.Event()
+    errors = []
+
+    def feed(task):
+        try:
+            loop.call_soon_threadsafe(pending.put_nowait, task)
+            return True
+        except RuntimeError:
+            # 事件循环已结束（引擎异常退出）
+            return False
+
+    def read():
+        # 任务迭代器可能阻塞（读取文件、派发排序、请求去重、指纹查询、变体队列），在独立线程中执行
+        try:
+            for task in tasks:
+                # 暂停时在此阻塞，取消后不再派发
+                if control is not None and not control.wait_running():
+                    return
+                while not slots.acquire(timeout=JOB_CONTROL_POLL_INTERVAL):
+                    if stopped.is_set() or (control is not None and control.cancelled):
+                        return
+                if stopped.is_set() or not feed((task, time.perf_counter())):
+                    return
+        except Exception as e:
+            errors.append(e)
+        finally:
+            feed(None)
+
+    async def worker():
+        while True:
+            task = await pending.get()
+            if task is None:
+                # 结束标记传给下一个协程
+                pending.put_nowait(None)
+                return
+            slots.release()
+            (idx, item), enqueued = task
+            meta = {}
+            add_timing(meta, 'queue_wait', time.perf_counter() - enqueued)
+            on_delta = (lambda delta, idx=idx: on_partial(idx, delta)) if on_partial else None
+            processed_item, error = await call_llm_api_async(transports, item, prompt_template, api_config, result_field_name,
+                                                             meta, on_delta)
+            on_result(idx, item, processed_item, error, meta)
+
+    transports = AsyncTransports(max_workers)
+    reader = threading.Thread(target=read, daemon=True)
+    reader.start()
+    workers = [asyncio.ensure_future(worker()) for _ in range(max_workers)]
+    async def watch_cancel():
+        while not control.cancelled:
+            await asyncio.sleep(JOB_CONTROL_POLL_INTERVAL)
+        for task in workers:
+            task.cancel()
+    watcher = asyncio.ensure_future(watch_cancel()) if control is not None else None
+    try:
+        results = await asyncio.gather(*workers, return_exceptions=True)
+    finally:
+        stopped.set()
+        if watcher is not None:
+            watcher.cancel()
+        await transports.aclose()
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+    # 读取线程在发出结束标记后退出；任务取消时它在下一个检查点退出
+    await asyncio.to_thread(reader.join)
+    if errors:
+        raise errors[0]
+
+ENGINES = {
+    'thread': run_thread_engine,
+    'async': run_async_engine
+}
+
+def run_with_dead_letter(engine, tasks, prompt_template, api_config, result_field_name, max_workers, on_result, on_partial=None,
+                        control=None, gate=None):
+    """执行任务，并在末尾以较低并发对首轮失败的行做一次死信重跑
+
+    首轮结果回调时 meta['phase'] 为 'main'，死信重跑的结果回调时为 'dead_letter'（同一行会回调两次）。
+    api_config 字段：dead_letter（是否启用，默认启用）、dead_letter_workers（默认 max_workers 的1/4）。
+    on_partial(idx, delta)：流式模式下每行的增量输出回调（语义同 call_llm_api 的 on_delta）。
+    control：任务控制（JobControl），任务取消后跳过死信重跑。
+    gate：可选，包装首轮与死信重跑的任务迭代器（如在派发前取得共享的并发名额）。
+    """
+    failed = []
+    def record_row(idx, item, processed_item, error, meta):
+        if meta.get('cancelled'):
+            # 因任务取消而中止的行不计入指标
+            return
+        # 多端点时按实际请求的端点归集指标
+        get_endpoint_metrics(api_config, meta.get('endpoint')).observe_row(meta, error)
+        # 逐行明细只在 DEBUG 级别按采样率记录；失败行以 WARNING 级别按采样率记录
+        level = logging.WARNING if error else logging.DEBUG
+        if logger.isEnabledFor(level) and log_sampled(api_config, idx):
+            log_event(level, '行处理失败' if error else '行处理完成', row=idx, phase=meta['phase'],
+                      attempts=meta.get('attempts'), cache=meta.get('cache'), dedup=meta.get('dedup', False), error=error,
+                      prompt=compile_template(prompt_template).render(item), output=processed_item.get(result_field_name))
+    def main_result(idx, item, processed_item, error, meta):
+        meta['phase'] = 'main'
+        if error and not meta.get('cancelled'):
+            failed.append((idx, item))
+        record_row(idx, item, processed_item, error, meta)
+        on_result(idx, item, processed_item, error, meta)
+    def dead_letter_result(idx, item, processed_item, error, meta):
+        meta['phase'] = 'dead_letter'
+        record_row(idx, item, processed_item, error, meta)
+        on_result(idx, item, processed_item, error, meta)
+    
+    gate = gate or (lambda tasks: tasks)
+    try:
+        run_deduplicated(engine, gate(tasks), prompt_template, api_config, result_field_name, max_workers, main_result, on_partial,
+                         control)
+        if failed and api_config.get('dead_letter', True) and not (control is not None and control.cancelled):
+            failed.sort(key=lambda task: task[0])
+            workers = int(api_config.get('dead_letter_workers') or max(1, max_workers // 4))
+            # 批处理API的失败行不再排队等待新的批处理任务，直接实时重跑
+            dead_letter_engine = 'thread' if engine == 'batch' else engine
+            run_deduplicated(dead_letter_engine, gate(failed), prompt_template, api_config, result_field_name, workers,
+                             dead_letter_result, on_partial, control)
+    finally:
+        # 写回本次运行缓冲中的响应缓存
+        response_cache.flush()
+# ================== End 批处理执行引擎 ==================
+
+# ================== 请求去重 ==================
+# 渲染后请求完全相同的行只发送一次：首个出现的行作为代表请求，其余行在代表请求进行中时挂起等待、
+# 完成后直接复用结果（meta['dedup'] 为 True）。已成功的结果保留在有界 LRU 中，超出后依赖响应缓存。
+# api_config['dedup'] 为 false 时关闭（任务级开关）。
+DEDUP_MEMO_SIZE = 10000
+
+def run_deduplicated(engine, tasks, prompt_template, api_config, result_field_name, max_workers, on_result, on_partial=None,
+                     control=None):
+    """在执行引擎外层按渲染后的请求去重"""
+    if not api_config.get('dedup', True):
+        ENGINES[engine](tasks, prompt_template, api_config, result_field_name, max_workers, on_result, on_partial, control)
+        return
+    lock = threading.Lock()
+    inflight = {}
+    leader_keys = {}
+    memo = OrderedDict()
+    primary_config = get_endpoint_pool(api_config).primary.config
+    
+    def fan_out(idx, item, result, error, meta):
+        processed_item = item.copy()
+        processed_item[result_field_name] = result
+        meta = {k: v for k, v in meta.items() if k not in ('cache', 'timings', 'prompt_tokens', 'cached_tokens', 'fingerprint', 'requests')}
+        on_result(idx, item, processed_item, error, dict(meta, dedup=True, attempts=0))
+    
+    def unique_tasks():
+        for idx, item in tasks:
+            try:
+                api_url, _, payload = build_llm_request(item, prompt_template, primary_config)
+                key = ResponseCache.make_key(api_url, payload)
+            except Exception:
+                # 渲染失败的行照常派发，由 call_llm_api 记录错误
+                yield idx, item
+                continue
+            with lock:
+                if key in memo:
+                    memo.move_to_end(key)
+                    cached = memo[key]
+                elif key in inflight:
+                    inflight[key].append((idx, item))
+                    continue
+                else:
+                    cached = None
+                    inflight[key] = []
+                    leader_keys[idx] = key
+            if cached is not None:
+                fan_out(idx, item, cached, None, {})
+                continue
+            yield idx, item
+    
+    def leader_result(idx, item, processed_item, error, meta):
+        with lock:
+            key = leader_keys.pop(idx, None)
+            followers = inflight.pop(key, []) if key else []
+            if key and not error:
+                memo[key] = processed_item.get(result_field_name)
+                if len(memo) > DEDUP_MEMO_SIZE:
+                    memo.popitem(last=False)
+        on_result(idx, item, processed_item, error, meta)
+        for follower_idx, follower_item in followers:
+            fan_out(follower_idx, follower_item, processed_item.get(result_field_name), error, meta)
+    
+    ENGINES[engine](unique_tasks(), prompt_template, api_config, result_field_name, max_workers, leader_result, on_partial, control)
+# ================== End 请求去重 ==================
+
+# ================== 前缀感知调度 ==================
+# 任务参数 dispatch_order 为 'prefix' 时，每次读入一个窗口（api_config['prefix_window'] 行，默认 PREFIX_WINDOW）
+# 的待处理行，按渲染后的提示词排序后派发：共享前缀的提示词（同一段长文档、相同的静态指令前缀）相邻发送，
+# 上游的前缀缓存（vLLM/SGLang prefix caching、提供商的 prompt caching）在被淘汰前即可复用。
+# 结果文件仍按原始行顺序生成；缓存命中情况见任务统计中的 tokens.cached_ratio。
+PREFIX_WINDOW = 2000
+
+def prefix_ordered(tasks, prompt_template, window=PREFIX_WINDOW):
+    """按窗口重排 (行序号, 数据) 任务：窗口内按渲染后的提示词字典序派发，相同提示词保持原顺序"""
+    template = compile_template(prompt_template)
+    tasks = iter(tasks)
+    while True:
+        chunk = list(islice(tasks, max(1, int(window))))
+        if not chunk:
+            return
+        keyed = []
+        for idx, item in chunk:
+            try:
+                key = template.render(item)
+            except Exception:
+                # 渲染失败的行排在窗口最前，由 call_llm_api 记录错误
+                key = ''
+            keyed.append((key, idx, item))
+        keyed.sort(key=lambda entry: (entry[0], entry[1]))
+        for _, idx, item in keyed:
+            yield idx, item
+
+def dispatch_tasks(tasks, params, prompt_template, api_config):
+    """按任务参数中的派发顺序包装任务迭代器"""
+    if params.get('dispatch_order') == 'prefix':
+        return prefix_ordered(tasks, prompt_template, api_config.get('prefix_window') or PREFIX_WINDOW)
+    return tasks
+# ================== End 前缀感知调度 ==================
+
+# ================== 多变体对比 ==================
+# 任务参数 variants 为变体列表时，同一输入文件按多个 (提示词模板, 项目配置, 结果字段) 变体处理，用于提示词/模型对比：
+# - 输入文件只解析一次，由读取线程分发给各变体（每个变体一个有界队列，进度快的变体等待慢的变体）
+# - 每个变体照常经过请求去重、重试、死信重跑与派发排序；结果按行合并，每行带有全部变体的结果字段，
+#   任一变体失败即视为该行失败（断点续跑时整行重跑，已成功的变体通常命中响应缓存）
+# - 所有变体共享 max_workers 个在途名额，慢的变体可以占用更多名额。名额在派发前取得：线程池引擎在派发线程中，
+#   asyncio 引擎在读取线程中（变体队列与名额的阻塞等待都不在事件循环中）。批处理API引擎按变体数均分 max_workers。
+#   访问同一端点的变体共用该端点的限流控制器（并发上限、RPM/TPM）
+# - 变体模式不支持分片执行与生成中的输出预览
+# 变体字段：result_field_name（必填，互不相同）、prompt_template（缺省为任务的模板）、
+# project_id（使用该项目的API配置，缺省为任务所属项目）、api_config（覆盖配置中的字段，如 {"modelName": "..."}）
+FANOUT_MAX_VARIANTS = 8
+FANOUT_QUEUE_SIZE = 1000
+
+def parse_variants(text):
+    """解析并校验提交任务时的变体列表（JSON），未提供时返回 None"""
+    if not text or not text.strip():
+        return None
+    try:
+        variants = json.loads(text)
+    except ValueError as e:
+        raise ValueError(f'变体配置不是合法的JSON: {str(e)}')
+    if not isinstance(variants, list) or not variants or not all(isinstance(v, dict) for v in variants):
+        raise ValueError('变体配置应为非空的对象数组')
+    if len(variants) > FANOUT_MAX_VARIANTS:
+        raise ValueError(f'变体数不能超过 {FANOUT_MAX_VARIANTS} 个')
+    fields = [v.get('result_field_name') for v in variants]
+    if not all(isinstance(f, str) and f for f in fields) or len(set(fields)) != len(fields):
+        raise ValueError('每个变体都需要填写互不相同的 result_field_name')
+    if not all(isinstance(v.get('api_config', {}), dict) for v in variants):
+        raise ValueError('变体的 api_config 应为对象')
+    return variants
+
+def load_project_api_config(project_id):
+    """读取项目的API配置，项目不存在时返回 None"""
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute('SELECT api_config FROM projects WHERE id = ?', (project_id,))
+    row = cursor.fetchone()
+    conn.close()
+    if not row:
+        return None
+    return json.loads(row[0]) if row[0] else {}
+
+def resolve_variants(params, api_config):
+    """把任务参数中的变体解析为 [{'prompt_template', 'api_config', 'result_field_name'}]
+
+    api_config 为任务所属项目的配置（已应用任务级的缓存与去重开关）。
+    """
+    variants = []
+    for n, spec in enumerate(params.get('variants') or [], 1):
+        config = api_config
+        if spec.get('project_id'):
+            config = load_project_api_config(spec['project_id'])
+            if config is None:
+                raise ValueError(f'变体{n}的项目不存在')
+            config = job_api_config(params, config)
+        variants.append({
+            'prompt_template': compile_template(spec.get('prompt_template') or params.get('prompt_template', '')),
+            'api_config': dict(config, **(spec.get('api_config') or {})),
+            'result_field_name': spec['result_field_name']
+        })
+    return variants
+
+class FanoutMerger:
+    """按行合并各变体的结果（线程安全）
+
+    所有变体都返回首轮结果后以 phase='main' 回调合并后的行；含失败变体的行保留到任务结束，
+    其死信重跑结果到达时以 phase='dead_letter' 再次回调（错误为仍失败的变体）。
+    """
+
+    def __init__(self, variants, on_result):
+        self.fields = [variant['result_field_name'] for variant in variants]
+        self.on_result = on_result
+        self.lock = threading.Lock()
+        # 行序号 -> [原始数据, 各变体结果, 各变体错误, 各变体 meta]
+        self.pending = {}
+        self.failed = {}
+        self.cancelled = set()
+
+    def add(self, variant, idx, item, processed_item, error, meta):
+        with self.lock:
+            if idx in self.cancelled:
+                return
+            if meta.get('cancelled'):
+                # 任一变体因任务取消而中止，整行不写入结果
+                self.cancelled.add(idx)
+                self.pending.pop(idx, None)
+                return
+            output = processed_item.get(self.fields[variant])
+            if meta['phase'] == 'dead_letter' and idx in self.failed:
+                row = self.failed[idx]
+                row[1][variant], row[2][variant] = output, error
+                if not any(row[2]):
+                    del self.failed[idx]
+                self.emit(idx, row, meta)
+                return
+            row = self.pending.get(idx)
+            if row is None:
+                n = len(self.fields)
+                row = self.pending[idx] = [item, [None] * n, [None] * n, [None] * n]
+            row[1][variant], row[2][variant] = output, error
+            if meta['phase'] == 'main':
+                row[3][variant] = meta
+            if any(m is None for m in row[3]):
+                return
+            del self.pending[idx]
+            if any(row[2]):
+                self.failed[idx] = row
+            self.emit(idx, row, merge_variant_meta(row[3]))
+
+    def emit(self, idx, row, meta):
+        item, outputs, errors, _ = row
+        merged = item.copy()
+        for field, output in zip(self.fields, outputs):
+            merged[field] = output
+        error = '; '.join(f'{field}: {e}' for field, e in zip(self.fields, errors) if e) or None
+        self.on_result(idx, item, merged, error, meta)
+
+def merge_variant_meta(metas):
+    """合并同一行各变体的 meta：重试次数、请求数、耗时与 token 数累加，全部命中缓存/去重时才计为命中"""
+    merged = {'phase': 'main', 'attempts': 1 + sum(max(0, m.get('attempts', 1) - 1) for m in metas),
+              'requests': sum(m.get('requests', 0) for m in metas), 'timings': {}}
+    for m in metas:
+        for phase, seconds in m.get('timings', {}).items():
+            add_timing(merged, phase, seconds)
+        if m.get('prompt_tokens'):
+            merged['prompt_tokens'] = merged.get('prompt_tokens', 0) + m['prompt_tokens']
+            merged['cached_tokens'] = merged.get('cached_tokens', 0) + m.get('cached_tokens', 0)
+    caches = [m.get('cache') for m in metas]
+    if all(cache == 'hit' for cache in caches):
+        merged['cache'] = 'hit'
+    elif 'miss' in caches:
+        merged['cache'] = 'miss'
+    if all(m.get('dedup') for m in metas):
+        merged['dedup'] = True
+    return merged
+
+def run_fanout(engine, tasks, variants, params, max_workers, on_result, control=None):
+    """一次读取任务、按多个变体并行处理，合并后的逐行结果回调 on_result（语义同 run_with_dead_letter）"""
+    merger = FanoutMerger(variants, on_result)
+    queues = [queue.Queue(maxsize=FANOUT_QUEUE_SIZE) for _ in variants]
+    finished = [threading.Event() for _ in variants]
+    stopped = threading.Event()
+    errors = []
+    # 批处理API引擎读完全部行才返回结果，不能按行占用共享名额
+    shared = engine in ('thread', 'async')
+    budget = threading.Semaphore(max_workers) if shared else None
+    workers = max_workers if shared else max(1, max_workers // len(variants))
+
+    def put(variant, task):
+        """向变体队列放入任务，变体已结束时放弃；返回 False 表示应停止读取"""
+        while not finished[variant].is_set():
+            try:
+                queues[variant].put(task, timeout=JOB_CONTROL_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                if task is not None and (stopped.is_set() or (control is not None and control.cancelled)):
+                    return False
+        return True
+
+    def read():
+        try:
+            for task in tasks:
+                # 任一变体异常结束或任务取消后停止读取
+                if stopped.is_set() or (control is not None and control.cancelled):
+                    break
+                if not all(put(variant, task) for variant in range(len(variants))):
+                    break
+        except Exception as e:
+            errors.append(e)
+        finally:
+            for variant in range(len(variants)):
+                put(variant, None)
+
+    def variant_tasks(variant):
+        while True:
+            task = queues[variant].get()
+            if task is None:
+                return
+            yield task
+
+    def with_budget(tasks):
+        # 共享名额在派发前取得（首轮与死信重跑），变体返回该行结果时归还
+        for task in tasks:
+            while not budget.acquire(timeout=JOB_CONTROL_POLL_INTERVAL):
+                if control is not None and control.cancelled:
+                    return
+            yield task
+
+    def run_variant(variant):
+        config = variants[variant]
+        def variant_result(idx, item, processed_item, error, meta):
+            if shared:
+                budget.release()
+            merger.add(variant, idx, item, processed_item, error, meta)
+        try:
+            tasks = dispatch_tasks(variant_tasks(variant), params, config['prompt_template'], config['api_config'])
+            run_with_dead_letter(engine, tasks, config['prompt_template'], config['api_config'], config['result_field_name'],
+                                 workers, variant_result, control=control, gate=with_budget if shared else None)
+        except Exception as e:
+            errors.append(e)
+            stopped.set()
+        finally:
+            finished[variant].set()
+
+    threads = [threading.Thread(target=read, daemon=True)]
+    threads += [threading.Thread(target=run_variant, args=(variant,), daemon=True) for variant in range(len(variants))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+# ================== End 多变体对比 ==================
+
+# ================== 增量处理 ==================
+# 后台任务（多变体任务除外）把成功行的结果记入项目的指纹索引（projects.db 的 row_fingerprints 表）。
+# 指纹由数据行内容的哈希与渲染后请求的哈希（提示词、模型、温度、max_tokens、API地址，同响应缓存的键）组成。
+# 任务参数 incremental 为 true 时，指纹已在索引中的行直接复用上次的结果（meta['reused'] 为 True），
+# 只有新增的行、内容变化的行以及模板或模型配置变化后的行才请求API；进度与结果中的 reused / sent 为复用的行数与实际发出的请求数。
+# 每条指纹记录生成它的模板与端点配置的哈希；任务完成时删除项目中其他配置哈希（已被取代的模板或模型配置）的指纹，
+# 并按 FINGERPRINT_TTL 过期、按 FINGERPRINT_MAX_PER_PROJECT 只保留最新的指纹。
+# 删除项目或调用 DELETE /api/projects/<id>/fingerprints 时清空。
+FINGERPRINT_BATCH = 500
+FINGERPRINT_TTL = float(os.environ.get('PROMPTFACTORY_FINGERPRINT_TTL', 30 * 24 * 3600))
+FINGERPRINT_MAX_PER_PROJECT = int(os.environ.get('PROMPTFACTORY_FINGERPRINT_MAX', 200000))
+
+def row_fingerprint(item, prompt_template, primary_config):
+    """数据行在给定模板与端点配置下的指纹"""
+    api_url, _, payload = build_llm_request(item, prompt_template, primary_config)
+    row_hash = hashlib.sha256(json.dumps(item, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+    return hashlib.sha256(f'{row_hash}:{ResponseCache.make_key(api_url, payload)}'.encode('utf-8')).hexdigest()
+
+def fingerprint_config_hash(prompt_template, primary_config):
+    """模板与端点配置的哈希（以空数据行渲染，即模板原文，键的组成同响应缓存）"""
+    api_url, _, payload = build_llm_request({}, prompt_template, primary_config)
+    return ResponseCache.make_key(api_url, payload)
+
+def lookup_fingerprints(project_id, fingerprints):
+    """批量查询指纹索引，返回 {指纹: 上次的结果}"""
+    if not fingerprints:
+        return {}
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute(
+        f"SELECT fingerprint, output FROM row_fingerprints WHERE project_id = ? AND created_at >= ? "
+        f"AND fingerprint IN ({','.join('?' * len(fingerprints))})",
+        [project_id, time.time() - FINGERPRINT_TTL, *fingerprints]
+    )
+    rows = cursor.fetchall()
+    conn.close()
+    return {fingerprint: json.loads(output) for fingerprint, output in rows}
+
+def save_fingerprints(entries):
+    """写入指纹索引，entries 为 (项目ID, 指纹, 结果, 任务ID, 配置哈希) 列表"""
+    if not entries:
+        return
+    now = time.time()
+    conn = get_db()
+    conn.executemany(
+        'INSERT OR REPLACE INTO row_fingerprints (project_id, fingerprint, output, job_id, created_at, config_hash) '
+        'VALUES (?, ?, ?, ?, ?, ?)',
+        [(project_id, fingerprint, json.dumps(output, ensure_ascii=False), job_id, now, config_hash)
+         for project_id, fingerprint, output, job_id, config_hash in entries]
+    )
+    conn.commit()
+    conn.close()
+
+def prune_fingerprints(project_id, config_hash):
+    """淘汰项目的指纹：其他配置哈希的、过期的，以及超出每项目上限的最旧指纹；返回删除的条数"""
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute(
+        'DELETE FROM row_fingerprints WHERE project_id = ? AND (config_hash != ? OR created_at < ?)',
+        (project_id, config_hash, time.time() - FINGERPRINT_TTL)
+    )
+    deleted = cursor.rowcount
+    cursor.execute(
+        'DELETE FROM row_fingerprints WHERE project_id = ? AND rowid NOT IN '
+        '(SELECT rowid FROM row_fingerprints WHERE project_id = ? ORDER BY created_at DESC LIMIT ?)',
+        (project_id, project_id, FINGERPRINT_MAX_PER_PROJECT)
+    )
+    deleted += cursor.rowcount
+    conn.commit()
+    conn.close()
+    return deleted
+
+class FingerprintFilter:
+    """任务的指纹计算与结果复用
+
+    filter() 包装任务迭代器：按批计算指纹，增量模式下命中索引的行以复用的结果直接回调，其余行照常派发；
+    tag() 在派发行的结果 meta 中记录指纹（meta['fingerprint']），由任务线程把成功的结果写入索引。
+    """
+
+    def __init__(self, project_id, prompt_template, api_config, result_field_name, incremental):
+        self.project_id = project_id
+        self.prompt_template = compile_template(prompt_template)
+        self.primary_config = get_endpoint_pool(api_config).primary.config
+        try:
+            self.config_hash = fingerprint_config_hash(self.prompt_template, self.primary_config)
+        except ValueError:
+            # 端点未配置 API URL 时各行同样无法渲染请求，不记录指纹
+            self.config_hash = None
+        self.result_field_name = result_field_name
+        self.incremental = incremental
+        # 已派发行的指纹，成功或死信重跑结束后取出
+        self.fingerprints = {}
+
+    def filter(self, tasks, on_result):
+        tasks = iter(tasks)
+        while True:
+            chunk = list(islice(tasks, FINGERPRINT_BATCH))
+            if not chunk:
+                return
+            keyed = []
+            for idx, item in chunk:
+                try:
+                    fingerprint = row_fingerprint(item, self.prompt_template, self.primary_config)
+                except Exception:
+                    # 渲染失败的行照常派发，由 call_llm_api 记录错误
+                    fingerprint = None
+                keyed.append((idx, item, fingerprint))
+            found = lookup_fingerprints(self.project_id, [f for _, _, f in keyed if f]) if self.incremental else {}
+            for idx, item, fingerprint in keyed:
+                if fingerprint in found:
+                    processed_item = item.copy()
+                    processed_item[self.result_field_name] = found[fingerprint]
+                    on_result(idx, item, processed_item, None, {'phase': 'main', 'attempts': 0, 'reused': True})
+                    continue
+                if fingerprint:
+                    self.fingerprints[idx] = fingerprint
+                yield idx, item
+
+    def tag(self, idx, error, meta):
+        # 首轮失败的行保留指纹，等待死信重跑的结果
+        if error and meta.get('phase') == 'main':
+            fingerprint = self.fingerprints.get(idx)
+        else:
+            fingerprint = self.fingerprints.pop(idx, None)
+        if fingerprint:
+            meta['fingerprint'] = fingerprint
+
+@app.route('/api/projects/<project_id>/fingerprints', methods=['DELETE'])
+def clear_fingerprints(project_id):
+    """清空项目的增量处理指纹索引"""
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute('DELETE FROM row_fingerprints WHERE project_id = ?', (project_id,))
+    deleted = cursor.rowcount
+    conn.commit()
+    conn.close()
+    return jsonify({'message': '指纹索引已清空', 'deleted': deleted})
+# ================== End 增量处理 ==================
+
+# ================== 提供商批处理API ==================
+# engine='batch' 时不逐行实时调用，而是通过 OpenAI 兼容的 Files + Batches 接口离线处理（费用更低、限额更高，
+# 适合数十万行以上的大文件；完成时间由提供商决定，最长为 completion_window）：
+# 1. 逐行渲染请求写入批处理输入文件（{"custom_id", "method", "url", "body"}），每个文件最多 batch_max_requests 行
+#    或 BATCH_MAX_FILE_BYTES 字节，写满即上传并创建批处理任务
+# 2. 每 batch_poll_interval 秒轮询各任务状态，结束后下载输出文件，按原始行顺序回调结果
+# 已提交的任务按输入文件内容哈希记录在 provider_batches 表中，任务中断后续跑时内容相同的输入文件直接复用已有任务，
+# 不会重复提交。响应缓存与请求去重照常生效；死信重跑改用实时调用（线程池引擎）。
+# api_config 字段：batch_api_base（默认为 api_url 去掉 /chat/completions）、batch_endpoint（默认为 api_url 的路径）、
+# batch_completion_window（默认 24h）、batch_max_requests（默认50000）、batch_poll_interval（秒，默认30）。
+BATCH_DIR = os.path.join('data', 'batches')
+BATCH_MAX_REQUESTS = 50000
+BATCH_MAX_FILE_BYTES = 190 * 1024 * 1024
+BATCH_FINAL_STATUS = ('completed', 'failed', 'expired', 'cancelled')
+
+class BatchClient:
+    """OpenAI 兼容的 Files + Batches 接口"""
+
+    def __init__(self, api_config):
+        api_url = api_config.get('api_url') or api_config.get('apiUrl') or ''
+        base = api_config.get('batch_api_base') or api_url.split('?')[0].rsplit('/chat/completions', 1)[0]
+        self.base = base.rstrip('/')
+        self.endpoint = api_config.get('batch_endpoint') or urlsplit(api_url).path
+        self.completion_window = api_config.get('batch_completion_window', '24h')
+        self.headers = auth_headers(api_config)
+        self.verify = api_config.get('verify_ssl', True)
+        self.timeout = float(api_config.get('timeout', 30))
+        self.session = requests.Session()
+
+    def _request(self, method, path, timeout=None, **kwargs):
+        response = self.session.request(method, self.base + path, headers=self.headers, verify=self.verify,
+                                        timeout=timeout or self.timeout, **kwargs)
+        if response.status_code >= 400:
+            raise RuntimeError(f'批处理接口 {method} {path} 返回 {response.status_code}: {response.text[:200]}')
+        return response
+
+    def upload(self, path):
+        with open(path, 'rb') as f:
+            return self._request('POST', '/files', timeout=max(self.timeout, 300), data={'purpose': 'batch'},
+                                 files={'file': (os.path.basename(path), f, 'application/jsonl')}).json()['id']
+
+    def create(self, input_file_id):
+        return self._request('POST', '/batches', json={
+            'input_file_id': input_file_id,
+            'endpoint': self.endpoint,
+            'completion_window': self.completion_window
+        }).json()
+
+    def cancel(self, batch_id):
+        return self._request('POST', f'/batches/{batch_id}/cancel').json()
+
+    def get(self, batch_id):
+        return self._request('GET', f'/batches/{batch_id}').json()
+
+    def iter_file(self, file_id):
+        """逐行读取输出/错误文件"""
+        response = self._request('GET', f'/files/{file_id}/content', timeout=max(self.timeout, 300), stream=True)
+        try:
+            for line in response.iter_lines():
+                if line.strip():
+                    yield json.loads(line)
+        finally:
+            response.close()
+
+def find_provider_batch(api_base, input_sha256):
+    """查找输入内容相同、仍然有效的批处理任务"""
+    conn = get_db()
+    row = conn.execute('''
+        SELECT id FROM provider_batches
+        WHERE api_base = ? AND input_sha256 = ? AND status NOT IN ('failed', 'expired', 'cancelled')
+        ORDER BY created_at DESC LIMIT 1
+    ''', (api_base, input_sha256)).fetchone()
+    conn.close()
+    return row[0] if row else None
+
+def save_provider_batch(batch, api_base=None, input_sha256=None, request_count=None):
+    """记录新提交的批处理任务（传入 api_base 时），或更新已有任务的状态"""
+    counts = batch.get('request_counts') or {}
+    conn = get_db()
+    if api_base:
+        conn.execute('''
+            INSERT INTO provider_batches (id, api_base, input_sha256, input_file_id, request_count, status)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (batch['id'], api_base, input_sha256, batch.get('input_file_id'), request_count, batch.get('status')))
+    else:
+        conn.execute('''
+            UPDATE provider_batches
+            SET status = ?, completed_count = ?, failed_count = ?, output_file_id = ?, error_file_id = ?,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', (batch.get('status'), counts.get('completed', 0), counts.get('failed', 0),
+              batch.get('output_file_id'), batch.get('error_file_id'), batch['id']))
+    conn.commit()
+    conn.close()
+
+class BatchChunk:
+    """一个批处理输入文件，以及按相同顺序保存的原始行（idx, item, 缓存键）"""
+
+    def __init__(self, directory, number):
+        self.input_path = os.path.join(directory, f'input-{number}.jsonl')
+        self.rows_path = os.path.join(directory, f'rows-{number}.jsonl')
+        self.input = open(self.input_path, 'wb')
+        self.rows = open(self.rows_path, 'wb')
+        self.digest = hashlib.sha256()
+        self.count = 0
+        self.size = 0
+        self.batch_id = None
+        self.submitted_at = None
+
+    def add(self, idx, item, cache_key, request_line):
+        line = json.dumps(request_line, ensure_ascii=False).encode('utf-8') + b'\n'
+        self.input.write(line)
+        self.digest.update(line)
+        self.size += len(line)
+        self.rows.write(json.dumps([idx, item, cache_key], ensure_ascii=False).encode('utf-8') + b'\n')
+        self.count += 1
+
+    def close(self):
+        self.input.close()
+        self.rows.close()
+
+    def submit(self, client, reuse=True):
+        self.close()
+        input_sha256 = self.digest.hexdigest()
+        self.batch_id = find_provider_batch(client.base, input_sha256) if reuse else None
+        if self.batch_id:
+            log_event(logging.INFO, '复用已提交的批处理任务', batch_id=self.batch_id, requests=self.count)
+        else:
+            batch = client.create(client.upload(self.input_path))
+            self.batch_id = batch['id']
+            save_provider_batch(batch, client.base, input_sha256, self.count)
+            log_event(logging.INFO, '批处理任务已提交', batch_id=self.batch_id, requests=self.count)
+        os.remove(self.input_path)
+        self.submitted_at = time.perf_counter()
+
+    def merge(self, client, batch, result_field_name, on_result):
+        """下载结束的批处理任务的输出，按原始行顺序回调结果"""
+        results = {}
+        for file_id in (batch.get('output_file_id'), batch.get('error_file_id')):
+            if file_id:
+                for record in client.iter_file(file_id):
+                    results[record.get('custom_id')] = record
+        if batch['status'] == 'failed':
+            errors = (batch.get('errors') or {}).get('data') or []
+            missing_error = '批处理任务失败: ' + ('; '.join(e.get('message', '') for e in errors) or '未知原因')
+        else:
+            missing_error = {'expired': '批处理任务已过期', 'cancelled': '批处理任务已取消'}.get(batch['status'], '批处理结果中缺少该行')
+        elapsed = time.perf_counter() - self.submitted_at
+        with open(self.rows_path, 'rb') as f:
+            for line in f:
+                idx, item, cache_key = json.loads(line)
+                meta = {'attempts': 1, 'requests': 1, 'batch_id': self.batch_id}
+                if cache_key:
+                    meta['cache'] = 'miss'
+                add_timing(meta, 'batch', elapsed)
+                record = results.pop(str(idx), None)
+                response = (record or {}).get('response') or {}
+                response_data = response.get('body') or {}
+                if record is None:
+                    error = missing_error
+                elif record.get('error'):
+                    error = record['error'].get('message') or str(record['error'])
+                elif response.get('status_code', 200) >= 400:
+                    error = f"HTTP {response['status_code']}: {(response_data.get('error') or {}).get('message', '')}"
+                else:
+                    error = None
+                processed_item = item.copy()
+                if not error:
+                    try:
+                        processed_item[result_field_name] = parse_llm_response(response_data)
+                    except Exception as e:
+                        error = f'响应解析失败: {str(e)}'
+                    else:
+                        record_usage(meta, response_data)
+                        if cache_key:
+                            response_cache.put(cache_key, response_data)
+                if error:
+                    processed_item[result_field_name] = f"错误: {error}"
+                on_result(idx, item, processed_item, error, meta)
+        os.remove(self.rows_path)
+
+def cancel_provider_batches(client, chunks):
+    """取消已提交的批处理任务（任务取消时调用，已结束的批处理任务由提供商忽略）"""
+    for chunk in chunks:
+        try:
+            save_provider_batch(client.cancel(chunk.batch_id))
+        except Exception as e:
+            log_event(logging.WARNING, '批处理任务取消失败', batch_id=chunk.batch_id, error=str(e))
+
+def run_batch_engine(tasks, prompt_template, api_config, result_field_name, max_workers, on_result, on_partial=None, control=None):
+    """批处理API引擎：批处理任务由提供商排队执行，max_workers 与 on_partial 不适用
+
+    任务暂停时停止写入新的批处理输入（已提交的任务照常轮询）；任务取消时不再提交，并取消尚未结束的批处理任务。
+    """
+    primary_config = get_endpoint_pool(api_config).primary.config
+    client = BatchClient(primary_config)
+    poll_interval = float(api_config.get('batch_poll_interval', 30))
+    max_requests = int(api_config.get('batch_max_requests') or BATCH_MAX_REQUESTS)
+    # 跳过响应缓存（强制重新请求）时也不复用已提交的批处理任务
+    reuse = api_config.get('response_cache', True) != 'refresh'
+    directory = os.path.join(BATCH_DIR, uuid.uuid4().hex)
+    os.makedirs(directory, exist_ok=True)
+    chunks = []
+    chunk = None
+    try:
+        for idx, item in tasks:
+            if control is not None and not control.wait_running():
+                # 提交过程中取消：已提交的批处理任务同样取消，避免继续执行与计费
+                cancel_provider_batches(client, chunks)
+                return
+            meta = {}
+            started = time.perf_counter()
+            try:
+                api_url, _, payload = build_llm_request(item, prompt_template, primary_config)
+            except Exception as e:
+                processed_item = item.copy()
+                processed_item[result_field_name] = f"错误: {str(e)}"
+                on_result(idx, item, processed_item, str(e), meta)
+                continue
+            # 批处理接口不支持流式响应
+            payload['stream'] = False
+            payload.pop('stream_options', None)
+            add_timing(meta, 'render', time.perf_counter() - started)
+            cache_key, cached = lookup_cached_response(api_url, payload, api_config, meta)
+            if cached is not None:
+                processed_item = item.copy()
+                processed_item[result_field_name] = parse_llm_response(cached)
+                on_result(idx, item, processed_item, None, meta)
+                continue
+            if chunk is None:
+                chunk = BatchChunk(directory, len(chunks) + 1)
+            chunk.add(idx, item, cache_key, {'custom_id': str(idx), 'method': 'POST', 'url': client.endpoint, 'body': payload})
+            if chunk.count >= max_requests or chunk.size >= BATCH_MAX_FILE_BYTES:
+                chunk.submit(client, reuse)
+                chunks.append(chunk)
+                chunk = None
+        if chunk is not None:
+            chunk.submit(client, reuse)
+            chunks.append(chunk)
+            chunk = None
+        
+        pending = list(chunks)
+        while pending:
+            if control is not None and control.cancelled:
+                cancel_provider_batches(client, pending)
+                return
+            for current in list(pending):
+                try:
+                    batch = client.get(current.batch_id)
+                except Exception as e:
+                    # 轮询失败不影响批处理任务本身，下一轮继续
+                    log_event(logging.WARNING, '批处理任务状态查询失败', batch_id=current.batch_id, error=str(e))
+                    continue
+                save_provider_batch(batch)
+                if batch.get('status') in BATCH_FINAL_STATUS:
+                    log_event(logging.INFO, '批处理任务结束', batch_id=current.batch_id, status=batch['status'],
+                              request_counts=batch.get('request_counts'))
+                    current.merge(client, batch, result_field_name, on_result)
+                    pending.remove(current)
+            if pending:
+                if control is not None:
+                    control.sleep(poll_interval)
+                else:
+                    time.sleep(poll_interval)
+    finally:
+        if chunk is not None:
+            chunk.close()
+        shutil.rmtree(directory, ignore_errors=True)
+
+ENGINES['batch'] = run_batch_engine
+
+@app.route('/api/batches', methods=['GET'])
+def get_provider_batches():
+    """已提交的提供商批处理任务（按创建时间倒序分页）"""
+    def to_dict(row):
+        return dict(zip(('id', 'api_base', 'request_count', 'status', 'completed_count', 'failed_count',
+                         'output_file_id', 'error_file_id', 'created_at', 'updated_at'), row))
+    return page_query(
+        'SELECT id, api_base, request_count, status, completed_count, failed_count, output_file_id, error_file_id, '
+        'created_at, updated_at, created_at, id FROM provider_batches',
+        [], [], 'created_at', to_dict
+    )
+# ================== End 提供商批处理API ==================
+
+
+# ================== 提示词模板库 ==================
+# /api/prompt-templates 与 /api/templates 共用同一个模板库，数据保存在 data/prompt_templates.jsonl：
+# 每次新增/修改/删除只追加一行操作记录（{"op": "put", "template": {...}} 或 {"op": "delete", "id": ...}），
+# 失效记录过多时以临时文件 + os.replace 原子地重写为快照。模板常驻内存，文件 mtime/大小变化
+# （如其他进程写入）时重新加载；GET 接口返回 ETag，客户端可用 If-None-Match 获得 304。
+# 写入（版本检查、追加与重写快照）持有 data/prompt_templates.jsonl.lock 上的 fcntl.flock 排他锁，
+# 多个进程共用模板库时不会丢失彼此的写入（锁加在单独的文件上，因为重写快照会替换数据文件本身）；
+# 没有 fcntl 的平台（Windows）只保证进程内互斥，模板库只能由一个进程使用。
+# 首次启动时从旧版 data/prompt_templates.json 与 SQLite prompt_templates 表导入。
+TEMPLATE_STORE_FILE = os.path.join('data', 'prompt_templates.jsonl')
+LEGACY_TEMPLATE_FILE = os.path.join('data', 'prompt_templates.json')
+TEMPLATE_COMPACT_MIN_OPS = 200
+
+def _template_sort_key(template):
+    return (template.get('updated_at') or '', str(template['id']))
+
+class TemplateConflict(Exception):
+    """If-Match 与模板库当前版本不一致"""
+
+class TemplateStore:
+    """提示词模板库（线程安全）"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.lock_file = None
+        self.lock_depth = 0
+        self.templates = {}
+        self.ops = 0
+        self.file_state = None
+        self._sorted = None
+        self._body = None
+
+    @contextmanager
+    def _write_lock(self):
+        """写入锁（可重入）：进程内的线程锁 + 跨进程的文件锁"""
+        with self.lock:
+            if self.lock_depth == 0 and fcntl is not None:
+                if self.lock_file is None:
+                    os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                    self.lock_file = open(f'{self.path}.lock', 'a')
+                fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+            self.lock_depth += 1
+            try:
+                yield
+            finally:
+                self.lock_depth -= 1
+                if self.lock_depth == 0 and fcntl is not None:
+                    fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+            return (st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            return None
+
+    def _apply(self, record):
+        if record.get('op') == 'put':
+            template = record['template']
+            self.templates[str(template['id'])] = template
+        elif record.get('op') == 'delete':
+            self.templates.pop(str(record['id']), None)
+        self.ops += 1
+
+    def _load(self):
+        self.templates = {}
+        self.ops = 0
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    self._apply(json.loads(line))
+                except (ValueError, KeyError):
+                    # 写入中断留下的不完整行
+                    continue
+        self._sorted = None
+        self._body = None
+
+    def _bootstrap(self):
+        """从旧版 JSON 文件与 SQLite 表导入模板，生成初始快照"""
+        templates = {}
+        if os.path.exists(LEGACY_TEMPLATE_FILE):
+            try:
+                with open(LEGACY_TEMPLATE_FILE, 'r', encoding='utf-8') as f:
+                    for template in json.load(f):
+                        templates[str(template['id'])] = template
+            except (ValueError, KeyError, TypeError) as e:
+                log_event(logging.WARNING, '旧版模板文件解析失败，已跳过', path=LEGACY_TEMPLATE_FILE, error=str(e))
+        conn = get_db()
+        for row in conn.execute('SELECT id, name, description, content, created_at, updated_at FROM prompt_templates'):
+            templates[row[0]] = dict(zip(('id', 'name', 'description', 'content', 'created_at', 'updated_at'), row))
+        conn.close()
+        self.templates = templates
+        self._compact()
+
+    def _compact(self):
+        """把当前模板原子地重写为快照"""
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for template in self.templates.values():
+                f.write(json.dumps({'op': 'put', 'template': template}, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.ops = len(self.templates)
+        self.file_state = self._stat()
+
+    def _refresh(self):
+        state = self._stat()
+        if state is None:
+            with self._write_lock():
+                if self._stat() is None:
+                    self._bootstrap()
+                    self._sorted = None
+                    self._body = None
+            state = self._stat()
+        if state != self.file_state:
+            self._load()
+            self.file_state = state
+
+    def _append(self, record):
+        with self._write_lock():
+            self._refresh()
+            line = (json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8')
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            self._apply(record)
+            self.file_state = self._stat()
+            self._sorted = None
+            self._body = None
+            if self.ops > max(TEMPLATE_COMPACT_MIN_OPS, len(self.templates) * 2):
+                self._compact()
+
+    @property
+    def etag(self):
+        with self.lock:
+            self._refresh()
+            return '%x-%x' % self.file_state
+
+    def list(self):
+        """按更新时间倒序返回全部模板"""
+        with self.lock:
+            self._refresh()
+            if self._sorted is None:
+                self._sorted = sorted(self.templates.values(), key=_template_sort_key, reverse=True)
+            return self._sorted
+
+    def list_json(self):
+        """全部模板序列化后的 JSON（缓存到下一次写入）"""
+        with self.lock:
+            templates = self.list()
+            if self._body is None:
+                self._body = json.dumps(templates, ensure_ascii=False)
+            return self._body
+
+    def get(self, template_id):
+        with self.lock:
+            self._refresh()
+            return self.templates.get(str(template_id))
+
+    def matches(self, if_match):
+        """If-Match 中的任一 ETag 与当前版本一致时返回 True（/api/templates 的 ETag 带有查询参数后缀）"""
+        with self.lock:
+            etag = self.etag
+            return if_match.star_tag or any(tag == etag or tag.startswith(etag + '-') for tag in if_match)
+
+    def _check(self, if_match):
+        if if_match and not self.matches(if_match):
+            raise TemplateConflict('模板已被修改，请刷新后重试')
+
+    def put(self, template, if_match=None):
+        """新增或覆盖模板；传入 If-Match 时与当前版本比较，版本检查与写入在同一把锁内完成"""
+        with self._write_lock():
+            self._check(if_match)
+            now = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+            existing = self.get(template['id'])
+            template = dict(template, created_at=(existing or template).get('created_at') or now, updated_at=now)
+            self._append({'op': 'put', 'template': template})
+            return template
+
+    def update(self, template_id, fields, if_match=None):
+        """修改已有模板的字段，模板不存在时返回 None"""
+        with self._write_lock():
+            self._check(if_match)
+            existing = self.get(template_id)
+            if existing is None:
+                return None
+            return self.put(dict(existing, **fields))
+
+    def delete(self, template_id, if_match=None):
+        with self._write_lock():
+            self._check(if_match)
+            if self.get(template_id) is None:
+                return False
+            self._append({'op': 'delete', 'id': str(template_id)})
+            return True
+
+template_store = TemplateStore(TEMPLATE_STORE_FILE)
+
+def template_not_modified(etag):
+    """客户端缓存的 ETag 仍有效时返回 304 响应"""
+    if etag in request.if_none_match:
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    return None
+
+@app.route('/api/prompt-templates', methods=['GET'])
+def get_prompt_templates():
+    """获取所有提示词模板"""
+    etag = template_store.etag
+    not_modified = template_not_modified(etag)
+    if not_modified:
+        return not_modified
+    response = Response(template_store.list_json(), mimetype='application/json')
+    response.set_etag(etag)
+    return response
+
+@app.route('/api/prompt-templates', methods=['POST'])
+def add_prompt_template():
+    """新增提示词模板"""
+    data = request.json
+    new_template = template_store.put({
+        'id': str(uuid.uuid4()),
+        'name': data.get('name', '未命名模板'),
+        'description': data.get('description', ''),
+        'content': data.get('content', '')
+    })
+    return jsonify({'success': True, 'template': new_template})
+
+@app.route('/api/prompt-templates/<template_id>', methods=['DELETE'])
+def delete_prompt_template(template_id):
+    """删除指定ID的提示词模板"""
+    if not template_store.delete(template_id):
+        return jsonify({'success': False, 'error': '模板不存在'}), 404
+    return jsonify({'success': True})
+
+@app.route('/api/templates', methods=['GET'])
+def get_templates():
+    """获取提示词模板（按更新时间倒序分页，分页方式同 /api/projects）"""
+    etag = f'{template_store.etag}-{request.query_string.decode("ascii", "replace")}'
+    not_modified = template_not_modified(etag)
+    if not_modified:
+        return not_modified
+    try:
+        limit = min(max(int(request.args.get('limit', DEFAULT_PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify({'error': 'limit 参数必须是整数'}), 400
+    templates = template_store.list()
+    start = 0
+    cursor_arg = request.args.get('cursor')
+    if cursor_arg:
+        try:
+            after = tuple(decode_cursor(cursor_arg))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        # 列表按 (updated_at, id) 倒序，二分查找游标之后的第一条
+        lo, hi = 0, len(templates)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if _template_sort_key(templates[mid]) >= after:
+                lo = mid + 1
+            else:
+                hi = mid
+        start = lo
+    page = templates[start:start + limit]
+    response = jsonify(page)
+    if start + limit < len(templates):
+        response.headers['X-Next-Cursor'] = encode_cursor(*_template_sort_key(page[-1]))
+    response.set_etag(etag)
+    return response
+
+@app.route('/api/templates', methods=['POST'])
+def create_template():
+    """新建提示词模板"""
+    data = request.json
+    template = template_store.put({
+        'id': str(uuid.uuid4()),
+        'name': data.get('name', '新模板'),
+        'description': data.get('description', ''),
+        'content': data.get('content', '')
+    })
+    return jsonify(template)
+
+@app.route('/api/templates/<template_id>', methods=['PUT'])
+def update_template(template_id):
+    """编辑提示词模板（可带 If-Match，模板库在此期间被修改时返回 412）"""
+    data = request.json
+    try:
+        template = template_store.update(template_id, {
+            'name': data.get('name', ''),
+            'description': data.get('description', ''),
+            'content': data.get('content', '')
+        }, request.if_match)
+    except TemplateConflict as e:
+        return jsonify({'error': str(e)}), 412
+    if template is None:
+        return jsonify({'error': '模板不存在'}), 404
+    response = jsonify(template)
+    response.set_etag(template_store.etag)
+    return response
+
+@app.route('/api/templates/<template_id>', methods=['DELETE'])
+def delete_template(template_id):
+    """删除提示词模板（可带 If-Match）"""
+    try:
+        template_store.delete(template_id, request.if_match)
+    except TemplateConflict as e:
+        return jsonify({'error': str(e)}), 412
+    return jsonify({'success': True})
+# ================== End 提示词模板库 ==================
+
+# ================== 结果文件 ==================
+# 处理结果按完成顺序逐行追加到任务的 journal（同时作为逐行检查点），任务结束时按原始行顺序
+# 生成 data/results/<result_id>.jsonl[.gz]，前端通过下载接口流式获取
+RESULTS_DIR = os.path.join('data', 'results')
+JOURNAL_FSYNC_INTERVAL = 1.0
+
+def result_file_path(result_id, compress=False):
+    return os.path.join(RESULTS_DIR, f"{result_id}.jsonl" + ('.gz' if compress else ''))
+
+class ResultSink:
+    """处理结果的持久化日志（线程安全）
+
+    journal 每行格式为 `行序号\\t是否成功\\t结果JSON`，按完成顺序追加并逐行 flush；
+    重新打开已有 journal 时会恢复各行的完成状态并截掉崩溃时写了一半的尾行。
+    同一行多次写入（死信重跑、断点续跑）以最后一次为准。
+    """
+    STATUS_OK = 1
+    STATUS_ERROR = 2
+
+    def __init__(self, result_id, journal_path, compress=False, path=None):
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        self.result_id = result_id
+        self.compress = compress
+        self.path = path or result_file_path(result_id, compress)
+        self.journal_path = journal_path
+        self.lock = threading.Lock()
+        # 按行序号索引：journal 中最后一次写入的偏移量与状态
+        self.offsets = array('q')
+        self.status = bytearray()
+        if os.path.exists(journal_path):
+            self._load()
+        self.journal = open(journal_path, 'ab')
+        self.last_fsync = time.monotonic()
+
+    def _load(self):
+        offset = 0
+        with open(self.journal_path, 'rb') as f:
+            for line in f:
+                parts = line.split(b'\t', 2)
+                if not line.endswith(b'\n') or len(parts) != 3:
+                    break
+                self._record(int(parts[0]), offset, parts[1] == b'1')
+                offset += len(line)
+        os.truncate(self.journal_path, offset)
+
+    def _record(self, idx, offset, ok):
+        if idx >= len(self.offsets):
+            grow = idx + 1 - len(self.offsets)
+            self.offsets.extend([-1] * grow)
+            self.status.extend(bytes(grow))
+        self.offsets[idx] = offset
+        self.status[idx] = self.STATUS_OK if ok else self.STATUS_ERROR
+
+    @property
+    def success_count(self):
+        return self.status.count(self.STATUS_OK)
+
+    @property
+    def error_count(self):
+        return self.status.count(self.STATUS_ERROR)
+
+    def is_done(self, idx):
+        return idx < len(self.status) and self.status[idx] == self.STATUS_OK
+
+    def write(self, idx, item, ok=True):
+        line = b'%d\t%d\t' % (idx, 1 if ok else 0) + json.dumps(item, ensure_ascii=False).encode('utf-8') + b'\n'
+        with self.lock:
+            offset = self.journal.tell()
+            self.journal.write(line)
+            self.journal.flush()
+            self._record(idx, offset, ok)
+            now = time.monotonic()
+            if now - self.last_fsync >= JOURNAL_FSYNC_INTERVAL:
+                os.fsync(self.journal.fileno())
+                self.last_fsync = now
+
+    def close(self):
+        with self.lock:
+            if not self.journal.closed:
+                self.journal.flush()
+                os.fsync(self.journal.fileno())
+                self.journal.close()
+
+    def finalize(self, keep_journal=False):
+        """按原始行顺序生成结果文件并删除 journal（keep_journal=True 时保留），返回结果文件路径"""
+        self.close()
+        if self.compress:
+            out = gzip.open(self.path, 'wb')
+        else:
+            out = open(self.path, 'wb')
+        with open(self.journal_path, 'rb') as src, out:
+            for offset in self.offsets:
+                if offset < 0:
+                    continue
+                src.seek(offset)
+                out.write(src.readline().split(b'\t', 2)[2])
+        if not keep_journal:
+            os.remove(self.journal_path)
+        return self.path
+
+@app.route('/api/results/<result_id>', methods=['GET'])
+def download_result(result_id):
+    """下载处理结果文件（流式发送）"""
+    try:
+        result_id = str(uuid.UUID(result_id))
+    except ValueError:
+        return jsonify({'error': '结果文件不存在'}), 404
+    for compress in (False, True):
+        path = result_file_path(result_id, compress)
+        if os.path.exists(path):
+            download_name = request.args.get('name') or os.path.basename(path)
+            if compress and not download_name.endswith('.gz'):
+                download_name += '.gz'
+            return send_file(
+                os.path.abspath(path),
+                mimetype='application/gzip' if compress else 'application/jsonl',
+                as_attachment=True,
+                download_name=download_name
+            )
+    return jsonify({'error': '结果文件不存在'}), 404
+# ================== End 结果文件 ==================
+
+def sse_format(data, event_id=None):
+    """格式化为SSE消息（可带事件ID，客户端重连时通过 Last-Event-ID 传回）"""
+    import json
+    if event_id is not None:
+        return f"id: {event_id}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+    return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+# ================== 分片执行 ==================
+# 任务参数 shards > 1 时按字节范围把输入文件切成多个分片（边界对齐到行首），每个分片在进程池中的独立子进程
+# （spawn 启动，各自拥有解释器、执行引擎与连接池）中处理，JSON 解析、模板渲染、响应解码与结果序列化分摊到多个CPU核。
+# 子进程把结果写入各自的分片 journal 与结果文件，逐行事件经进程队列交给任务线程，汇总为同一个SSE进度流；
+# 任务结束时按分片顺序拼接各分片的结果文件（多个 gzip 成员直接拼接仍是合法的 gzip 文件）。
+# - 每个子进程的并发数为 max_workers / shards；rpm_limit、tpm_limit、max_concurrency 按分片数均分，总体限额不变
+# - 分片边界只取决于文件大小与分片数，断点续跑时各分片根据自己的 journal 跳过已完成的行
+# - 请求去重只在分片内生效；生成中的输出预览（stream_preview）在分片模式下不推送
+# - 事件中的行序号按分片之前的非空行数换算，输入中有无法解析的行时，其后分片的行序号比单进程模式略大
+SHARD_EVENT_QUEUE_SIZE = 10000
+
+def job_shards(shards):
+    """提交任务时确定分片数（不超过CPU核数）；分片数保存在任务配置中，续跑时沿用，与已有的分片 journal 保持一致"""
+    return max(1, min(int(shards or 1), os.cpu_count() or 1))
+
+def shard_paths(job_dir, shard):
+    """分片的 journal 与结果文件路径"""
+    return os.path.join(job_dir, f'shard-{shard}.journal'), os.path.join(job_dir, f'shard-{shard}.jsonl')
+
+def iter_byte_range(path, start, end):
+    """逐行读取文件中 [start, end) 字节范围内的行（start 需对齐到行首）"""
+    with open(path, 'rb') as f:
+        f.seek(start)
+        pos = start
+        for line in f:
+            if pos >= end:
+                break
+            pos += len(line)
+            yield line
+
+def split_shards(path, shards):
+    """按字节范围把输入文件切成最多 shards 个分片，边界对齐到行首
+
+    返回 (分片列表, 非空行总数)，分片为 (起始偏移, 结束偏移, 之前的文件行数, 之前的非空行数)；
+    文件较小时分片数可能少于 shards。
+    """
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, 'rb') as f:
+        for k in range(1, shards):
+            pos = max(size * k // shards, bounds[-1])
+            if pos > 0:
+                # 从目标位置的前一个字节读到行尾，得到下一行的行首
+                f.seek(pos - 1)
+                f.readline()
+                pos = f.tell()
+            if bounds[-1] < pos < size:
+                bounds.append(pos)
+        bounds.append(size)
+        # 一次顺序扫描统计每个分片之前的行数，用于把分片内的行号换算为全局行号
+        ranges = [(bounds[0], bounds[1], 0, 0)]
+        pos = lines = rows = 0
+        f.seek(0)
+        for line in f:
+            pos += len(line)
+            lines += 1
+            if line.strip():
+                rows += 1
+            if len(ranges) < len(bounds) - 1 and pos == bounds[len(ranges)]:
+                ranges.append((pos, bounds[len(ranges) + 1], lines, rows))
+    return ranges, rows
+
+def shard_api_config(api_config, shards):
+    """分片子进程使用的项目配置：速率限额与并发上限（含各端点的覆盖值）按分片数均分"""
+    def divide(config):
+        config = dict(config)
+        rpm = config.get('rpm_limit') or (config['rate_limit'] * 60 if config.get('rate_limit') else None)
+        config.pop('rate_limit', None)
+        if rpm:
+            config['rpm_limit'] = rpm / shards
+        if config.get('tpm_limit'):
+            config['tpm_limit'] = config['tpm_limit'] / shards
+        if config.get('max_concurrency'):
+            config['max_concurrency'] = max(1, int(config['max_concurrency']) // shards)
+        return config
+    config = divide(api_config)
+    if config.get('endpoints'):
+        config['endpoints'] = [divide(entry) for entry in config['endpoints']]
+    return config
+
+# 子进程中的事件队列与任务控制（由进程池的 initializer 设置）
+_shard_events = None
+_shard_control = None
+
+def _init_shard_worker(events, cancel_event, run_event):
+    global _shard_events, _shard_control
+    _shard_events = events
+    _shard_control = JobControl(cancel_event, run_event, reset=False)
+
+def run_shard(job_id, shard, shard_range, params, api_config, max_workers):
+    """在子进程中处理一个分片
+
+    结果写入分片 journal 与结果文件；逐行结果以 (全局行序号, {结果字段: 输出}, 错误, meta) 经事件队列回传，
+    解析失败的行以 ('parse_error', 全局文件行号, 错误) 回传，结束时（无论成败）回传 ('shard_done', 分片号)。
+    """
+    start, end, lines_before, rows_before = shard_range
+    job_dir = os.path.join(JOBS_DIR, job_id)
+    journal_path, output_path = shard_paths(job_dir, shard)
+    result_field_name = params.get('result_field_name', 'response')
+    sink = ResultSink(job_id, journal_path, params.get('output_format', 'jsonl') == 'jsonl.gz', path=output_path)
+    prompt_template = compile_template(params.get('prompt_template', ''))
+    fingerprints = FingerprintFilter(load_job_record(job_id)['project_id'], prompt_template, api_config, result_field_name,
+                                     params.get('incremental'))
+    def on_result(idx, item, processed_item, error, meta):
+        if meta.get('cancelled'):
+            return
+        fingerprints.tag(idx, error, meta)
+        started = time.perf_counter()
+        sink.write(idx, processed_item, not error)
+        add_timing(meta, 'write', time.perf_counter() - started)
+        output = '' if error else processed_item.get(result_field_name, '')
+        _shard_events.put((rows_before + idx, {result_field_name: output}, error, meta))
+    def on_parse_error(line_no, e):
+        _shard_events.put(('parse_error', lines_before + line_no, str(e)))
+    try:
+        tasks = ((idx, item) for idx, item in iter_jsonl(iter_byte_range(os.path.join(job_dir, 'input.jsonl'), start, end), on_parse_error)
+                 if not sink.is_done(idx))
+        tasks = dispatch_tasks(fingerprints.filter(tasks, on_result), params, prompt_template, api_config)
+        run_with_dead_letter(params.get('engine', 'thread'), tasks, prompt_template, api_config, result_field_name, max_workers,
+                             on_result, control=_shard_control)
+        # 保留 journal：其他分片失败后续跑时，已完成的分片据此跳过全部行；任务取消时生成已完成部分的结果
+        sink.finalize(keep_journal=True)
+    finally:
+        sink.close()
+        _shard_events.put(('shard_done', shard))
+
+def shard_job_control():
+    """分片模式的任务控制：状态保存在进程间共享的 Event 中，由各分片子进程直接读取"""
+    ctx = multiprocessing.get_context('spawn')
+    return JobControl(ctx.Event(), ctx.Event())
+
+def run_sharded(job_id, ranges, params, api_config, max_workers, on_event, control):
+    """在进程池中并行处理各分片，逐行事件按单进程模式的队列格式回调 on_event；任一分片失败时抛出异常
+
+    control 须由 shard_job_control() 创建。
+    """
+    ctx = multiprocessing.get_context('spawn')
+    # 有界队列：任务线程汇总不过来时子进程在回传处阻塞
+    events = ctx.Queue(maxsize=SHARD_EVENT_QUEUE_SIZE)
+    shard_config = shard_api_config(api_config, len(ranges))
+    workers = max(1, max_workers // len(ranges))
+    with ProcessPoolExecutor(max_workers=len(ranges), mp_context=ctx,
+                             initializer=_init_shard_worker, initargs=(events, control.cancel_event, control.run_event)) as pool:
+        futures = [pool.submit(run_shard, job_id, shard, shard_range, params, shard_config, workers)
+                   for shard, shard_range in enumerate(ranges)]
+        remaining = len(futures)
+        while remaining:
+            try:
+                event = events.get(timeout=1)
+            except queue.Empty:
+                # 子进程异常退出时收不到 shard_done
+                for future in futures:
+                    if future.done() and future.exception() is not None:
+                        raise future.exception()
+                continue
+            if event[0] == 'shard_done':
+                remaining -= 1
+                continue
+            if event[0] != 'parse_error' and not event[3].get('reused'):
+                # 子进程中的端点指标不可见，在本进程归集（复用上次结果的行未请求端点）
+                meta, error = event[3], event[2]
+                get_endpoint_metrics(api_config, meta.get('endpoint')).observe_row(meta, error)
+            on_event(event)
+        for future in futures:
+            future.result()
+
+class ShardedSink:
+    """分片模式的结果汇总：各分片的结果由子进程写入，这里负责恢复计数与按分片顺序拼接结果文件"""
+
+    def __init__(self, result_id, job_dir, shards, compress=False):
+        self.path = result_file_path(result_id, compress)
+        self.job_dir = job_dir
+        self.shards = shards
+        self.success_count = 0
+        for shard in range(shards):
+            journal_path, output_path = shard_paths(job_dir, shard)
+            if not os.path.exists(journal_path):
+                continue
+            # 子进程启动前读取，顺带截掉崩溃时写了一半的尾行
+            shard_sink = ResultSink(result_id, journal_path, compress, path=output_path)
+            self.success_count += shard_sink.success_count
+            shard_sink.close()
+
+    def close(self):
+        pass
+
+    def finalize(self):
+        """按分片顺序拼接各分片的结果文件，返回结果文件路径"""
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        with open(self.path, 'wb') as out:
+            for shard in range(self.shards):
+                _, output_path = shard_paths(self.job_dir, shard)
+                if os.path.exists(output_path):
+                    with open(output_path, 'rb') as src:
+                        shutil.copyfileobj(src, out, UPLOAD_CHUNK_SIZE)
+        return self.path
+# ================== End 分片执行 ==================
+
+# ================== 后台任务 ==================
+# process-stream 提交的任务记录在 processing_records 中（queued → processing → completed/failed/cancelled），
+# 由后台工作线程领取执行，与HTTP请求解耦：关闭页面或客户端断线不影响任务；
+# 暂停/取消接口把状态改为 paused/cancelling，执行任务的进程在每次心跳时按数据库状态同步任务控制
+# （本进程执行的任务立即生效），取消后生成已完成部分的结果文件并记为 cancelled。
+# 执行中的任务定期写入心跳与计数（检查点），进程崩溃后心跳超时的任务会被重新领取，
+# 并根据结果 journal 跳过已完成的行继续处理。
+# 事件推送与任务执行解耦：任务线程只把事件放入通道（不会被慢客户端阻塞），每个SSE连接按帧
+# （JOB_FRAME_INTERVAL）合并推送：日志合并为一个 logs 事件、进度只保留最新快照，跟不上的日志以 dropped 事件汇总。
+JOBS_DIR = os.path.join('data', 'jobs')
+JOB_WORKERS = int(os.environ.get('PROMPTFACTORY_JOB_WORKERS', 2))
+JOB_HEARTBEAT_INTERVAL = 2.0
+JOB_STALE_AFTER = 30.0
+JOB_EVENT_BUFFER = 1000
+JOB_FRAME_INTERVAL = 0.25
+JOB_FRAME_MAX_LOGS = 200
+# 流式模式下生成中的输出预览（partial 事件）：每行最多每 STREAM_PREVIEW_INTERVAL 秒推送一次，只推送末尾部分
+STREAM_PREVIEW_INTERVAL = 1.0
+STREAM_PREVIEW_CHARS = 500
+
+class JobChannel:
+    """单个任务的事件通道：保留最近的事件与最新进度快照，SSE客户端可随时（重新）订阅
+
+    进度事件不进入事件缓冲，只替换快照；其他事件按序号缓冲，序号连同通道的 epoch 作为SSE事件ID，
+    任务续跑时通道重建、epoch 改变，旧的 Last-Event-ID 不再适用。
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.events = deque(maxlen=JOB_EVENT_BUFFER)
+        self.seq = 0
+        self.progress = None
+        self.progress_version = 0
+        self.epoch = uuid.uuid4().hex[:8]
+        self.closed = False
+
+    def publish(self, event):
+        with self.cond:
+            if event['type'] == 'progress':
+                self.progress = event
+                self.progress_version += 1
+            else:
+                self.seq += 1
+                self.events.append((self.seq, event))
+            self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def event_id(self, seq):
+        return f'{self.epoch}-{seq}'
+
+    def resume_point(self, last_event_id):
+        """根据客户端的 Last-Event-ID 返回应从哪个序号之后继续推送"""
+        epoch, _, seq = (last_event_id or '').partition('-')
+        if epoch != self.epoch or not seq.isdigit():
+            return 0
+        return min(int(seq), self.seq)
+
+    def subscribe(self, after=0, keepalive=15):
+        """按帧产出序号大于 after 的事件：(帧内最后的序号, 事件列表)
+
+        每 JOB_FRAME_INTERVAL 秒最多一帧：进度快照有更新时放在帧首，连续的日志合并为 logs 事件，
+        同一行生成中的输出只保留最新一条；已被挤出缓冲或超过 JOB_FRAME_MAX_LOGS 条的日志只计数，
+        以 dropped 事件告知。空闲超过 keepalive 秒时产出 None，通道关闭且事件取完后结束。
+        """
+        progress_version = 0
+        last_frame = 0.0
+        while True:
+            with self.cond:
+                if not self.closed and self.seq <= after and self.progress_version == progress_version:
+                    self.cond.wait(timeout=keepalive)
+                closed = self.closed
+            # 距上一帧不足一个帧间隔时等待，期间到达的事件并入同一帧
+            delay = last_frame + JOB_FRAME_INTERVAL - time.monotonic()
+            if delay > 0 and not closed:
+                time.sleep(delay)
+            with self.cond:
+                oldest = self.events[0][0] if self.events else self.seq + 1
+                batch = [event for seq, event in self.events if seq > after]
+                progress = self.progress if self.progress_version != progress_version else None
+                progress_version = self.progress_version
+                seq = self.seq
+                closed = self.closed
+            if not batch and progress is None:
+                if closed:
+                    return
+                yield None
+                continue
+            last_frame = time.monotonic()
+            dropped = max(0, oldest - after - 1)
+            after = seq
+            skip = max(0, sum(1 for event in batch if event['type'] == 'log') - JOB_FRAME_MAX_LOGS)
+            dropped += skip
+            frame = [progress] if progress else []
+            if dropped:
+                frame.append({'type': 'dropped', 'count': dropped})
+            logs = None
+            partials = {}
+            for event in batch:
+                if event['type'] == 'log':
+                    partials.pop(event['line'], None)
+                    if skip:
+                        skip -= 1
+                        continue
+                    if logs is None:
+                        logs = {'type': 'logs', 'items': []}
+                        frame.append(logs)
+                    logs['items'].append(event)
+                    continue
+                if event['type'] == 'partial':
+                    partials[event['line']] = event
+                    continue
+                logs = None
+                frame.append(event)
+            # 生成中的输出放在结束事件（done/error）之前
+            tail = len(frame)
+            while tail and frame[tail - 1]['type'] in ('done', 'error') and 'line' not in frame[tail - 1]:
+                tail -= 1
+            frame[tail:tail] = partials.values()
+            yield seq, frame
+
+_job_channels = {}
+_job_channels_lock = threading.Condition()
+# 正在当前进程中执行的任务的控制（暂停/取消）
+_job_controls = {}
+_job_wakeup = threading.Event()
+_job_workers_started = False
+
+def get_job_channel(job_id, wait=0):
+    """获取在当前进程中执行的任务的事件通道，最多等待 wait 秒（不存在时返回 None）"""
+    with _job_channels_lock:
+        _job_channels_lock.wait_for(lambda: job_id in _job_channels, timeout=wait)
+        return _job_channels.get(job_id)
+
+def load_job_record(job_id):
+    """读取任务记录"""
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT id, project_id, file_name, total_lines, success_count, error_count, status, created_at,
+               job_config, processed_count, retry_count, result_id, error_message, cache_hits, cache_misses, dedup_count,
+               reused_count, sent_count
+        FROM processing_records
+        WHERE id = ?
+    ''', (job_id,))
+    row = cursor.fetchone()
+    conn.close()
+    if not row:
+        return None
+    return {
+        'id': row[0],
+        'project_id': row[1],
+        'file_name': row[2],
+        'total_lines': row[3],
+        'success_count': row[4],
+        'error_count': row[5],
+        'status': row[6],
+        'created_at': row[7],
+        'job_config': json.loads(row[8]) if row[8] else {},
+        'processed_count': row[9],
+        'retry_count': row[10],
+        'result_id': row[11],
+        'error_message': row[12],
+        'cache_hits': row[13] or 0,
+        'cache_misses': row[14] or 0,
+        'dedup_count': row[15] or 0,
+        'reused_count': row[16] or 0,
+        'sent_count': row[17] or 0
+    }
+
+def transition_job(job_id, from_statuses, to_status, **fields):
+    """仅当任务处于 from_statuses 之一时更新状态（条件更新，多进程安全），返回是否更新成功"""
+    conn = get_db()
+    cursor = conn.cursor()
+    assignments = ''.join(f', {name} = ?' for name in fields)
+    placeholders = ', '.join('?' * len(from_statuses))
+    cursor.execute(
+        f'UPDATE processing_records SET status = ?{assignments}, updated_at = CURRENT_TIMESTAMP '
+        f'WHERE id = ? AND status IN ({placeholders})',
+        (to_status, *fields.values(), job_id, *from_statuses)
+    )
+    conn.commit()
+    updated = cursor.rowcount == 1
+    conn.close()
+    return updated
+
+def fail_job(job_id, message):
+    """把执行中的任务标记为失败（条件更新）；失败前已收到取消请求的任务改为已取消，返回是否标记为失败"""
+    if transition_job(job_id, ('processing', 'paused'), 'failed', error_message=message):
+        return True
+    transition_job(job_id, ('cancelling',), 'cancelled', error_message=message)
+    return False
+
+@contextmanager
+def job_heartbeat(job_id):
+    """任务执行期间由后台线程定期刷新心跳，覆盖引擎结束后生成结果文件、淘汰指纹等不经过结果循环的阶段"""
+    stopped = threading.Event()
+    def beat():
+        while not stopped.wait(JOB_HEARTBEAT_INTERVAL):
+            update_job_record(job_id, heartbeat_at=time.time())
+    thread = threading.Thread(target=beat, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stopped.set()
+        thread.join()
+
+def update_job_record(job_id, **fields):
+    """更新任务记录的指定字段"""
+    conn = get_db()
+    cursor = conn.cursor()
+    assignments = ', '.join(f'{name} = ?' for name in fields)
+    cursor.execute(
+        f'UPDATE processing_records SET {assignments}, updated_at = CURRENT_TIMESTAMP WHERE id = ?',
+        (*fields.values(), job_id)
+    )
+    conn.commit()
+    conn.close()
+
+# 正在当前进程中执行的任务的实时指标
+_job_metrics = {}
+
+@app.route('/api/processing-records/<record_id>/stats', methods=['GET'])
+def get_processing_record_stats(record_id):
+    """获取处理记录（任务）的各阶段耗时统计；执行中的任务返回实时数据"""
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute('SELECT status, stats FROM processing_records WHERE id = ?', (record_id,))
+    row = cursor.fetchone()
+    conn.close()
+    if not row:
+        return jsonify({'error': '记录不存在'}), 404
+    metrics = _job_metrics.get(record_id)
+    stats = metrics.snapshot() if metrics else (json.loads(row[1]) if row[1] else None)
+    return jsonify({'id': record_id, 'status': row[0], 'stats': stats})
+
+def create_job(project_id, file, job_config):
+    """保存上传文件并创建排队中的任务，返回任务ID"""
+    job_id = str(uuid.uuid4())
+    job_dir = os.path.join(JOBS_DIR, job_id)
+    os.makedirs(job_dir, exist_ok=True)
+    spool_upload(file, os.path.join(job_dir, 'input.jsonl'))
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT INTO processing_records (id, project_id, file_name, success_count, error_count, status,
+                                        job_config, processed_count, retry_count)
+        VALUES (?, ?, ?, 0, 0, 'queued', ?, 0, 0)
+    ''', (job_id, project_id, file.filename, json.dumps(job_config, ensure_ascii=False)))
+    conn.commit()
+    conn.close()
+    _job_wakeup.set()
+    return job_id
+
+def claim_job():
+    """领取一个排队中或心跳超时的任务，返回任务ID；没有可领取的任务时返回 None"""
+    conn = get_db()
+    cursor = conn.cursor()
+    try:
+        now = time.time()
+        # 取消中的任务所在进程崩溃后同样重新领取，直接生成已完成部分的结果
+        cursor.execute('''
+            SELECT id FROM processing_records
+            WHERE status = 'queued' OR (status IN ('processing', 'cancelling') AND heartbeat_at < ?)
+            ORDER BY created_at
+            LIMIT 5
+        ''', (now - JOB_STALE_AFTER,))
+        with _job_channels_lock:
+            running = set(_job_channels)
+        for (job_id,) in cursor.fetchall():
+            if job_id in running:
+                # 仍在本进程中执行（如正在生成结果文件）的任务不重复领取
+                continue
+            # 条件更新保证多个进程/线程不会领取同一个任务
+            cursor.execute('''
+                UPDATE processing_records
+                SET status = CASE status WHEN 'cancelling' THEN 'cancelling' ELSE 'processing' END, heartbeat_at = ?
+                WHERE id = ? AND (status = 'queued' OR (status IN ('processing', 'cancelling') AND heartbeat_at < ?))
+            ''', (now, job_id, now - JOB_STALE_AFTER))
+            conn.commit()
+            if cursor.rowcount == 1:
+                return job_id
+        return None
+    finally:
+        conn.close()
+
+def run_job(job_id):
+    """执行（或断点续跑）一个后台任务"""
+    channel = JobChannel()
+    with _job_channels_lock:
+        _job_channels[job_id] = channel
+        _job_channels_lock.notify_all()
+    try:
+        with job_heartbeat(job_id):
+            _run_job(job_id, channel)
+    except Exception as e:
+        logger.exception('任务执行异常', extra={'fields': {'job_id': job_id}})
+        if fail_job(job_id, str(e)):
+            channel.publish({'type': 'error', 'error': f'任务执行异常: {str(e)}'})
+        else:
+            channel.publish(job_done_event(load_job_record(job_id)))
+    finally:
+        channel.close()
+        _job_metrics.pop(job_id, None)
+        _job_controls.pop(job_id, None)
+        with _job_channels_lock:
+            _job_channels.pop(job_id, None)
+
+def job_api_config(params, api_config):
+    """应用任务级的缓存与去重开关"""
+    api_config = dict(api_config)
+    if params.get('bypass_cache') and response_cache_mode(api_config):
+        api_config['response_cache'] = 'refresh'
+    if 'dedup' in params:
+        api_config['dedup'] = params['dedup']
+    return api_config
+
+def _run_job(job_id, channel):
+    record = load_job_record(job_id)
+    params = record['job_config']
+    api_config = load_project_api_config(record['project_id'])
+    try:
+        if api_config is None:
+            raise ValueError('项目不存在')
+        api_config = job_api_config(params, api_config)
+        variants = resolve_variants(params, api_config)
+    except ValueError as e:
+        if fail_job(job_id, str(e)):
+            channel.publish({'type': 'error', 'error': str(e)})
+        else:
+            channel.publish(job_done_event(load_job_record(job_id)))
+        return
+    prompt_template = compile_template(params.get('prompt_template', ''))
+    result_field_name = params.get('result_field_name', 'response')
+    max_workers = int(params.get('max_workers', 10))
+    engine = params.get('engine', 'thread')
+    compress = params.get('output_format', 'jsonl') == 'jsonl.gz'
+    job_dir = os.path.join(JOBS_DIR, job_id)
+    input_path = os.path.join(job_dir, 'input.jsonl')
+    with open(input_path, 'rb') as f:
+        sample = first_jsonl_row(f)
+    for template in [variant['prompt_template'] for variant in variants] or [prompt_template]:
+        warning = template_warning(template, sample)
+        if warning:
+            channel.publish({'type': 'info', 'message': warning})
+    # 变体模式在单进程中执行；分片数沿用提交时确定的值（换到CPU核数不同的机器上续跑时不变）
+    shards = int(params.get('shards') or 1) if not variants else 1
+    log_event(logging.INFO, '任务开始', job_id=job_id, project_id=record['project_id'], file_name=record['file_name'],
+              engine=engine, max_workers=max_workers, shards=shards, resumed=bool(record['processed_count']))
+    
+    if shards > 1:
+        sink = ShardedSink(job_id, job_dir, shards, compress)
+        control = shard_job_control()
+    else:
+        sink = ResultSink(job_id, os.path.join(job_dir, 'results.journal'), compress)
+        control = JobControl()
+    _job_controls[job_id] = control
+    if record['status'] == 'cancelling':
+        control.cancel()
+    # 断点续跑：journal 中成功的行直接跳过，失败的行重新处理
+    success_count = sink.success_count
+    if success_count:
+        channel.publish({'type': 'info', 'message': f'从检查点恢复，跳过已完成的 {success_count} 行'})
+    error_count = 0
+    processed_count = success_count
+    retry_count = record['retry_count'] or 0
+    cache_hits = record['cache_hits']
+    cache_misses = record['cache_misses']
+    dedup_count = record['dedup_count']
+    reused_count = record['reused_count']
+    sent_count = record['sent_count']
+    # 成功行的指纹与结果，随检查点批量写入指纹索引（多变体任务不记录）
+    fingerprints = FingerprintFilter(record['project_id'], prompt_template, api_config, result_field_name,
+                                     params.get('incremental')) if not variants else None
+    fingerprint_rows = []
+    parse_errors = 0
+    metrics = _job_metrics[job_id] = PhaseMetrics()
+    endpoint_metrics = get_endpoint_metrics(api_config)
+    # 总行数由后台线程统计（分片模式在切分时统计），统计完成前进度中的 total 为 None，不阻塞首批请求
+    counted = {'total': None}
+    def count_rows():
+        with open(input_path, 'rb') as f:
+            counted['total'] = count_jsonl_rows(f)
+    if shards == 1:
+        threading.Thread(target=count_rows, daemon=True).start()
+    # 引擎在后台线程中边解析边派发，逐行结果经队列交给任务线程汇总
+    q = queue.Queue()
+    engine_errors = []
+    def on_result(idx, item, processed_item, error, meta):
+        if fingerprints is not None:
+            fingerprints.tag(idx, error, meta)
+        q.put((idx, processed_item, error, meta))
+    def on_parse_error(line_no, e):
+        q.put(('parse_error', line_no, str(e)))
+    # 生成中的输出由引擎线程直接按行节流推送，不经过结果队列
+    partials = {}
+    partials_lock = threading.Lock()
+    def on_partial(idx, delta):
+        with partials_lock:
+            if delta is None:
+                partials.pop(idx, None)
+                return
+            entry = partials.setdefault(idx, [[], 0.0])
+            entry[0].append(delta)
+            now = time.monotonic()
+            if now - entry[1] < STREAM_PREVIEW_INTERVAL:
+                return
+            entry[1] = now
+            text = ''.join(entry[0])
+            entry[0] = [text]
+        channel.publish({'type': 'partial', 'line': idx+1, 'output': text[-STREAM_PREVIEW_CHARS:], 'chars': len(text)})
+    def row_output(processed_item):
+        if not variants:
+            return processed_item.get(result_field_name, '')
+        return '\n'.join(f"[{variant['result_field_name']}] {processed_item.get(variant['result_field_name'], '')}" for variant in variants)
+    stream_preview = bool(params.get('stream_preview') and api_config.get('stream')) and shards == 1 and not variants
+    def run_engine():
+        try:
+            if shards > 1:
+                ranges, counted['total'] = split_shards(input_path, shards)
+                run_sharded(job_id, ranges, params, api_config, max_workers, q.put, control)
+                return
+            with open(input_path, 'rb') as f:
+                tasks = ((idx, item) for idx, item in iter_jsonl(f, on_parse_error) if not sink.is_done(idx))
+                if variants:
+                    run_fanout(engine, tasks, variants, params, max_workers, on_result, control)
+                    return
+                tasks = dispatch_tasks(fingerprints.filter(tasks, on_result), params, prompt_template, api_config)
+                run_with_dead_letter(engine, tasks, prompt_template, api_config, result_field_name, max_workers, on_result,
+                                     on_partial if stream_preview else None, control)
+        except Exception as e:
+            engine_errors.append(str(e))
+        finally:
+            q.put(None)
+    endpoint_pool = get_endpoint_pool(api_config)
+    threading.Thread(target=run_engine, daemon=True).start()
+    
+    def total_rows():
+        return counted['total'] - parse_errors if counted['total'] is not None else None
+    def checkpoint(**fields):
+        save_fingerprints(fingerprint_rows)
+        fingerprint_rows.clear()
+        update_job_record(
+            job_id,
+            heartbeat_at=time.time(),
+            total_lines=total_rows(),
+            processed_count=processed_count,
+            success_count=success_count,
+            error_count=error_count,
+            retry_count=retry_count,
+            cache_hits=cache_hits,
+            cache_misses=cache_misses,
+            dedup_count=dedup_count,
+            reused_count=reused_count,
+            sent_count=sent_count,
+            stats=json.dumps(metrics.snapshot()),
+            **fields
+        )
+    def sync_control():
+        """按数据库中的任务状态同步暂停/取消（由其他进程处理的接口请求经此生效）"""
+        status = (load_job_record(job_id) or {}).get('status')
+        if status == 'cancelling' and not control.cancelled:
+            control.cancel()
+        elif status == 'paused' and not control.paused and not control.cancelled:
+            control.pause()
+        elif status == 'processing' and control.paused:
+            control.resume()
+        else:
+            return
+        channel.publish({'type': 'state', 'status': status})
+    last_checkpoint = time.monotonic()
+    while True:
+        try:
+            res = q.get(timeout=JOB_HEARTBEAT_INTERVAL)
+        except queue.Empty:
+            res = ()
+        if time.monotonic() - last_checkpoint >= JOB_HEARTBEAT_INTERVAL:
+            checkpoint()
+            sync_control()
+            last_checkpoint = time.monotonic()
+        if res is None:
+            break
+        if not res:
+            continue
+        if res[0] == 'parse_error':
+            _, line_no, message = res
+            parse_errors += 1
+            channel.publish({'type': 'error', 'line': line_no, 'error': f'第{line_no}行JSON解析失败: {message}'})
+            continue
+        idx, processed_item, error, meta = res
+        if stream_preview:
+            with partials_lock:
+                partials.pop(idx, None)
+        if meta.get('cancelled'):
+            # 取消时中止的行不写入结果，续跑语义上等同于未处理
+            continue
+        phase = meta.get('phase', 'main')
+        attempts = meta.get('attempts', 1)
+        retry_count += max(0, attempts - 1)
+        if meta.get('dedup') and phase == 'main':
+            dedup_count += 1
+        if meta.get('reused'):
+            reused_count += 1
+        # 按实际发出的HTTP请求计数（含重试、死信重跑与各变体的请求；缓存命中、去重与复用的行不计）
+        sent_count += meta.get('requests', 0)
+        if meta.get('cache') == 'hit':
+            cache_hits += 1
+        elif meta.get('cache') == 'miss':
+            cache_misses += 1
+        if phase == 'main':
+            processed_count += 1
+        elif not error:
+            # 死信重跑成功，原先计入的失败转为成功
+            error_count -= 1
+        if error:
+            if phase == 'main':
+                error_count += 1
+            channel.publish({'type': 'log', 'line': idx+1, 'status': 'error', 'output': '', 'error': error, 'attempts': attempts, 'phase': phase})
+        else:
+            success_count += 1
+            if meta.get('fingerprint'):
+                fingerprint_rows.append((record['project_id'], meta['fingerprint'], processed_item.get(result_field_name), job_id,
+                                         fingerprints.config_hash))
+            channel.publish({'type': 'log', 'line': idx+1, 'status': 'success', 'output': row_output(processed_item), 'error': '', 'attempts': attempts, 'phase': phase})
+        metrics.observe_row(meta, error)
+        if shards == 1:
+            # 失败的行同样保留（结果字段为错误信息），便于下载后排查；分片模式由子进程写入，写入耗时已计入 meta
+            started = time.perf_counter()
+            sink.write(idx, processed_item, not error)
+            elapsed = time.perf_counter() - started
+            metrics.observe('write', elapsed)
+            endpoint_metrics.observe('write', elapsed)
+        # 推送进度（分片模式下并发由各子进程分别调节，不推送）
+        channel.publish({'type': 'progress', 'current': processed_count, 'total': total_rows(), 'success': success_count, 'error': error_count, 'retries': retry_count, 'cache_hits': cache_hits, 'cache_misses': cache_misses,
+                         'deduplicated': dedup_count, 'dedup_ratio': round(dedup_count / processed_count, 4),
+                         'cached_token_ratio': metrics.cached_ratio(), 'reused': reused_count, 'sent': sent_count,
+                         'phase': phase, 'concurrency': endpoint_pool.concurrency() if shards == 1 else None})
+    
+    if control.cancelled:
+        # 已完成的行（含失败行）照常生成结果文件
+        result_id = None
+        if processed_count:
+            sink.finalize()
+            result_id = job_id
+        else:
+            sink.close()
+        checkpoint(status='cancelled', result_id=result_id)
+        shutil.rmtree(job_dir, ignore_errors=True)
+        log_event(logging.INFO, '任务已取消', job_id=job_id, success=success_count, error=error_count)
+        channel.publish(job_done_event(load_job_record(job_id)))
+        return
+    if engine_errors:
+        # 保留 journal 与输入文件，修复问题后可通过 resume 接口继续
+        sink.close()
+        checkpoint()
+        log_event(logging.ERROR, '执行引擎异常', job_id=job_id, error=engine_errors[0])
+        if fail_job(job_id, engine_errors[0]):
+            channel.publish({'type': 'error', 'error': f'执行引擎异常: {engine_errors[0]}'})
+            return
+        shutil.rmtree(job_dir, ignore_errors=True)
+        channel.publish(job_done_event(load_job_record(job_id)))
+        return
+    if processed_count == 0:
+        sink.close()
+        checkpoint()
+        shutil.rmtree(job_dir, ignore_errors=True)
+        if fail_job(job_id, '文件中没有有效的JSON数据'):
+            channel.publish({'type': 'error', 'error': '文件中没有有效的JSON数据'})
+        else:
+            channel.publish(job_done_event(load_job_record(job_id)))
+        return
+    sink.finalize()
+    counted['total'] = processed_count + parse_errors
+    checkpoint()
+    # 条件更新：引擎结束后才落地的取消请求不会被 completed 覆盖，此时结果已完整生成，按已取消保留
+    if not transition_job(job_id, ('processing', 'paused'), 'completed', result_id=job_id):
+        transition_job(job_id, ('cancelling',), 'cancelled', result_id=job_id)
+    if fingerprints is not None and fingerprints.config_hash:
+        # 本次任务的模板与配置取代项目中此前的指纹
+        pruned = prune_fingerprints(record['project_id'], fingerprints.config_hash)
+        if pruned:
+            log_event(logging.INFO, '淘汰指纹索引', job_id=job_id, project_id=record['project_id'], deleted=pruned)
+    shutil.rmtree(job_dir, ignore_errors=True)
+    log_event(logging.INFO, '任务完成', job_id=job_id, success=success_count, error=error_count, retries=retry_count,
+              cache_hits=cache_hits, deduplicated=dedup_count, reused=reused_count, sent=sent_count)
+    # 处理完成，推送结果文件下载地址
+    channel.publish(job_done_event(load_job_record(job_id)))
+
+def job_done_event(record):
+    """根据任务记录构造 done 事件（已取消的任务为 cancelled 事件，带已完成部分的结果）"""
+    return {
+        'type': 'cancelled' if record['status'] == 'cancelled' else 'done',
+        'job_id': record['id'],
+        'file_name': record['file_name'],
+        'success': record['success_count'],
+        'error': record['error_count'],
+        'total': record['total_lines'],
+        'retries': record['retry_count'] or 0,
+        'cache_hits': record['cache_hits'],
+        'cache_misses': record['cache_misses'],
+        'deduplicated': record['dedup_count'],
+        'reused': record['reused_count'],
+        'sent': record['sent_count'],
+        'result_id': record['result_id'],
+        'download_url': f"/api/results/{record['result_id']}" if record['result_id'] else None,
+        'compressed': record['job_config'].get('output_format') == 'jsonl.gz'
+    }
+
+def job_worker():
+    """后台工作线程：循环领取并执行任务"""
+    while True:
+        job_id = claim_job()
+        if job_id is None:
+            _job_wakeup.wait(timeout=JOB_HEARTBEAT_INTERVAL)
+            _job_wakeup.clear()
+            continue
+        run_job(job_id)
+
+def start_job_workers():
+    """启动后台任务工作线程（每个进程只启动一次）"""
+    global _job_workers_started
+    if _job_workers_started:
+        return
+    _job_workers_started = True
+    for _ in range(JOB_WORKERS):
+        threading.Thread(target=job_worker, daemon=True).start()
+
+def stream_job_events(job_id, last_event_id=None):
+    """任务事件的SSE生成器
+
+    任务在当前进程执行时直接订阅事件通道（每帧一次写出，帧内最后一条消息带事件ID，
+    携带 last_event_id 重连时从该事件之后继续）；尚未被领取、由其他进程执行或已结束时，
+    每秒从数据库读取进度快照，直到任务结束或开始在当前进程执行。
+    """
+    yield sse_format({'type': 'job', 'job_id': job_id})
+    while True:
+        channel = get_job_channel(job_id)
+        if channel is not None:
+            # 通道关闭前的最后一个事件即为 done/error
+            for frame in channel.subscribe(channel.resume_point(last_event_id)):
+                if frame is None:
+                    yield ': keepalive\n\n'
+                    continue
+                seq, events = frame
+                yield ''.join(sse_format(event) for event in events[:-1]) + sse_format(events[-1], channel.event_id(seq))
+            return
+        record = load_job_record(job_id)
+        if record is None:
+            yield sse_format({'type': 'error', 'error': '任务不存在'})
+            return
+        if record['status'] in ('completed', 'cancelled'):
+            yield sse_format(job_done_event(record))
+            return
+        if record['status'] == 'failed':
+            yield sse_format({'type': 'error', 'error': record['error_message'] or '任务执行失败'})
+            return
+        yield sse_format({
+            'type': 'progress',
+            'current': record['processed_count'] or 0,
+            'total': record['total_lines'],
+            'success': record['success_count'] or 0,
+            'error': record['error_count'] or 0,
+            'retries': record['retry_count'] or 0,
+            'cache_hits': record['cache_hits'],
+            'cache_misses': record['cache_misses'],
+            'deduplicated': record['dedup_count'],
+            'reused': record['reused_count'],
+            'sent': record['sent_count'],
+            'status': record['status']
+        })
+        # 等待任务在当前进程开始执行（由其他进程执行时每秒刷新一次快照）
+        get_job_channel(job_id, wait=1)
+
+@app.route('/api/process-stream/<project_id>', methods=['POST'])
+def process_stream(project_id):
+    """提交批量处理任务，并以SSE流式推送进度和日志"""
+    # 先把所有 request 相关数据取出来
+    job_config = {
+        'prompt_template': request.form.get('prompt_template', ''),
+        'result_field_name': request.form.get('result_field_name', 'response'),
+        'max_workers': int(request.form.get('max_workers', 10)),
+        'engine': request.form.get('engine', 'thread'),
+        'output_format': request.form.get('output_format', 'jsonl'),
+        'bypass_cache': request.form.get('bypass_cache') in ('1', 'true', 'on'),
+        'dedup': request.form.get('dedup', '1') in ('1', 'true', 'on'),
+        'stream_preview': request.form.get('stream_preview') in ('1', 'true', 'on'),
+        'shards': job_shards(request.form.get('shards')),
+        'dispatch_order': request.form.get('dispatch_order', 'file'),
+        'incremental': request.form.get('incremental') in ('1', 'true', 'on')
+    }
+    file = request.files.get('file')
+    if not file:
+        def error_gen():
+            yield sse_format({'type': 'error', 'error': '未上传文件'})
+        return Response(error_gen(), mimetype='text/event-stream')
+    try:
+        job_config['variants'] = parse_variants(request.form.get('variants'))
+        for n, variant in enumerate(job_config['variants'] or [], 1):
+            if variant.get('project_id') and load_project_api_config(variant['project_id']) is None:
+                raise ValueError(f'变体{n}的项目不存在')
+        if job_config['variants'] and job_config['incremental']:
+            raise ValueError('增量处理不支持多变体对比任务')
+    except ValueError as e:
+        message = str(e)
+        def error_gen():
+            yield sse_format({'type': 'error', 'error': message})
+        return Response(error_gen(), mimetype='text/event-stream')
+    if job_config['engine'] not in ENGINES:
+        def error_gen():
+            yield sse_format({'type': 'error', 'error': f"不支持的执行引擎: {job_config['engine']}"})
+        return Response(error_gen(), mimetype='text/event-stream')
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute('SELECT 1 FROM projects WHERE id = ?', (project_id,))
+    row = cursor.fetchone()
+    conn.close()
+    if not row:
+        def error_gen():
+            yield sse_format({'type': 'error', 'error': '项目不存在'})
+        return Response(error_gen(), mimetype='text/event-stream')
+    job_id = create_job(project_id, file, job_config)
+    return Response(stream_job_events(job_id), mimetype='text/event-stream')
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """获取任务状态"""
+    record = load_job_record(job_id)
+    if not record:
+        return jsonify({'error': '任务不存在'}), 404
+    return jsonify(record)
+
+@app.route('/api/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    """重新订阅任务的SSE事件流（支持 Last-Event-ID 请求头或 last_event_id 参数断点续传）"""
+    if not load_job_record(job_id):
+        return jsonify({'error': '任务不存在'}), 404
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    return Response(stream_job_events(job_id, last_event_id), mimetype='text/event-stream')
+
+@app.route('/api/jobs/<job_id>/resume', methods=['POST'])
+def resume_job(job_id):
+    """继续暂停的任务；失败的任务重新排队，从检查点继续处理"""
+    record = load_job_record(job_id)
+    if not record:
+        return jsonify({'error': '任务不存在'}), 404
+    if record['status'] == 'paused':
+        # 执行进程已崩溃时改回 processing 后心跳超时，会被重新领取
+        if not transition_job(job_id, ('paused',), 'processing'):
+            return jsonify({'error': '任务状态已变化，请刷新后重试'}), 409
+        notify_job_control(job_id, 'processing')
+        return jsonify({'message': '任务已继续'})
+    if record['status'] != 'failed' or not os.path.exists(os.path.join(JOBS_DIR, job_id, 'input.jsonl')):
+        return jsonify({'error': '只能继续暂停的任务，或恢复输入文件仍存在的失败任务'}), 400
+    update_job_record(job_id, status='queued', error_message=None)
+    _job_wakeup.set()
+    return jsonify({'message': '任务已重新排队'})
+
+@app.route('/api/jobs/<job_id>/pause', methods=['POST'])
+def pause_job(job_id):
+    """暂停任务：停止派发新行，已在途的行照常完成，已完成的结果不受影响"""
+    if not load_job_record(job_id):
+        return jsonify({'error': '任务不存在'}), 404
+    if not transition_job(job_id, ('processing',), 'paused'):
+        return jsonify({'error': '只能暂停处理中的任务'}), 400
+    notify_job_control(job_id, 'paused')
+    return jsonify({'message': '任务已暂停'})
+
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    """取消任务：排队中的任务直接取消；执行中的任务停止派发、中止在途请求，并生成已完成部分的结果"""
+    if not load_job_record(job_id):
+        return jsonify({'error': '任务不存在'}), 404
+    if transition_job(job_id, ('queued',), 'cancelled'):
+        shutil.rmtree(os.path.join(JOBS_DIR, job_id), ignore_errors=True)
+        return jsonify({'message': '任务已取消'})
+    if not transition_job(job_id, ('processing', 'paused'), 'cancelling'):
+        return jsonify({'error': '任务已结束'}), 400
+    notify_job_control(job_id, 'cancelling')
+    return jsonify({'message': '正在取消任务'})
+
+def notify_job_control(job_id, status):
+    """任务在当前进程执行时立即应用状态变更（其他进程在下次心跳时同步）"""
+    control = _job_controls.get(job_id)
+    if control is None:
+        return
+    if status == 'cancelling':
+        control.cancel()
+    elif status == 'paused':
+        control.pause()
+    else:
+        control.resume()
+    channel = get_job_channel(job_id)
+    if channel is not None:
+        channel.publish({'type': 'state', 'status': status})
+# ================== End 后台任务 ==================
+
+# 分片子进程导入本模块时不启动任务线程
+if multiprocessing.parent_process() is None:
+    start_job_workers()
 
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5001, use_reloader=False) 
\ No newline at end of file
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""
+生成基准测试用的合成 JSONL 文件
+
+    python bench/generate_jsonl.py --rows 100000 --text-chars 500 --duplicate-ratio 0.1 -o bench/data/100k.jsonl
+"""
+import argparse
+import json
+import random
+import string
+
+
+def generate(path, rows, text_chars=200, duplicate_ratio=0.0, seed=0, prefix_groups=0):
+    """写入 rows 行 {"id", "text", "category"}；duplicate_ratio 比例的行复用之前出现过的 text
+
+    prefix_groups > 0 时每行的 text 由随机选取的 prefix_groups 篇共享文档之一加上该行独有的问题组成（同一文档多次提问）。
+    """
+    rng = random.Random(seed)
+    alphabet = string.ascii_lowercase + ' ' * 5
+    texts = []
+    documents = [''.join(rng.choices(alphabet, k=text_chars)) for _ in range(prefix_groups)]
+    with open(path, 'w', encoding='utf-8') as f:
+        for i in range(rows):
+            if documents:
+                text = rng.choice(documents) + f'\n问题{i}：' + ''.join(rng.choices(alphabet, k=20))
+            elif texts and rng.random() < duplicate_ratio:
+                text = rng.choice(texts)
+            else:
+                text = f'{i} ' + ''.join(rng.choices(alphabet, k=text_chars))
+                if len(texts) < 10000:
+                    texts.append(text)
+            f.write(json.dumps({'id': i, 'text': text, 'category': f'c{i % 10}'}, ensure_ascii=False) + '\n')
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description='生成合成 JSONL 数据')
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--text-chars', type=int, default=200, help='每行 text 字段长度')
+    parser.add_argument('--duplicate-ratio', type=float, default=0.0, help='重复 text 的比例')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--prefix-groups', type=int, default=0, help='共享文档数（0 为每行独立生成）')
+    parser.add_argument('-o', '--output', required=True)
+    args = parser.parse_args()
+    generate(args.output, args.rows, args.text_chars, args.duplicate_ratio, args.seed, args.prefix_groups)
+
+
+if __name__ == '__main__':
+    main()
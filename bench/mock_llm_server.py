@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+"""
+本地 OpenAI 兼容模拟服务（基准测试用）
+
+POST /v1/chat/completions 按配置的延迟分布、错误率、429 比例与响应长度返回结果，
+请求体 stream 为 true 时以SSE分块返回（延迟分布作为首个token延迟），GET /stats 返回累计请求计数。
+同时模拟 OpenAI 兼容的批处理接口（POST /v1/files、POST /v1/batches、GET /v1/batches/{id}、
+GET /v1/files/{id}/content、POST /v1/batches/{id}/cancel）：任务创建后经过 --batch-delay 秒完成，按错误率生成失败行。
+--prefix-cache N 时模拟服务端前缀缓存：与最近 N 个提示词的最长公共前缀（按 PREFIX_BLOCK_TOKENS 个 token 对齐）
+计为命中缓存，在 usage.prompt_tokens_details.cached_tokens 中返回。
+
+    python bench/mock_llm_server.py --port 8900 --latency lognormal:0.2,0.5 --error-rate 0.01 --rate-429 0.02 --response-chars 500
+"""
+import argparse
+import json
+import math
+import random
+import threading
+import time
+import uuid
+from collections import deque
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def parse_latency(spec):
+    """解析延迟分布，返回采样函数（单位：秒）
+
+    const:0.1 | uniform:0.05,0.2 | lognormal:中位数,sigma | exp:均值
+    """
+    kind, _, args = spec.partition(':')
+    values = [float(v) for v in args.split(',')] if args else []
+    if kind == 'const':
+        return lambda: values[0]
+    if kind == 'uniform':
+        return lambda: random.uniform(values[0], values[1])
+    if kind == 'lognormal':
+        mu = math.log(values[0])
+        return lambda: random.lognormvariate(mu, values[1])
+    if kind == 'exp':
+        return lambda: random.expovariate(1 / values[0])
+    raise ValueError(f'不支持的延迟分布: {spec}')
+
+
+# 模拟前缀缓存的块大小（token），与 vLLM 默认的 KV 块大小一致
+PREFIX_BLOCK_TOKENS = 16
+
+
+def common_prefix_len(a, b):
+    """两个字符串的公共前缀长度（二分比较切片）"""
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+class MockState:
+    def __init__(self, latency, error_rate, rate_429, response_chars, retry_after, chunk_chars=20, chunk_interval=0.005,
+                 batch_delay=1.0, prefix_cache=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_429 = rate_429
+        self.response_chars = response_chars
+        self.retry_after = retry_after
+        self.chunk_chars = chunk_chars
+        self.chunk_interval = chunk_interval
+        self.batch_delay = batch_delay
+        self.recent_prompts = deque(maxlen=prefix_cache) if prefix_cache else None
+        self.lock = threading.RLock()
+        self.counts = {'requests': 0, 'ok': 0, 'error': 0, 'throttled': 0, 'connections': 0, 'batches': 0, 'batch_requests': 0,
+                       'prompt_tokens': 0, 'cached_tokens': 0}
+        self.files = {}
+        self.batches = {}
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.counts[key] += n
+
+    def completion(self, prompt):
+        """生成模拟的模型输出与 usage"""
+        content = ('echo:' + prompt)[:self.response_chars].ljust(self.response_chars, '.')
+        usage = {
+            'prompt_tokens': len(prompt) // 2 + 1,
+            'completion_tokens': len(content) // 2 + 1,
+            'total_tokens': (len(prompt) + len(content)) // 2 + 2
+        }
+        if self.recent_prompts is not None:
+            with self.lock:
+                matched = max((common_prefix_len(prompt, other) for other in self.recent_prompts), default=0)
+                self.recent_prompts.append(prompt)
+            cached = matched // 2 // PREFIX_BLOCK_TOKENS * PREFIX_BLOCK_TOKENS
+            usage['prompt_tokens_details'] = {'cached_tokens': cached}
+            self.count('prompt_tokens', usage['prompt_tokens'])
+            self.count('cached_tokens', cached)
+        return content, usage
+
+    def add_file(self, data, purpose):
+        file_id = 'file-' + uuid.uuid4().hex[:12]
+        with self.lock:
+            self.files[file_id] = data
+        return {'id': file_id, 'object': 'file', 'bytes': len(data), 'purpose': purpose}
+
+    def run_batch(self, batch):
+        """后台执行批处理任务：延迟 batch_delay 秒后逐行生成结果"""
+        time.sleep(self.batch_delay / 2)
+        with self.lock:
+            if batch['status'] == 'cancelling':
+                batch['status'] = 'cancelled'
+                return
+            batch['status'] = 'in_progress'
+        outputs, errors = [], []
+        for line in self.files[batch['input_file_id']].splitlines():
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                prompt = request['body']['messages'][0]['content']
+            except (ValueError, KeyError, IndexError, TypeError):
+                with self.lock:
+                    batch['status'] = 'failed'
+                    batch['errors'] = {'data': [{'code': 'invalid_request', 'message': '输入文件格式错误'}]}
+                return
+            record = {'id': 'batch_req_' + uuid.uuid4().hex[:12], 'custom_id': request.get('custom_id'), 'error': None}
+            if random.random() < self.error_rate:
+                record['response'] = {'status_code': 500, 'body': {'error': {'message': 'mock server error'}}}
+                errors.append(record)
+            else:
+                content, usage = self.completion(prompt)
+                record['response'] = {'status_code': 200, 'body': {
+                    'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+                    'usage': usage
+                }}
+                outputs.append(record)
+        time.sleep(self.batch_delay / 2)
+        self.count('batch_requests', len(outputs) + len(errors))
+        with self.lock:
+            if batch['status'] == 'cancelling':
+                batch['status'] = 'cancelled'
+                return
+            # 输出顺序与输入无关，调用方需按 custom_id 对应
+            random.shuffle(outputs)
+            dump = lambda records: '\n'.join(json.dumps(r, ensure_ascii=False) for r in records).encode('utf-8') + b'\n'
+            if outputs:
+                batch['output_file_id'] = self.add_file(dump(outputs), 'batch_output')['id']
+            if errors:
+                batch['error_file_id'] = self.add_file(dump(errors), 'batch_output')['id']
+            batch['request_counts'] = {'total': len(outputs) + len(errors), 'completed': len(outputs), 'failed': len(errors)}
+            batch['status'] = 'completed'
+
+
+def make_handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def setup(self):
+            super().setup()
+            state.count('connections')
+
+        def log_message(self, *args):
+            pass
+
+        def send_json(self, status, body, headers=None):
+            data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def send_stream(self, content, usage):
+            """以 chunked 编码逐块发送 chat.completion.chunk 事件"""
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+
+            def write_event(body):
+                data = ('data: ' + (body if isinstance(body, str) else json.dumps(body, ensure_ascii=False)) + '\n\n').encode('utf-8')
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+                self.wfile.flush()
+
+            chunk = {'id': 'mock', 'object': 'chat.completion.chunk', 'model': 'mock'}
+            try:
+                for start in range(0, len(content), state.chunk_chars):
+                    if start:
+                        time.sleep(state.chunk_interval)
+                    write_event(dict(chunk, choices=[{'index': 0, 'delta': {'content': content[start:start + state.chunk_chars]}, 'finish_reason': None}]))
+                write_event(dict(chunk, choices=[{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]))
+                if usage:
+                    write_event(dict(chunk, choices=[], usage=usage))
+                write_event('[DONE]')
+                self.wfile.write(b'0\r\n\r\n')
+            except (BrokenPipeError, ConnectionResetError):
+                # 客户端超时后主动断开
+                self.close_connection = True
+
+        def do_GET(self):
+            if self.path == '/stats':
+                with state.lock:
+                    self.send_json(200, dict(state.counts))
+            elif self.path.startswith('/v1/batches/'):
+                batch = state.batches.get(self.path.rsplit('/', 1)[-1])
+                if not batch:
+                    self.send_json(404, {'error': {'message': 'batch not found'}})
+                    return
+                with state.lock:
+                    batch = dict(batch)
+                self.send_json(200, batch)
+            elif self.path.startswith('/v1/files/') and self.path.endswith('/content'):
+                data = state.files.get(self.path.split('/')[3])
+                if data is None:
+                    self.send_json(404, {'error': {'message': 'file not found'}})
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/jsonl')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+            else:
+                self.send_json(404, {'error': 'not found'})
+
+        def handle_batch_api(self, body):
+            if self.path == '/v1/files':
+                # multipart/form-data：purpose + file
+                message = BytesParser().parsebytes(b'Content-Type: ' + self.headers['Content-Type'].encode() + b'\r\n\r\n' + body)
+                fields = {part.get_param('name', header='content-disposition'): part.get_payload(decode=True)
+                          for part in message.get_payload()}
+                self.send_json(200, state.add_file(fields.get('file') or b'', (fields.get('purpose') or b'').decode()))
+            elif self.path == '/v1/batches':
+                request = json.loads(body)
+                if request.get('input_file_id') not in state.files:
+                    self.send_json(400, {'error': {'message': 'input file not found'}})
+                    return
+                batch = {
+                    'id': 'batch_' + uuid.uuid4().hex[:12], 'object': 'batch', 'endpoint': request.get('endpoint'),
+                    'input_file_id': request['input_file_id'], 'completion_window': request.get('completion_window'),
+                    'status': 'validating', 'created_at': int(time.time()), 'output_file_id': None, 'error_file_id': None,
+                    'request_counts': {'total': 0, 'completed': 0, 'failed': 0}
+                }
+                with state.lock:
+                    state.batches[batch['id']] = batch
+                state.count('batches')
+                threading.Thread(target=state.run_batch, args=(batch,), daemon=True).start()
+                self.send_json(200, dict(batch))
+            elif self.path.startswith('/v1/batches/') and self.path.endswith('/cancel'):
+                batch = state.batches.get(self.path.split('/')[3])
+                if not batch:
+                    self.send_json(404, {'error': {'message': 'batch not found'}})
+                    return
+                with state.lock:
+                    if batch['status'] in ('validating', 'in_progress'):
+                        batch['status'] = 'cancelling'
+                    self.send_json(200, dict(batch))
+            else:
+                self.send_json(404, {'error': {'message': 'not found'}})
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            if not self.path.endswith('/chat/completions'):
+                self.handle_batch_api(body)
+                return
+            state.count('requests')
+            roll = random.random()
+            if roll < state.rate_429:
+                state.count('throttled')
+                self.send_json(429, {'error': {'message': 'rate limited'}}, {'Retry-After': str(state.retry_after)})
+                return
+            time.sleep(state.latency())
+            if roll < state.rate_429 + state.error_rate:
+                state.count('error')
+                self.send_json(500, {'error': {'message': 'mock server error'}})
+                return
+            try:
+                request = json.loads(body)
+                prompt = request['messages'][0]['content']
+            except (ValueError, KeyError, IndexError):
+                self.send_json(400, {'error': {'message': 'bad request'}})
+                return
+            content, usage = state.completion(prompt)
+            state.count('ok')
+            if request.get('stream'):
+                self.send_stream(content, usage if (request.get('stream_options') or {}).get('include_usage') else None)
+                return
+            self.send_json(200, {
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+                'usage': usage
+            })
+
+    return Handler
+
+
+def add_arguments(parser):
+    parser.add_argument('--latency', default='const:0.05', help='延迟分布，如 const:0.1、uniform:0.05,0.2、lognormal:0.2,0.5、exp:0.1')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='返回 500 的比例')
+    parser.add_argument('--rate-429', type=float, default=0.0, help='返回 429 的比例')
+    parser.add_argument('--retry-after', type=float, default=0.1, help='429 响应的 Retry-After（秒）')
+    parser.add_argument('--response-chars', type=int, default=200, help='响应内容长度（字符）')
+    parser.add_argument('--chunk-chars', type=int, default=20, help='流式响应每块的字符数')
+    parser.add_argument('--chunk-interval', type=float, default=0.005, help='流式响应相邻块的间隔（秒）')
+    parser.add_argument('--batch-delay', type=float, default=1.0, help='批处理任务从创建到完成的时间（秒）')
+    parser.add_argument('--prefix-cache', type=int, default=0, help='模拟前缀缓存保留的最近提示词数（0 为不模拟）')
+
+
+class MockHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # listen() 在构造函数中调用，积压队列长度须在类属性上设置；默认的5在数百个并发连接同时建立时会被内核重置
+    request_queue_size = 1024
+
+
+def create_server(host, port, args):
+    state = MockState(parse_latency(args.latency), args.error_rate, args.rate_429, args.response_chars, args.retry_after,
+                      args.chunk_chars, args.chunk_interval, args.batch_delay, args.prefix_cache)
+    return MockHTTPServer((host, port), make_handler(state))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='本地 OpenAI 兼容模拟服务')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    add_arguments(parser)
+    args = parser.parse_args()
+    server = create_server(args.host, args.port, args)
+    print(f'mock LLM server listening on http://{args.host}:{server.server_port}/v1/chat/completions', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+吞吐量基准测试
+
+启动本地模拟服务（子进程），在临时目录中加载应用，通过 Flask 测试客户端驱动
+process_file（同步处理）或 process_stream（后台任务）接口，输出行/秒、各阶段 p99、峰值 RSS 与 CPU。
+
+    python bench/run_bench.py --rows 10000 --mode process_stream --engine thread --workers 50 --latency lognormal:0.2,0.5
+    python bench/run_bench.py --rows 10000 --engine async --workers 500 --json bench/results.jsonl
+
+性能相关的改动请附上本脚本的前后对比数据。
+"""
+import argparse
+import io
+import json
+import os
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from generate_jsonl import generate  # noqa: E402
+from mock_llm_server import add_arguments  # noqa: E402
+
+
+def start_mock_server(args):
+    """以子进程启动模拟服务，返回 (进程, API地址)"""
+    cmd = [
+        sys.executable, os.path.join(BENCH_DIR, 'mock_llm_server.py'), '--port', '0',
+        '--latency', args.latency, '--error-rate', str(args.error_rate), '--rate-429', str(args.rate_429),
+        '--retry-after', str(args.retry_after), '--response-chars', str(args.response_chars),
+        '--chunk-chars', str(args.chunk_chars), '--chunk-interval', str(args.chunk_interval),
+        '--batch-delay', str(args.batch_delay), '--prefix-cache', str(args.prefix_cache)
+    ]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True)
+    match = re.search(r'(http://\S+)', proc.stdout.readline())
+    if not match:
+        proc.kill()
+        raise RuntimeError('模拟服务启动失败')
+    return proc, match.group(1)
+
+
+def mock_stats(api_url):
+    base = api_url.split('/v1/')[0]
+    with urllib.request.urlopen(f'{base}/stats') as resp:
+        return json.load(resp)
+
+
+def read_events(body):
+    return [json.loads(line[5:]) for line in body.splitlines() if line.startswith('data:')]
+
+
+def usage():
+    ru = resource.getrusage(resource.RUSAGE_SELF)
+    # 已退出的子进程（分片进程池）的CPU时间；模拟服务在测试结束后才回收，不计入
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return ru.ru_utime + ru.ru_stime + children.ru_utime + children.ru_stime, ru.ru_maxrss
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix='pf-bench-')
+    data_path = args.input or generate(os.path.join(workdir, 'input.jsonl'), args.rows, args.text_chars, args.duplicate_ratio,
+                                        prefix_groups=args.prefix_groups)
+    proc, api_url = start_mock_server(args)
+    try:
+        os.chdir(workdir)
+        os.environ.setdefault('PROMPTFACTORY_LOG_LEVEL', 'WARNING')
+        sys.path.insert(0, ROOT_DIR)
+        import app as pf
+
+        if args.engine not in pf.ENGINES:
+            raise SystemExit(f'未知的执行引擎: {args.engine}（可选: {", ".join(pf.ENGINES)}）')
+        api_config = {'api_url': api_url, 'modelName': 'mock', 'response_cache': False}
+        api_config.update(json.loads(args.api_config))
+        client = pf.app.test_client()
+        project_id = client.post('/api/projects', json={'name': 'bench', 'api_config': api_config}).json['id']
+        with open(data_path, 'rb') as f:
+            payload = f.read()
+        form = {
+            'file': (io.BytesIO(payload), 'bench.jsonl'),
+            'prompt_template': args.template,
+            'result_field_name': 'response',
+            'max_workers': str(args.workers),
+            'engine': args.engine,
+            'shards': str(args.shards),
+            'dispatch_order': args.dispatch_order
+        }
+
+        cpu_before, _ = usage()
+        started = time.perf_counter()
+        if args.mode == 'process_file':
+            resp = client.post(f'/api/projects/{project_id}/process', data=form, content_type='multipart/form-data')
+            result = resp.json
+            record_id = result.get('record_id')
+            rows, errors = result.get('total_lines'), result.get('error_count')
+        else:
+            resp = client.post(f'/api/process-stream/{project_id}', data=form, content_type='multipart/form-data')
+            events = read_events(resp.get_data(as_text=True))
+            done = [e for e in events if e['type'] == 'done']
+            if not done:
+                raise RuntimeError(f'任务未完成: {events[-1] if events else resp.status_code}')
+            record_id = done[0]['job_id']
+            rows, errors = done[0]['total'], done[0]['error']
+        elapsed = time.perf_counter() - started
+        cpu_after, max_rss = usage()
+
+        stats = client.get(f'/api/processing-records/{record_id}/stats').json.get('stats') or {}
+        phases = stats.get('phases', {})
+        report = {
+            'mode': args.mode,
+            'engine': args.engine,
+            'workers': args.workers,
+            'shards': args.shards,
+            'dispatch_order': args.dispatch_order,
+            'rows': rows,
+            'errors': errors,
+            'latency': args.latency,
+            'error_rate': args.error_rate,
+            'rate_429': args.rate_429,
+            'elapsed_s': round(elapsed, 3),
+            'rows_per_s': round(rows / elapsed, 1) if elapsed else None,
+            'http_p50_ms': round(phases['http']['p50'] * 1000, 1) if 'http' in phases else None,
+            'http_p99_ms': round(phases['http']['p99'] * 1000, 1) if 'http' in phases else None,
+            'phase_p99_ms': {name: round(p['p99'] * 1000, 3) for name, p in phases.items() if p['p99'] is not None},
+            'peak_rss_mb': round(max_rss / 1024, 1),
+            'cpu_s': round(cpu_after - cpu_before, 2),
+            'cached_token_ratio': (stats.get('tokens') or {}).get('cached_ratio'),
+            'cpu_pct': round((cpu_after - cpu_before) / elapsed * 100, 1) if elapsed else None,
+            'server': mock_stats(api_url)
+        }
+        return report
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='PromptFactory 吞吐量基准测试')
+    parser.add_argument('--mode', choices=['process_file', 'process_stream'], default='process_stream')
+    parser.add_argument('--engine', default='thread', help='执行引擎（app.ENGINES 中的任一项）')
+    parser.add_argument('--workers', type=int, default=20)
+    parser.add_argument('--shards', type=int, default=1, help='分片进程数（仅 process_stream）')
+    parser.add_argument('--rows', type=int, default=2000)
+    parser.add_argument('--text-chars', type=int, default=200)
+    parser.add_argument('--duplicate-ratio', type=float, default=0.0)
+    parser.add_argument('--prefix-groups', type=int, default=0, help='共享文档数（生成同一文档多次提问的数据）')
+    parser.add_argument('--dispatch-order', choices=['file', 'prefix'], default='file', help='派发顺序（仅 process_stream）')
+    parser.add_argument('--input', help='使用已有的 JSONL 文件代替生成数据')
+    parser.add_argument('--template', default='请总结以下内容：{{text}}')
+    parser.add_argument('--api-config', default='{}', help='额外的 api_config（JSON）')
+    parser.add_argument('--json', help='将结果追加写入该 JSONL 文件')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    report = run(args)
+    for key, value in report.items():
+        print(f'{key:>14}: {value}')
+    if args.json:
+        with open(os.path.join(ROOT_DIR, args.json) if not os.path.isabs(args.json) else args.json, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(dict(report, ts=time.strftime('%Y-%m-%d %H:%M:%S')), ensure_ascii=False) + '\n')
+
+
+if __name__ == '__main__':
+    main()
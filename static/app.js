@@ -6,10 +6,17 @@ let fileData = null;
 let variables = [];
 let promptEditor = null;
 let isProcessing = false;
-let shouldCancel = false;
 let promptTemplates = [];
 let templates = [];
+let templatesEtag = null; // 模板列表加载时的版本，编辑/删除时以 If-Match 提交
 let currentTemplate = null;
+let projectsCursor = null;
+let historyRecords = [];
+let historyCursor = null;
+
+// 列表接口每页条数（服务端通过 X-Next-Cursor 响应头返回下一页游标）
+const PAGE_SIZE = 50;
+const HISTORY_PAGE_SIZE = 20;
 
 // DOM元素
 const views = {
@@ -56,12 +63,17 @@ function setupEventListeners() {
     
     // 执行控制
     const startBtn = document.getElementById('startBtn');
+    const pauseBtn = document.getElementById('pauseBtn');
     const cancelBtn = document.getElementById('cancelBtn');
     
     if (startBtn) {
         startBtn.addEventListener('click', startProcessing);
     }
     
+    if (pauseBtn) {
+        pauseBtn.addEventListener('click', togglePauseProcessing);
+    }
+    
     if (cancelBtn) {
         cancelBtn.addEventListener('click', cancelProcessing);
     }
@@ -107,12 +119,15 @@ function showView(viewName) {
     }
 }
 
-// 加载项目列表
-async function loadProjects() {
+// 加载项目列表（more 为 true 时加载下一页并追加）
+async function loadProjects(more = false) {
     try {
-        const response = await fetch('/api/projects');
+        const cursor = more && projectsCursor ? `&cursor=${encodeURIComponent(projectsCursor)}` : '';
+        const response = await fetch(`/api/projects?limit=${PAGE_SIZE}${cursor}`);
         if (response.ok) {
-            projects = await response.json();
+            const page = await response.json();
+            projects = more ? projects.concat(page) : page;
+            projectsCursor = response.headers.get('X-Next-Cursor');
             renderProjects();
         } else {
             let errorMsg = '加载项目列表失败';
@@ -161,7 +176,11 @@ function renderProjects() {
                 <button class="btn btn-danger" onclick="event.stopPropagation(); deleteProject('${project.id}')">删除</button>
             </div>
         </div>
-    `).join('');
+    `).join('') + (projectsCursor ? `
+        <div class="load-more">
+            <button class="btn btn-secondary" onclick="loadProjects(true)">加载更多</button>
+        </div>
+    ` : '');
 }
 
 // 显示创建项目
@@ -259,15 +278,18 @@ function renderProjectConfig() {
     `;
 }
 
-// 加载处理历史
-async function loadProcessingHistory() {
+// 加载处理历史（按页加载，more 为 true 时追加下一页）
+async function loadProcessingHistory(more = false) {
     if (!currentProject) return;
     
     try {
-        const response = await fetch(`/api/processing-records?project_id=${currentProject.id}`);
+        const cursor = more && historyCursor ? `&cursor=${encodeURIComponent(historyCursor)}` : '';
+        const response = await fetch(`/api/processing-records?project_id=${currentProject.id}&limit=${HISTORY_PAGE_SIZE}${cursor}`);
         if (response.ok) {
-            const records = await response.json();
-            renderProcessingHistory(records);
+            const page = await response.json();
+            historyRecords = more ? historyRecords.concat(page) : page;
+            historyCursor = response.headers.get('X-Next-Cursor');
+            renderProcessingHistory(historyRecords);
         }
     } catch (error) {
         console.error('加载处理历史失败:', error);
@@ -289,15 +311,20 @@ function renderProcessingHistory(records) {
             <div class="history-info">
                 <div class="history-file">${record.file_name}</div>
                 <div class="history-stats">
-                    总行数: ${record.total_lines} | 
+                    总行数: ${record.total_lines ?? '-'} | 
                     成功: ${record.success_count} | 
                     失败: ${record.error_count} | 
                     时间: ${formatDate(record.created_at)}
                 </div>
             </div>
             <div class="history-status ${record.status}">${getStatusText(record.status)}</div>
+            ${record.result_id ? `<a class="btn btn-secondary btn-sm" href="/api/results/${record.result_id}?name=${encodeURIComponent('processed_' + record.file_name)}">下载结果</a>` : ''}
         </div>
-    `).join('');
+    `).join('') + (historyCursor ? `
+        <div class="load-more">
+            <button class="btn btn-secondary btn-sm" onclick="loadProcessingHistory(true)">加载更多</button>
+        </div>
+    ` : '');
 }
 
 // 编辑项目
@@ -320,6 +347,7 @@ function editProject(projectId = null) {
     document.getElementById('editMaxTokens').value = apiConfig.max_tokens || '1000';
     document.getElementById('editTimeout').value = apiConfig.timeout || '30';
     document.getElementById('editRateLimit').value = apiConfig.rate_limit || '5';
+    document.getElementById('editStream').checked = !!apiConfig.stream;
     if (promptEditor) promptEditor.setValue(currentProject.prompt_template || '');
 }
 
@@ -328,14 +356,17 @@ async function saveProject() {
     const projectData = {
         name: document.getElementById('editProjectName').value,
         description: document.getElementById('editProjectDescription').value,
+        // 保留表单之外的高级配置（连接池等）
         api_config: {
+            ...((currentProject && currentProject.api_config) || {}),
             api_url: document.getElementById('editApiUrl').value,
             modelName: document.getElementById('editModelName').value,
             apiKey: document.getElementById('editApiKey').value,
             temperature: parseFloat(document.getElementById('editTemperature').value),
             max_tokens: parseInt(document.getElementById('editMaxTokens').value),
             timeout: parseInt(document.getElementById('editTimeout').value),
-            rate_limit: parseInt(document.getElementById('editRateLimit').value)
+            rate_limit: parseInt(document.getElementById('editRateLimit').value),
+            stream: document.getElementById('editStream').checked
         },
         prompt_template: promptEditor ? promptEditor.getValue() : ''
     };
@@ -421,6 +452,7 @@ function showProjectList() {
 function startQuickProcess() {
     if (!currentProject) return;
     showView('processingView');
+    reattachJob(currentProject.id);
 }
 
 // 文件上传处理
@@ -605,12 +637,18 @@ async function testPrompt() {
             body: JSON.stringify({
                 project_id: currentProject.id,
                 prompt_template: prompt,
-                test_data: testData
+                test_data: testData,
+                stream: true
             })
         });
         
-        const result = await response.json();
+        // 项目启用流式响应时服务端返回SSE，边生成边显示
+        const contentType = response.headers.get('Content-Type') || '';
+        const result = contentType.startsWith('text/event-stream') ? await readTestPromptStream(response) : await response.json();
         
+        if (result.missing_variables && result.missing_variables.length > 0) {
+            log('info', `以下模板变量在测试数据中不存在: ${result.missing_variables.join(', ')}`);
+        }
         if (response.ok && result.success) {
             document.getElementById('apiResponse').textContent = result.response;
             document.getElementById('testResult').style.display = 'block';
@@ -628,83 +666,215 @@ async function testPrompt() {
     }
 }
 
+// 读取测试提示词的SSE响应，返回 done 事件
+async function readTestPromptStream(response) {
+    const apiResponse = document.getElementById('apiResponse');
+    apiResponse.textContent = '';
+    document.getElementById('testResult').style.display = 'block';
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let pending = '';
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        pending += decoder.decode(value, { stream: true });
+        const events = pending.split(/\n\n/);
+        pending = events.pop();
+        for (const evt of events) {
+            if (!evt.startsWith('data:')) continue;
+            const msg = JSON.parse(evt.replace(/^data:/, '').trim());
+            if (msg.type === 'delta') {
+                apiResponse.textContent += msg.text;
+            } else if (msg.type === 'reset') {
+                // 上游请求失败重试，丢弃已显示的部分输出
+                apiResponse.textContent = '';
+            } else if (msg.type === 'done') {
+                return msg;
+            }
+        }
+    }
+    return { success: false, error: '连接已断开' };
+}
+
 // ========== SSE 实时处理流 ==========
 async function startProcessingSSE() {
     if (!fileData || !promptEditor || !currentProject) {
         showError('请先上传文件并编写提示词');
         return;
     }
-    isProcessing = true;
-    shouldCancel = false;
-    const startBtn = document.getElementById('startBtn');
-    const cancelBtn = document.getElementById('cancelBtn');
-    const progressContainer = document.querySelector('.progress-container');
-    if (startBtn) startBtn.style.display = 'none';
-    if (cancelBtn) cancelBtn.style.display = 'inline-flex';
-    if (progressContainer) progressContainer.style.display = 'block';
-    const logOutput = document.getElementById('logOutput');
-    if (logOutput) logOutput.innerHTML = '';
+    resetProcessingView();
     // 构造formData
     const formData = new FormData();
     formData.append('file', fileData.file);
     formData.append('prompt_template', promptEditor.getValue());
     formData.append('result_field_name', document.getElementById('resultFieldName').value || 'response');
     formData.append('max_workers', document.getElementById('maxWorkers').value || '10');
+    formData.append('engine', document.getElementById('engineSelect').value || 'thread');
+    formData.append('shards', document.getElementById('shardCount').value || '1');
+    formData.append('dispatch_order', document.getElementById('dispatchOrder').value || 'file');
+    formData.append('variants', document.getElementById('variantsConfig').value.trim());
+    formData.append('output_format', document.getElementById('outputFormat').value || 'jsonl');
+    formData.append('bypass_cache', document.getElementById('bypassCache').checked ? '1' : '0');
+    formData.append('dedup', document.getElementById('dedupRequests').checked ? '1' : '0');
+    formData.append('incremental', document.getElementById('incrementalRun').checked ? '1' : '0');
+    formData.append('stream_preview', document.getElementById('streamPreview').checked ? '1' : '0');
     // 发送请求，获取SSE流
     const xhr = new XMLHttpRequest();
     xhr.open('POST', `/api/process-stream/${currentProject.id}`);
+    consumeJobStream(xhr, currentProject.id);
+    xhr.send(formData);
+}
+
+// 重新订阅后台运行中的任务（页面刷新或断线后）
+function reattachJob(projectId) {
+    const jobId = localStorage.getItem(`activeJob_${projectId}`);
+    if (!jobId || isProcessing) return;
+    resetProcessingView();
+    log('info', `重新连接后台任务 ${jobId}`);
+    const xhr = new XMLHttpRequest();
+    xhr.open('GET', `/api/jobs/${jobId}/events`);
+    consumeJobStream(xhr, projectId);
+    xhr.send();
+}
+
+function resetProcessingView() {
+    isProcessing = true;
+    const startBtn = document.getElementById('startBtn');
+    const cancelBtn = document.getElementById('cancelBtn');
+    const progressContainer = document.querySelector('.progress-container');
+    if (startBtn) startBtn.style.display = 'none';
+    if (cancelBtn) cancelBtn.style.display = 'inline-flex';
+    setPauseButton(false, true);
+    if (progressContainer) progressContainer.style.display = 'block';
+    const logOutput = document.getElementById('logOutput');
+    if (logOutput) logOutput.innerHTML = '';
+}
+
+// 解析任务的SSE响应并更新界面；连接意外断开时携带 Last-Event-ID 自动重连，从断点继续接收
+function consumeJobStream(xhr, projectId, view = null) {
+    const startBtn = document.getElementById('startBtn');
+    const cancelBtn = document.getElementById('cancelBtn');
+    const jobKey = `activeJob_${projectId}`;
+    // 日志区状态在重连之间保留；partialRows 为生成中的行（partial 事件），该行结果到达后移除
+    view = view || { logBuffer: [], partialRows: new Map(), dropped: 0, lastEventId: null, reconnects: 0, cachedTokenRatio: null };
     xhr.responseType = 'text';
-    let received = '';
-    let processedData = [];
-    let logBuffer = [];
+    let received = 0;
+    let pending = '';
+    const addLog = (msg) => {
+        view.logBuffer.push(msg);
+        view.partialRows.delete(msg.line);
+    };
+    const finish = () => {
+        localStorage.removeItem(jobKey);
+        isProcessing = false;
+        if (startBtn) startBtn.style.display = 'inline-flex';
+        if (cancelBtn) cancelBtn.style.display = 'none';
+        setPauseButton(false, false);
+    };
     xhr.onreadystatechange = function() {
         if (xhr.readyState === 3 || xhr.readyState === 4) {
-            let chunk = xhr.responseText.substring(received.length);
-            received = xhr.responseText;
-            // 按SSE格式分割
-            const events = chunk.split(/\n\n/).filter(Boolean);
+            pending += xhr.responseText.substring(received);
+            received = xhr.responseText.length;
+            // 按SSE格式分割，最后一段可能不完整，留到下次处理
+            const events = pending.split(/\n\n/);
+            pending = events.pop();
+            let logsChanged = false;
             for (const evt of events) {
-                if (!evt.startsWith('data:')) continue;
-                const json = evt.replace(/^data:/, '').trim();
+                let json = '';
+                for (const line of evt.split('\n')) {
+                    if (line.startsWith('data:')) json += line.slice(5).trim();
+                    else if (line.startsWith('id:')) view.lastEventId = line.slice(3).trim();
+                }
+                if (!json) continue;
                 let msg;
                 try { msg = JSON.parse(json); } catch { continue; }
-                if (msg.type === 'log') {
-                    // 日志区只保留100条
-                    logBuffer.push(msg);
-                    if (logBuffer.length > 100) logBuffer = logBuffer.slice(-100);
-                    renderLogBuffer(logBuffer);
+                view.reconnects = 0;
+                if (msg.type === 'job') {
+                    localStorage.setItem(jobKey, msg.job_id);
+                } else if (msg.type === 'logs') {
+                    msg.items.forEach(addLog);
+                    logsChanged = true;
+                } else if (msg.type === 'log') {
+                    addLog(msg);
+                    logsChanged = true;
+                } else if (msg.type === 'dropped') {
+                    // 推送过快或连接较慢时服务端省略的日志条数
+                    view.dropped += msg.count;
+                    logsChanged = true;
+                } else if (msg.type === 'partial') {
+                    view.partialRows.set(msg.line, msg);
+                    logsChanged = true;
                 } else if (msg.type === 'progress') {
                     updateProgress(msg.current, msg.total, msg.success, msg.error);
+                    if (msg.cached_token_ratio != null) view.cachedTokenRatio = msg.cached_token_ratio;
+                    if (msg.status) setPauseButton(msg.status === 'paused', true);
+                } else if (msg.type === 'state') {
+                    setPauseButton(msg.status === 'paused', msg.status !== 'cancelling');
+                    log('info', { paused: '任务已暂停，已在途的行处理完后停止', processing: '任务已继续', cancelling: '正在取消任务...' }[msg.status] || msg.status);
+                } else if (msg.type === 'info') {
+                    log('info', msg.message);
                 } else if (msg.type === 'done') {
-                    processedData = msg.processed_data || [];
-                    log('success', `处理完成！成功: ${msg.success}, 失败: ${msg.error}`);
-                    isProcessing = false;
-                    if (startBtn) startBtn.style.display = 'inline-flex';
-                    if (cancelBtn) cancelBtn.style.display = 'none';
-                    downloadResults(processedData);
+                    finish();
+                    log('success', `处理完成！成功: ${msg.success}, 失败: ${msg.error}, 重试: ${msg.retries || 0}次, 缓存命中: ${msg.cache_hits || 0}行, 重复合并: ${msg.deduplicated || 0}行` +
+                        (msg.reused ? `, 复用上次结果: ${msg.reused}行, 实际请求: ${msg.sent}次` : '') +
+                        (view.cachedTokenRatio != null ? `, 前缀缓存命中: ${(view.cachedTokenRatio * 100).toFixed(1)}% token` : ''));
+                    downloadResults(msg.download_url, msg.compressed, msg.file_name);
+                } else if (msg.type === 'cancelled') {
+                    finish();
+                    log('info', `任务已取消，已完成: 成功 ${msg.success}, 失败 ${msg.error}`);
+                    if (msg.download_url) downloadResults(msg.download_url, msg.compressed, msg.file_name);
                 } else if (msg.type === 'error') {
+                    // 不带行号的错误表示任务本身失败
+                    if (!msg.line) localStorage.removeItem(jobKey);
                     log('error', msg.error || '未知错误');
                 }
             }
+            // 日志区只保留100条，每批消息只渲染一次
+            if (logsChanged) {
+                if (view.logBuffer.length > 100) view.logBuffer = view.logBuffer.slice(-100);
+                renderLogBuffer(view.logBuffer, view.partialRows, view.dropped);
+            }
         }
     };
     xhr.onloadend = function() {
+        const jobId = localStorage.getItem(jobKey);
+        if (jobId && view.reconnects < 5) {
+            // 任务仍在运行：稍后携带最后收到的事件ID重连
+            view.reconnects += 1;
+            setTimeout(() => {
+                const retry = new XMLHttpRequest();
+                retry.open('GET', `/api/jobs/${jobId}/events`);
+                if (view.lastEventId) retry.setRequestHeader('Last-Event-ID', view.lastEventId);
+                consumeJobStream(retry, projectId, view);
+                retry.send();
+            }, 1000 * view.reconnects);
+            return;
+        }
         isProcessing = false;
         if (startBtn) startBtn.style.display = 'inline-flex';
         if (cancelBtn) cancelBtn.style.display = 'none';
+        setPauseButton(false, false);
+        if (jobId) {
+            log('info', '连接已断开，任务仍在后台运行，重新进入处理页面即可继续查看进度');
+        }
     };
-    xhr.send(formData);
 }
 
-function renderLogBuffer(logBuffer) {
+function renderLogBuffer(logBuffer, partialRows = new Map(), dropped = 0) {
     const logOutput = document.getElementById('logOutput');
     if (!logOutput) return;
-    logOutput.innerHTML = logBuffer.map(msg => {
+    const summary = dropped ? `<div class='log-entry' style='color:#9e9e9e'>为保证实时性已省略 ${dropped} 条逐行日志，完整结果请下载结果文件</div>` : '';
+    const partials = Array.from(partialRows.values()).slice(-20).map(msg =>
+        `<div class='log-entry' style='color:#9e9e9e'>[第${msg.line}行] 生成中（${msg.chars}字符）<pre>${escapeHtml(msg.output)}</pre></div>`
+    ).join('');
+    logOutput.innerHTML = summary + logBuffer.map(msg => {
         let color = msg.status === 'success' ? '#4CAF50' : '#f44336';
         let output = msg.output ? `<div style='color:#2196F3'>模型输出: <pre>${escapeHtml(msg.output)}</pre></div>` : '';
         let error = msg.error ? `<div style='color:#f44336'>错误: ${escapeHtml(msg.error)}</div>` : '';
-        return `<div class='log-entry' style='color:${color}'>[第${msg.line}行] ${msg.status === 'success' ? '成功' : '失败'}${output}${error}</div>`;
-    }).join('');
+        let phase = msg.phase === 'dead_letter' ? '[死信重跑] ' : '';
+        let retries = msg.attempts > 1 ? `（重试${msg.attempts - 1}次）` : '';
+        return `<div class='log-entry' style='color:${color}'>${phase}[第${msg.line}行] ${msg.status === 'success' ? '成功' : '失败'}${retries}${output}${error}</div>`;
+    }).join('') + partials;
     logOutput.scrollTop = logOutput.scrollHeight;
 }
 function escapeHtml(str) {
@@ -714,31 +884,53 @@ function escapeHtml(str) {
     });
 }
 
+// 暂停/继续、取消后台任务（状态变化由SSE的 state 事件同步到界面）
+async function controlActiveJob(action) {
+    const jobId = currentProject && localStorage.getItem(`activeJob_${currentProject.id}`);
+    if (!jobId) return;
+    try {
+        const response = await fetch(`/api/jobs/${jobId}/${action}`, { method: 'POST' });
+        const result = await response.json();
+        if (!response.ok) showError(result.error || '操作失败');
+    } catch (error) {
+        showError('操作失败: ' + error.message);
+    }
+}
+
+function togglePauseProcessing() {
+    const pauseBtn = document.getElementById('pauseBtn');
+    controlActiveJob(pauseBtn && pauseBtn.dataset.paused === '1' ? 'resume' : 'pause');
+}
+
+function setPauseButton(paused, visible) {
+    const pauseBtn = document.getElementById('pauseBtn');
+    if (!pauseBtn) return;
+    pauseBtn.dataset.paused = paused ? '1' : '0';
+    pauseBtn.textContent = paused ? '继续' : '暂停';
+    pauseBtn.style.display = visible ? 'inline-flex' : 'none';
+}
+
 // 取消处理
 function cancelProcessing() {
-    shouldCancel = true;
-    log('info', '正在取消处理...');
+    controlActiveJob('cancel');
 }
 
-// 下载结果
-function downloadResults(processedData) {
-    if (!processedData || !fileData) {
+// 下载结果（服务端逐行写入的结果文件）
+function downloadResults(downloadUrl, compressed = false, sourceName = null) {
+    if (!downloadUrl) {
         showError('没有可下载的数据');
         return;
     }
     
     try {
-        const jsonlContent = processedData.map(item => JSON.stringify(item)).join('\n');
-        const blob = new Blob([jsonlContent], { type: 'application/jsonl' });
-        const url = URL.createObjectURL(blob);
-        
+        const baseName = sourceName || (fileData ? fileData.file.name : 'results.jsonl');
+        const fileName = `processed_${baseName}${compressed ? '.gz' : ''}`;
         const a = document.createElement('a');
-        a.href = url;
-        a.download = `processed_${fileData.file.name}`;
+        a.href = `${downloadUrl}?name=${encodeURIComponent(fileName)}`;
+        a.download = fileName;
         document.body.appendChild(a);
         a.click();
         document.body.removeChild(a);
-        URL.revokeObjectURL(url);
         
         log('success', '结果文件下载成功');
         
@@ -749,7 +941,8 @@ function downloadResults(processedData) {
 
 // 更新进度
 function updateProgress(current, total, success, error) {
-    const percentage = (current / total) * 100;
+    // 总行数在后台统计完成前为空
+    const percentage = total ? (current / total) * 100 : 0;
     
     const progressText = document.getElementById('progressText');
     const progressCount = document.getElementById('progressCount');
@@ -759,11 +952,11 @@ function updateProgress(current, total, success, error) {
     const remainingCount = document.getElementById('remainingCount');
     
     if (progressText) progressText.textContent = '处理中...';
-    if (progressCount) progressCount.textContent = `${current} / ${total}`;
+    if (progressCount) progressCount.textContent = `${current} / ${total ?? '?'}`;
     if (progressFill) progressFill.style.width = `${percentage}%`;
     if (successCount) successCount.textContent = success;
     if (errorCount) errorCount.textContent = error;
-    if (remainingCount) remainingCount.textContent = total - current;
+    if (remainingCount) remainingCount.textContent = total ? total - current : '-';
 }
 
 // 日志记录
@@ -841,8 +1034,12 @@ function formatDate(dateString) {
 
 function getStatusText(status) {
     const statusMap = {
+        'queued': '排队中',
         'completed': '已完成',
         'processing': '处理中',
+        'paused': '已暂停',
+        'cancelling': '取消中',
+        'cancelled': '已取消',
         'failed': '失败'
     };
     return statusMap[status] || status;
@@ -933,11 +1130,34 @@ function renderPromptTemplateSelector() {
 
 // ========== 全局提示词模板库逻辑 ==========
 async function loadTemplates() {
-    const res = await fetch('/api/templates');
-    templates = await res.json();
+    // 模板库需要完整列表（预览与编辑按ID查找），逐页加载
+    let all = [];
+    let cursor = null;
+    let etag = null;
+    do {
+        const res = await fetch(`/api/templates?limit=${PAGE_SIZE}${cursor ? `&cursor=${encodeURIComponent(cursor)}` : ''}`);
+        etag = etag || res.headers.get('ETag');
+        all = all.concat(await res.json());
+        cursor = res.headers.get('X-Next-Cursor');
+    } while (cursor);
+    templates = all;
+    templatesEtag = etag;
     renderTemplateList();
 }
 
+function templateWriteHeaders(headers = {}) {
+    return templatesEtag ? { ...headers, 'If-Match': templatesEtag } : headers;
+}
+
+async function checkTemplateConflict(res) {
+    if (res.status !== 412) return false;
+    alert('模板已被其他页面修改，已重新加载，请确认后重试');
+    closeTemplateEdit();
+    closeTemplatePreview();
+    await loadTemplates();
+    return true;
+}
+
 function renderTemplateList() {
     const list = document.getElementById('templateList');
     if (!list) return;
@@ -998,7 +1218,8 @@ if (deleteTemplateBtn) {
     deleteTemplateBtn.onclick = async function() {
         if (!currentTemplate) return;
         if (!confirm('确定要删除该模板吗？')) return;
-        await fetch(`/api/templates/${currentTemplate.id}`, { method: 'DELETE' });
+        const res = await fetch(`/api/templates/${currentTemplate.id}`, { method: 'DELETE', headers: templateWriteHeaders() });
+        if (await checkTemplateConflict(res)) return;
         closeTemplatePreview();
         await loadTemplates();
     };
@@ -1017,11 +1238,12 @@ if (saveTemplateBtn) {
         }
         if (currentTemplate) {
             // 编辑
-            await fetch(`/api/templates/${currentTemplate.id}`, {
+            const res = await fetch(`/api/templates/${currentTemplate.id}`, {
                 method: 'PUT',
-                headers: { 'Content-Type': 'application/json' },
+                headers: templateWriteHeaders({ 'Content-Type': 'application/json' }),
                 body: JSON.stringify({ name, description, content })
             });
+            if (await checkTemplateConflict(res)) return;
         } else {
             // 新建
             await fetch('/api/templates', {
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+测试公共夹具
+
+应用使用相对路径保存数据库与结果文件，且导入时即初始化数据库、启动后台任务线程，
+因此整个测试会话在临时目录中导入一次 app。API 由本进程线程中运行的服务模拟：
+llm_server 按测试脚本逐个请求决定响应，mock_llm 为基准测试用的 bench/mock_llm_server.py。
+"""
+import argparse
+import importlib
+import io
+import json
+import os
+import sys
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, 'bench'))
+
+import mock_llm_server  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def pf(tmp_path_factory):
+    """在临时工作目录中导入的应用模块"""
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp('work'))
+    try:
+        yield importlib.import_module('app')
+    finally:
+        os.chdir(cwd)
+
+
+@pytest.fixture
+def client(pf):
+    return pf.app.test_client()
+
+
+class ScriptedLLM:
+    """脚本化的 OpenAI 兼容服务
+
+    respond(prompt, n) 按提示词及其第 n 次请求（从1开始）返回响应：None 表示回显（"echo:" + 提示词），
+    或 dict：status（默认200）、headers、content（模型输出）、chunks（以SSE逐块返回的内容片段）、
+    done（chunks 结束时是否发送 [DONE]，默认 True）。
+    """
+
+    def __init__(self):
+        self.respond = lambda prompt, n: None
+        self.counts = Counter()
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.server.server_port}/v1/chat/completions'
+
+    @property
+    def requests(self):
+        return sum(self.counts.values())
+
+    def _handler(self):
+        scripted = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def send_body(self, status, body, headers):
+                data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def send_chunks(self, chunks, done):
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.end_headers()
+                self.close_connection = True
+                for text in chunks:
+                    event = {'choices': [{'index': 0, 'delta': {'content': text}, 'finish_reason': None}]}
+                    self.wfile.write(('data: ' + json.dumps(event, ensure_ascii=False) + '\n\n').encode('utf-8'))
+                    self.wfile.flush()
+                if done:
+                    self.wfile.write(b'data: [DONE]\n\n')
+
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)))
+                prompt = payload['messages'][0]['content']
+                with scripted.lock:
+                    scripted.counts[prompt] += 1
+                    n = scripted.counts[prompt]
+                reply = scripted.respond(prompt, n) or {}
+                status = reply.get('status', 200)
+                content = reply.get('content', 'echo:' + prompt)
+                if status >= 400:
+                    self.send_body(status, {'error': {'message': 'scripted error'}}, reply.get('headers', {}))
+                elif payload.get('stream'):
+                    self.send_chunks(reply.get('chunks', [content]), reply.get('done', True))
+                else:
+                    self.send_body(status, {
+                        'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+                        'usage': {'prompt_tokens': 1, 'completion_tokens': 1, 'total_tokens': 2}
+                    }, reply.get('headers', {}))
+
+        return Handler
+
+
+@pytest.fixture
+def llm_server():
+    """脚本化的API服务（见 ScriptedLLM），可用 llm_server.url 作为项目的 api_url"""
+    scripted = ScriptedLLM()
+    threading.Thread(target=scripted.server.serve_forever, daemon=True).start()
+    yield scripted
+    scripted.server.shutdown()
+    scripted.server.server_close()
+
+
+@pytest.fixture
+def mock_llm():
+    """启动模拟服务，参数同 mock_llm_server 的命令行（如 mock_llm('--latency', 'const:0.2')），返回 API 地址"""
+    servers = []
+
+    def start(*argv):
+        parser = argparse.ArgumentParser()
+        mock_llm_server.add_arguments(parser)
+        server = mock_llm_server.create_server('127.0.0.1', 0, parser.parse_args(argv))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return f'http://127.0.0.1:{server.server_port}/v1/chat/completions'
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def create_project(client, api_url, **api_config):
+    config = dict({'api_url': api_url, 'response_cache': False}, **api_config)
+    response = client.post('/api/projects', json={'name': 'test', 'api_config': config})
+    assert response.status_code == 200, response.json
+    return response.json['id']
+
+
+def run_job(client, project_id, rows, **form):
+    """提交批量处理并读完SSE流，返回事件列表"""
+    data = '\n'.join(json.dumps(row, ensure_ascii=False) for row in rows).encode('utf-8')
+    fields = dict({'prompt_template': 'Q {{text}}'}, **{k: str(v) for k, v in form.items()})
+    fields['file'] = (io.BytesIO(data), 'input.jsonl')
+    response = client.post(f'/api/process-stream/{project_id}', data=fields, content_type='multipart/form-data')
+    return [json.loads(line[5:]) for line in response.get_data(as_text=True).splitlines() if line.startswith('data:')]
+
+
+def download_rows(client, event):
+    body = client.get(event['download_url']).get_data(as_text=True)
+    return [json.loads(line) for line in body.splitlines()]
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+
+def test_rows_complete_through_the_batch_api(pf, mock_llm):
+    api_url = mock_llm('--batch-delay', '0.2', '--response-chars', '8')
+    config = {'api_url': api_url, 'response_cache': False, 'batch_max_requests': 3, 'batch_poll_interval': 0.05}
+    results = {}
+
+    def on_result(idx, item, processed_item, error, meta):
+        results[idx] = (processed_item['out'], error, meta['batch_id'])
+
+    pf.run_batch_engine(enumerate({'text': f'r{i}'} for i in range(7)), '{{text}}', config, 'out', 1, on_result)
+    assert sorted(results) == list(range(7))
+    assert all(error is None and len(out) == 8 for out, error, _ in results.values())
+    # 每个批处理任务最多3行
+    assert len({batch_id for _, _, batch_id in results.values()}) == 3
+
+
+def test_cancel_during_submission_cancels_submitted_batches(pf, monkeypatch):
+    created, cancelled = [], []
+
+    class FakeBatchClient:
+        base = 'http://batch.test/v1'
+        endpoint = '/v1/chat/completions'
+
+        def __init__(self, api_config):
+            pass
+
+        def upload(self, path):
+            return f'file-{len(created)}'
+
+        def create(self, input_file_id):
+            created.append(f'batch-{len(created)}')
+            return {'id': created[-1], 'status': 'validating', 'input_file_id': input_file_id}
+
+        def cancel(self, batch_id):
+            cancelled.append(batch_id)
+            return {'id': batch_id, 'status': 'cancelling'}
+
+        def get(self, batch_id):
+            raise AssertionError('取消后不应继续轮询')
+
+    monkeypatch.setattr(pf, 'BatchClient', FakeBatchClient)
+    control = pf.JobControl()
+
+    def tasks():
+        for idx in range(10):
+            if idx == 5:
+                # 已提交两个批处理任务（每个2行），第三个尚未写满
+                control.cancel()
+            yield idx, {'text': f'r{idx}'}
+
+    results = []
+    config = {'api_url': 'http://batch.test/v1/chat/completions', 'response_cache': False, 'batch_max_requests': 2}
+    pf.run_batch_engine(tasks(), '{{text}}', config, 'out', 1, lambda *args: results.append(args), control=control)
+    assert created == ['batch-0', 'batch-1']
+    assert cancelled == created
+    assert results == []
+    conn = pf.get_db()
+    try:
+        statuses = conn.execute("SELECT status FROM provider_batches WHERE id IN ('batch-0', 'batch-1')").fetchall()
+    finally:
+        conn.close()
+    assert statuses == [('cancelling',), ('cancelling',)]
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+import sqlite3
+
+
+def test_cache_defaults_to_deterministic_requests_only(pf):
+    assert pf.response_cache_mode({}) is False
+    assert pf.response_cache_mode({'temperature': 0.7}) is False
+    assert pf.response_cache_mode({'temperature': 0}) is True
+    assert pf.response_cache_mode({'temperature': 0.7, 'response_cache': True}) is True
+    assert pf.response_cache_mode({'temperature': 0, 'response_cache': False}) is False
+
+
+def test_repeated_request_is_served_from_cache(pf, llm_server):
+    config = {'api_url': llm_server.url, 'temperature': 0}
+    first, second = {}, {}
+    assert pf.call_llm_api({'text': 'same'}, '{{text}}', config, 'out', first)[0]['out'] == 'echo:same'
+    assert pf.call_llm_api({'text': 'same'}, '{{text}}', config, 'out', second)[0]['out'] == 'echo:same'
+    assert (first['cache'], second['cache']) == ('miss', 'hit')
+    assert llm_server.requests == 1
+    # 跳过读取时重新请求，新结果仍写入缓存
+    refresh = dict(config, response_cache='refresh')
+    assert pf.call_llm_api({'text': 'same'}, '{{text}}', refresh, 'out')[1] is None
+    assert llm_server.requests == 2
+
+
+def test_cache_writes_are_batched(pf, tmp_path, monkeypatch):
+    monkeypatch.setattr(pf, 'CACHE_WRITE_BATCH', 3)
+    path = str(tmp_path / 'cache.db')
+    cache = pf.ResponseCache(path, 3600, 1024 ** 2)
+
+    def stored():
+        conn = sqlite3.connect(path)
+        try:
+            return dict(conn.execute('SELECT key, accessed_at FROM responses'))
+        finally:
+            conn.close()
+
+    assert cache.get('missing') is None
+    cache.put('a', {'content': 'A'})
+    cache.put('b', {'content': 'B'})
+    # 未写入数据库的结果同样可以命中
+    assert cache.get('a') == {'content': 'A'}
+    assert stored() == {}
+    cache.put('c', {'content': 'C'})
+    written = stored()
+    assert sorted(written) == ['a', 'b', 'c']
+    # 命中只在内存中记录访问时间，下一次写入时批量写回
+    assert cache.get('b') == {'content': 'B'}
+    assert stored() == written
+    cache.flush()
+    assert stored()['b'] > written['b']
+    assert (cache.hits, cache.misses) == (2, 1)
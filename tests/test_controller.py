@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+
+def test_concurrent_leases_share_the_ceiling(pf):
+    controller = pf.EndpointController()
+    controller.configure({})
+    with controller.lease(40):
+        assert controller.max_concurrency == 40
+        assert controller.limit == 40
+        with controller.lease(5):
+            assert controller.max_concurrency == 45
+        # 另一次较小的运行结束后不拉低当前运行的上限
+        assert controller.max_concurrency == 40
+        assert controller.limit == 40
+
+
+def test_configured_max_concurrency_is_a_fixed_ceiling(pf):
+    controller = pf.EndpointController()
+    controller.configure({'max_concurrency': 8})
+    with controller.lease(40), controller.lease(40):
+        assert controller.max_concurrency == 8
+        assert controller.limit == 8
+
+
+def test_independent_429s_keep_a_concurrency_floor(pf):
+    controller = pf.EndpointController()
+    controller.configure({})
+    with controller.lease(50):
+        for _ in range(20):
+            assert controller.try_acquire(1) == 0
+            # 模拟彼此相隔超过1秒的零星限流
+            controller.last_decrease = float('-inf')
+            controller.release(429, 0.01)
+        assert controller.limit == 5
+
+
+def test_retry_after_delays_only_the_throttled_request(pf, llm_server):
+    llm_server.respond = lambda prompt, n: {'status': 429, 'headers': {'Retry-After': '0.5'}} if prompt == 'slow' and n == 1 else None
+    config = {'api_url': llm_server.url, 'response_cache': False}
+    elapsed = {}
+
+    def call(text):
+        started = time.monotonic()
+        processed_item, error = pf.call_llm_api({'text': text}, '{{text}}', config, 'out')
+        assert error is None and processed_item['out'] == 'echo:' + text
+        elapsed[text] = time.monotonic() - started
+
+    slow = threading.Thread(target=call, args=('slow',))
+    slow.start()
+    while not llm_server.requests:
+        time.sleep(0.01)
+    call('fast')
+    slow.join()
+    assert llm_server.counts['slow'] == 2
+    assert elapsed['slow'] >= 0.5
+    # 同一端点上的其他请求不等待 Retry-After
+    assert elapsed['fast'] < 0.3
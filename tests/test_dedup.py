@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+import time
+
+
+def run(pf, config, rows):
+    results = {}
+
+    def on_result(idx, item, processed_item, error, meta):
+        results[idx] = (processed_item['out'], error, meta.get('dedup', False))
+
+    pf.run_deduplicated('thread', enumerate(rows), '{{text}}', config, 'out', 8, on_result)
+    return results
+
+
+def test_identical_prompts_are_sent_once(pf, llm_server):
+    # 首个请求较慢，重复行在其进行中到达时挂起等待
+    llm_server.respond = lambda prompt, n: time.sleep(0.2)
+    config = {'api_url': llm_server.url, 'response_cache': False}
+    rows = [{'text': f'r{i % 4}', 'id': i} for i in range(20)]
+    results = run(pf, config, rows)
+    assert llm_server.requests == 4
+    assert {idx: out for idx, (out, _, _) in results.items()} == {i: f'echo:r{i % 4}' for i in range(20)}
+    assert sum(dedup for _, _, dedup in results.values()) == 16
+
+
+def test_followers_share_the_leader_error(pf, llm_server):
+    llm_server.respond = lambda prompt, n: (time.sleep(0.2), {'status': 400})[1]
+    config = {'api_url': llm_server.url, 'response_cache': False}
+    results = run(pf, config, [{'text': 'bad'}] * 5)
+    assert llm_server.requests == 1
+    assert all(error for _, error, _ in results.values())
+
+
+def test_dedup_can_be_disabled(pf, llm_server):
+    config = {'api_url': llm_server.url, 'response_cache': False, 'dedup': False}
+    run(pf, config, [{'text': 'same'}] * 5)
+    assert llm_server.requests == 5
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from conftest import create_project, download_rows, run_job
+
+
+def test_prefix_order_sorts_within_each_window(pf):
+    tasks = [(0, {'text': 'b1'}), (1, {'text': 'a1'}), (2, {'text': 'b2'}), (3, {'text': 'a2'}), (4, {'text': 'a0'})]
+    ordered = [idx for idx, _ in pf.prefix_ordered(tasks, '{{text}}', window=4)]
+    # 窗口之间不跨越排序
+    assert ordered == [1, 3, 0, 2, 4]
+
+
+def test_usage_tokens_reads_each_provider_format(pf):
+    assert pf.usage_tokens({'prompt_tokens': 100, 'prompt_tokens_details': {'cached_tokens': 64}}) == (100, 64)
+    assert pf.usage_tokens({'prompt_tokens': 100, 'prompt_cache_hit_tokens': 32}) == (100, 32)
+    assert pf.usage_tokens({'input_tokens': 10, 'cache_read_input_tokens': 80, 'cache_creation_input_tokens': 5}) == (95, 80)
+    assert pf.usage_tokens(None) == (0, 0)
+
+
+def test_prefix_order_raises_the_cached_token_ratio(client, mock_llm):
+    project_id = create_project(client, mock_llm('--prefix-cache', '1'))
+    documents = ['甲' * 200, '乙' * 200]
+    # 两篇文档交替出现：按文件顺序派发时相邻请求不共享前缀
+    rows = [{'id': i, 'text': f'{documents[i % 2]} 问题{i}'} for i in range(20)]
+    ratios = {}
+    for order in ('file', 'prefix'):
+        events = run_job(client, project_id, rows, dispatch_order=order, max_workers=1, bypass_cache='true')
+        assert events[-1]['type'] == 'done', events[-1]
+        ratios[order] = [e for e in events if e['type'] == 'progress'][-1]['cached_token_ratio']
+        assert [row['id'] for row in download_rows(client, events[-1])] == list(range(20))
+    assert ratios['file'] == 0
+    assert ratios['prefix'] > 0.5
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+import pytest
+
+from conftest import ScriptedLLM
+
+
+@pytest.fixture
+def second_server():
+    scripted = ScriptedLLM()
+    threading.Thread(target=scripted.server.serve_forever, daemon=True).start()
+    yield scripted
+    scripted.server.shutdown()
+    scripted.server.server_close()
+
+
+def test_failing_endpoint_is_routed_around(pf, llm_server, second_server):
+    second_server.respond = lambda prompt, n: {'status': 500}
+    config = {'response_cache': False, 'retry_backoff_base': 0.01, 'circuit_failure_threshold': 2,
+              'load_balancing': 'weighted_round_robin',
+              'endpoints': [{'api_url': llm_server.url}, {'api_url': second_server.url}]}
+    results = [pf.call_llm_api({'text': f'r{i}'}, '{{text}}', config, 'out') for i in range(20)]
+    assert all(error is None for _, error in results)
+    # 熔断后不再向故障端点发送请求
+    assert second_server.requests == 2
+    assert llm_server.requests == 20
+
+
+def test_open_circuit_fails_fast_until_the_probe(pf, llm_server):
+    healthy = []
+    llm_server.respond = lambda prompt, n: None if healthy else {'status': 500}
+    config = {'api_url': llm_server.url, 'response_cache': False, 'retry_max_attempts': 1, 'circuit_failure_threshold': 2,
+              'circuit_cooldown': 0.3}
+    for _ in range(2):
+        assert pf.call_llm_api({'text': 'a'}, '{{text}}', config, 'out')[1]
+    # 唯一的端点熔断后直接失败，不再请求
+    processed_item, error = pf.call_llm_api({'text': 'a'}, '{{text}}', config, 'out')
+    assert '熔断' in error
+    assert llm_server.requests == 2
+    healthy.append(True)
+    time.sleep(0.35)
+    # 冷却结束后放行探测请求，成功即恢复
+    assert pf.call_llm_api({'text': 'a'}, '{{text}}', config, 'out')[1] is None
+    assert pf.call_llm_api({'text': 'b'}, '{{text}}', config, 'out')[1] is None
+    assert llm_server.requests == 4
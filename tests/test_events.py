@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+import json
+import uuid
+
+import pytest
+
+
+@pytest.fixture
+def channel(pf, monkeypatch):
+    """当前进程中“执行中”任务的事件通道（已关闭，订阅读完缓冲后结束）"""
+    monkeypatch.setattr(pf, 'JOB_EVENT_BUFFER', 5)
+    monkeypatch.setattr(pf, 'JOB_FRAME_INTERVAL', 0)
+    job_id = str(uuid.uuid4())
+    conn = pf.get_db()
+    conn.execute("INSERT INTO processing_records (id, project_id, file_name, status) VALUES (?, 'p', 'f.jsonl', 'processing')",
+                 (job_id,))
+    conn.commit()
+    conn.close()
+    channel = pf.JobChannel()
+    channel.job_id = job_id
+    monkeypatch.setitem(pf._job_channels, job_id, channel)
+    return channel
+
+
+def read_events(client, job_id, last_event_id=None):
+    headers = {'Last-Event-ID': last_event_id} if last_event_id else {}
+    body = client.get(f'/api/jobs/{job_id}/events', headers=headers).get_data(as_text=True)
+    ids = [line[4:] for line in body.splitlines() if line.startswith('id: ')]
+    return [json.loads(line[5:]) for line in body.splitlines() if line.startswith('data:')], ids
+
+
+def test_last_event_id_replays_only_later_events(client, channel):
+    for n in range(4):
+        channel.publish({'type': 'info', 'message': f'm{n}'})
+    channel.publish({'type': 'progress', 'current': 4})
+    channel.close()
+    events, ids = read_events(client, channel.job_id)
+    assert [e.get('message') for e in events if e['type'] == 'info'] == ['m0', 'm1', 'm2', 'm3']
+    # 每帧只有最后一条消息带事件ID
+    assert ids == [channel.event_id(4)]
+    events, _ = read_events(client, channel.job_id, channel.event_id(2))
+    assert [e.get('message') for e in events if e['type'] == 'info'] == ['m2', 'm3']
+    # 通道重建（任务续跑）后旧的事件ID不再适用，从头推送
+    events, _ = read_events(client, channel.job_id, 'stale-2')
+    assert len([e for e in events if e['type'] == 'info']) == 4
+
+
+def test_events_pushed_out_of_the_buffer_are_reported(client, channel):
+    for n in range(8):
+        channel.publish({'type': 'log', 'line': n, 'message': f'l{n}'})
+    channel.close()
+    events, _ = read_events(client, channel.job_id, channel.event_id(1))
+    assert {'type': 'dropped', 'count': 2} in events
+    logs = [e for e in events if e['type'] == 'logs']
+    # 连续的日志合并为一个 logs 事件
+    assert len(logs) == 1
+    assert [item['line'] for item in logs[0]['items']] == [3, 4, 5, 6, 7]
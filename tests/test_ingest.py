@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+import gzip
+import json
+import uuid
+
+from conftest import create_project, download_rows, run_job
+
+
+def test_jsonl_rows_are_parsed_lazily(pf):
+    consumed = []
+
+    def lines():
+        for n, line in enumerate([b'{"a": 1}\n', b'\n', b'not json\n', b'{"a": 2}\r\n', b'{"a": 3}']):
+            consumed.append(n)
+            yield line
+
+    errors = []
+    rows = pf.iter_jsonl(lines(), lambda line_no, e: errors.append(line_no))
+    assert next(rows) == (0, {'a': 1})
+    assert consumed == [0]
+    # 空行跳过，无法解析的行按文件行号回调，行序号只对有效行计数
+    assert list(rows) == [(1, {'a': 2}), (2, {'a': 3})]
+    assert errors == [3]
+
+
+def test_result_sink_writes_rows_in_input_order(pf, tmp_path):
+    sink = pf.ResultSink(str(uuid.uuid4()), str(tmp_path / 'order.journal'))
+    for idx in (2, 0, 1):
+        sink.write(idx, {'idx': idx})
+    # 死信重跑的结果覆盖首轮失败的结果
+    sink.write(3, {'idx': 3, 'error': True}, ok=False)
+    sink.write(3, {'idx': 3})
+    assert sink.success_count == 4
+    path = sink.finalize()
+    with open(path, encoding='utf-8') as f:
+        assert [json.loads(line)['idx'] for line in f] == [0, 1, 2, 3]
+
+
+def test_result_sink_resumes_from_its_journal(pf, tmp_path):
+    result_id = str(uuid.uuid4())
+    journal = str(tmp_path / 'resume.journal')
+    sink = pf.ResultSink(result_id, journal, compress=True)
+    sink.write(0, {'idx': 0})
+    sink.write(1, {'idx': 1}, ok=False)
+    sink.close()
+    with open(journal, 'ab') as f:
+        # 崩溃时写了一半的尾行
+        f.write(b'2\t1\t{"idx"')
+    sink = pf.ResultSink(result_id, journal, compress=True)
+    assert (sink.success_count, sink.error_count) == (1, 1)
+    assert [sink.is_done(idx) for idx in range(3)] == [True, False, False]
+    sink.write(1, {'idx': 1})
+    sink.write(2, {'idx': 2})
+    with gzip.open(sink.finalize(), 'rt', encoding='utf-8') as f:
+        assert [json.loads(line)['idx'] for line in f] == [0, 1, 2]
+
+
+def test_job_results_are_downloaded_not_streamed(client, llm_server):
+    project_id = create_project(client, llm_server.url)
+    rows = [{'id': i, 'text': f'r{i}'} for i in range(30)]
+    events = run_job(client, project_id, rows)
+    done = events[-1]
+    assert done['type'] == 'done', done
+    assert 'processed_data' not in done
+    assert [row['response'] for row in download_rows(client, done)] == ['echo:Q r%d' % i for i in range(30)]
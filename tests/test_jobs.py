@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import sqlite3
+import time
+import urllib.request
+
+import pytest
+
+from conftest import create_project, download_rows, run_job
+
+
+def mock_stats(api_url):
+    with urllib.request.urlopen(api_url.split('/v1/')[0] + '/stats') as response:
+        return json.load(response)
+
+
+def test_heartbeat_covers_result_generation(pf, client, llm_server, monkeypatch):
+    monkeypatch.setattr(pf, 'JOB_HEARTBEAT_INTERVAL', 0.05)
+    monkeypatch.setattr(pf, 'JOB_STALE_AFTER', 0.3)
+    finalize = pf.ResultSink.finalize
+    seen = {}
+
+    def slow_finalize(sink, *args, **kwargs):
+        # 生成结果文件的时间超过心跳超时
+        time.sleep(0.6)
+        conn = sqlite3.connect(pf.DB_PATH)
+        try:
+            heartbeat_at, = conn.execute('SELECT heartbeat_at FROM processing_records WHERE id = ?', (sink.result_id,)).fetchone()
+            seen['age'] = time.time() - heartbeat_at
+            # 即使心跳过期（如数据库写入受阻），仍在本进程执行的任务也不会被重复领取
+            conn.execute('UPDATE processing_records SET heartbeat_at = 0 WHERE id = ?', (sink.result_id,))
+            conn.commit()
+            seen['claimed'] = pf.claim_job()
+        finally:
+            conn.close()
+        return finalize(sink, *args, **kwargs)
+
+    monkeypatch.setattr(pf.ResultSink, 'finalize', slow_finalize)
+    project_id = create_project(client, llm_server.url)
+    done = run_job(client, project_id, [{'text': f'r{i}'} for i in range(5)])[-1]
+    assert done['type'] == 'done', done
+    assert seen['age'] < 0.3
+    assert seen['claimed'] is None
+    assert llm_server.requests == 5
+
+
+def engine_failure(pf, monkeypatch, cancel):
+    """执行引擎抛出异常；cancel 为 True 时异常前任务已收到（其他进程转交的）取消请求"""
+    def failing_engine(engine, tasks, prompt_template, api_config, result_field_name, max_workers, on_result, on_partial=None,
+                       control=None):
+        job_id = next(job_id for job_id, job_control in pf._job_controls.items() if job_control is control)
+        if cancel:
+            assert pf.transition_job(job_id, ('processing',), 'cancelling')
+        raise RuntimeError('engine exploded')
+
+    monkeypatch.setattr(pf, 'run_with_dead_letter', failing_engine)
+
+
+def test_engine_failure_fails_the_job(pf, client, llm_server, monkeypatch):
+    engine_failure(pf, monkeypatch, cancel=False)
+    project_id = create_project(client, llm_server.url)
+    events = run_job(client, project_id, [{'text': 'a'}])
+    assert events[-1]['type'] == 'error'
+    record = pf.load_job_record(events[0]['job_id'])
+    assert record['status'] == 'failed'
+    assert 'engine exploded' in record['error_message']
+    # 保留输入文件与 journal 以便 resume
+    assert os.path.exists(os.path.join(pf.JOBS_DIR, record['id'], 'input.jsonl'))
+
+
+def test_failure_after_cancel_request_is_cancelled(pf, client, llm_server, monkeypatch):
+    engine_failure(pf, monkeypatch, cancel=True)
+    project_id = create_project(client, llm_server.url)
+    events = run_job(client, project_id, [{'text': 'a'}])
+    assert events[-1]['type'] == 'cancelled'
+    assert pf.load_job_record(events[0]['job_id'])['status'] == 'cancelled'
+
+
+def test_cancel_after_engine_returns_is_not_overwritten(pf, client, mock_llm, monkeypatch):
+    project_id = create_project(client, mock_llm())
+    finalize = pf.ResultSink.finalize
+
+    def cancel_then_finalize(sink, *args, **kwargs):
+        # 引擎已结束、任务尚未写入 completed 时收到取消请求
+        assert client.post(f'/api/jobs/{sink.result_id}/cancel').status_code == 200
+        return finalize(sink, *args, **kwargs)
+
+    monkeypatch.setattr(pf.ResultSink, 'finalize', cancel_then_finalize)
+    events = run_job(client, project_id, [{'text': f'r{i}'} for i in range(20)])
+    done = events[-1]
+    assert done['type'] == 'cancelled'
+    assert pf.load_job_record(done['job_id'])['status'] == 'cancelled'
+    assert len(download_rows(client, done)) == 20
+
+
+def test_sent_counts_http_requests(client, mock_llm):
+    api_url = mock_llm('--rate-429', '0.2', '--retry-after', '0.01')
+    project_id = create_project(client, api_url)
+    rows = [{'text': f'r{i % 30}'} for i in range(50)]
+    before = mock_stats(api_url)['requests']
+    done = run_job(client, project_id, rows, incremental='true')[-1]
+    assert done['deduplicated'] == 20
+    assert done['sent'] == mock_stats(api_url)['requests'] - before
+    before = mock_stats(api_url)['requests']
+    done = run_job(client, project_id, rows + [{'text': 'new'}], incremental='true', engine='thread')[-1]
+    assert done['reused'] == 50
+    assert done['sent'] == mock_stats(api_url)['requests'] - before
+
+
+def test_superseded_fingerprints_are_pruned(pf, client, mock_llm):
+    project_id = create_project(client, mock_llm())
+    rows = [{'text': f'r{i}'} for i in range(10)]
+
+    def hashes():
+        conn = sqlite3.connect(pf.DB_PATH)
+        try:
+            return conn.execute('SELECT config_hash, COUNT(*) FROM row_fingerprints WHERE project_id = ? GROUP BY 1',
+                                (project_id,)).fetchall()
+        finally:
+            conn.close()
+
+    run_job(client, project_id, rows, prompt_template='A {{text}}')
+    assert [count for _, count in hashes()] == [10]
+    first = hashes()[0][0]
+    done = run_job(client, project_id, rows, prompt_template='B {{text}}', incremental='true')[-1]
+    assert done['reused'] == 0
+    assert [h for h, _ in hashes()] != [first]
+    assert [count for _, count in hashes()] == [10]
+
+
+def test_async_fanout_shares_workers_across_variants(pf, client, mock_llm, monkeypatch):
+    pytest.importorskip('httpx')
+    project_id = create_project(client, mock_llm('--latency', 'const:0.01'))
+    slow_id = create_project(client, mock_llm('--latency', 'const:0.3'))
+    inflight = {'A': 0, 'B': 0, 'peak_B': 0, 'peak': 0}
+    call = pf.call_llm_api_async
+
+    async def counted(transports, data_item, prompt_template, api_config, result_field_name, *args, **kwargs):
+        inflight[result_field_name] += 1
+        inflight['peak_B'] = max(inflight['peak_B'], inflight['B'])
+        inflight['peak'] = max(inflight['peak'], inflight['A'] + inflight['B'])
+        try:
+            return await call(transports, data_item, prompt_template, api_config, result_field_name, *args, **kwargs)
+        finally:
+            inflight[result_field_name] -= 1
+
+    monkeypatch.setattr(pf, 'call_llm_api_async', counted)
+    variants = [{'result_field_name': 'A'}, {'result_field_name': 'B', 'project_id': slow_id, 'prompt_template': 'B {{text}}'}]
+    rows = [{'id': i, 'text': f'r{i}'} for i in range(60)]
+    events = run_job(client, project_id, rows, engine='async', max_workers=10, variants=json.dumps(variants))
+    done = events[-1]
+    assert done['type'] == 'done', done
+    assert done['sent'] == 120
+    results = download_rows(client, done)
+    assert [row['id'] for row in results] == list(range(60))
+    assert all(row['A'].startswith('echo:Q r') and row['B'].startswith('echo:B r') for row in results)
+    # 所有变体共享 max_workers 个名额：快的变体空出的名额由慢的变体占用（按变体均分时慢的变体最多5个）
+    assert inflight['peak'] <= 10
+    assert inflight['peak_B'] > 5
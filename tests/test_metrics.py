@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+import re
+
+from conftest import create_project, run_job
+
+SAMPLE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{[^}]*\})? (-?[0-9.e+-]+|\+Inf)$')
+
+
+def test_metrics_use_the_prometheus_text_format(client, llm_server):
+    project_id = create_project(client, llm_server.url)
+    done = run_job(client, project_id, [{'text': f'r{i}'} for i in range(20)])[-1]
+    assert done['type'] == 'done', done
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    typed = {}
+    buckets = {}
+    for line in response.get_data(as_text=True).splitlines():
+        if line.startswith('# TYPE '):
+            _, _, name, kind = line.split(' ')
+            typed[name] = kind
+            continue
+        if line.startswith('#'):
+            continue
+        name, labels, value = SAMPLE.match(line).groups()
+        family = re.sub(r'_(bucket|sum|count)$', '', name) if name not in typed else name
+        # 每个样本之前都有所属指标的 TYPE 行
+        assert family in typed, line
+        if name.endswith('_bucket'):
+            series = re.sub(r',?le="[^"]*"', '', labels)
+            buckets.setdefault(series, []).append(float(value))
+    assert typed['promptfactory_phase_seconds'] == 'histogram'
+    endpoint = llm_server.url.split('/v1/')[0]
+    http_buckets = buckets[f'{{endpoint="{endpoint}",phase="http"}}']
+    # 分桶计数累计递增，+Inf 桶等于样本数
+    assert http_buckets == sorted(http_buckets)
+    assert http_buckets[-1] == 20
+
+
+def test_record_stats_summarise_phases(client, llm_server):
+    project_id = create_project(client, llm_server.url)
+    done = run_job(client, project_id, [{'text': f'r{i}'} for i in range(10)])[-1]
+    stats = client.get(f"/api/processing-records/{done['job_id']}/stats").json
+    assert stats['status'] == 'completed'
+    assert stats['stats']['rows'] == {'success': 10, 'error': 0}
+    assert stats['stats']['phases']['http']['count'] == 10
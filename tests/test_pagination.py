@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+import uuid
+
+
+def fetch_pages(client, url, limit, **filters):
+    items, cursor = [], None
+    while True:
+        response = client.get(url, query_string=dict(filters, limit=limit, **({'cursor': cursor} if cursor else {})))
+        assert response.status_code == 200, response.json
+        items += response.json
+        cursor = response.headers.get('X-Next-Cursor')
+        if not cursor:
+            return items
+
+
+def test_project_cursors_cover_every_project_once(client):
+    for n in range(7):
+        response = client.post('/api/projects', json={'name': f'p{n}', 'api_config': {'api_url': 'http://127.0.0.1:9'}})
+        assert response.status_code == 200
+    everything = client.get('/api/projects', query_string={'limit': 500}).json
+    pages = fetch_pages(client, '/api/projects', 3)
+    # 同一秒内创建的项目按 id 区分先后，翻页不重复、不遗漏
+    assert [p['id'] for p in pages] == [p['id'] for p in everything]
+
+
+def test_record_filters_and_cursors(pf, client):
+    project_id = str(uuid.uuid4())
+    conn = pf.get_db()
+    for n in range(9):
+        conn.execute('''
+            INSERT INTO processing_records (id, project_id, file_name, success_count, error_count, status, created_at)
+            VALUES (?, ?, 'f.jsonl', 1, 0, ?, ?)
+        ''', (str(uuid.uuid4()), project_id, 'completed' if n % 3 else 'failed', f'2024-01-0{n + 1} 12:00:00'))
+    conn.commit()
+    conn.close()
+    records = fetch_pages(client, '/api/processing-records', 2, project_id=project_id)
+    assert [r['created_at'] for r in records] == [f'2024-01-0{n + 1} 12:00:00' for n in reversed(range(9))]
+    completed = fetch_pages(client, '/api/processing-records', 2, project_id=project_id, status='completed',
+                            since='2024-01-03', until='2024-01-08')
+    assert [r['created_at'][:10] for r in completed] == ['2024-01-06', '2024-01-05', '2024-01-03']
+    assert client.get('/api/processing-records', query_string={'cursor': 'bogus'}).status_code == 400
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+
+def test_transient_errors_are_retried(pf, llm_server):
+    llm_server.respond = lambda prompt, n: {'status': 500} if n < 3 else None
+    config = {'api_url': llm_server.url, 'response_cache': False, 'retry_backoff_base': 0.01}
+    meta = {}
+    processed_item, error = pf.call_llm_api({'text': 'a'}, '{{text}}', config, 'out', meta)
+    assert error is None
+    assert processed_item['out'] == 'echo:a'
+    assert meta['attempts'] == 3
+
+
+def test_non_retryable_status_fails_at_once(pf, llm_server):
+    llm_server.respond = lambda prompt, n: {'status': 400}
+    config = {'api_url': llm_server.url, 'response_cache': False, 'retry_backoff_base': 0.01}
+    processed_item, error = pf.call_llm_api({'text': 'a'}, '{{text}}', config, 'out')
+    assert error
+    assert processed_item['out'].startswith('错误: ')
+    assert llm_server.requests == 1
+
+
+def test_failed_rows_get_a_dead_letter_pass(pf, llm_server):
+    # r3、r7 的首次请求失败且不在首轮重试，任务末尾的死信重跑成功
+    llm_server.respond = lambda prompt, n: {'status': 500} if prompt in ('r3', 'r7') and n == 1 else None
+    config = {'api_url': llm_server.url, 'response_cache': False, 'retry_max_attempts': 1}
+    results = []
+    pf.run_with_dead_letter('thread', ((idx, {'text': f'r{idx}'}) for idx in range(10)), '{{text}}', config, 'out', 4,
+                            lambda idx, item, processed_item, error, meta: results.append((idx, meta['phase'], error)))
+    assert sorted(idx for idx, phase, error in results if error) == [3, 7]
+    assert sorted((idx, error) for idx, phase, error in results if phase == 'dead_letter') == [(3, None), (7, None)]
+    assert len(results) == 12
+
+
+def test_dead_letter_pass_does_not_lower_a_running_job(pf, llm_server):
+    llm_server.respond = lambda prompt, n: {'status': 500} if n == 1 and int(prompt[1:]) % 3 == 0 else None
+    config = {'api_url': llm_server.url, 'response_cache': False, 'retry_max_attempts': 1, 'dead_letter_workers': 2}
+    controller = pf.get_controller(config)
+    phases = []
+    # 外层租约模拟同一端点上并发运行的另一个任务
+    with controller.lease(40):
+        pf.run_with_dead_letter('thread', ((idx, {'text': f'r{idx}'}) for idx in range(50)), '{{text}}', config,
+                                'out', 10, lambda *args: phases.append(args[4]['phase']))
+        assert 'dead_letter' in phases
+        assert controller.max_concurrency == 40
+        assert controller.limit >= 40
+    assert controller.leases == {}
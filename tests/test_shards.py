@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+import io
+import json
+import threading
+
+from conftest import create_project, download_rows
+
+
+def test_shard_control_keeps_the_parent_state(pf):
+    cancel_event, run_event = threading.Event(), threading.Event()
+    parent = pf.JobControl(cancel_event, run_event)
+    parent.pause()
+    # 子进程包装父进程的 Event 时不把暂停中的任务置为运行
+    child = pf.JobControl(cancel_event, run_event, reset=False)
+    assert child.paused and parent.paused
+    parent.resume()
+    assert not child.paused
+    parent.cancel()
+    assert child.cancelled
+
+
+def test_shard_count_is_fixed_at_submission(pf, client, llm_server, monkeypatch):
+    used = []
+    run_sharded = pf.run_sharded
+
+    def record_shards(job_id, ranges, *args):
+        used.append(len(ranges))
+        return run_sharded(job_id, ranges, *args)
+
+    monkeypatch.setattr(pf, 'run_sharded', record_shards)
+    project_id = create_project(client, llm_server.url)
+    data = '\n'.join(json.dumps({'text': f'r{i}'}) for i in range(40)).encode('utf-8')
+    with monkeypatch.context() as m:
+        m.setattr(pf.os, 'cpu_count', lambda: 2)
+        response = client.post(f'/api/process-stream/{project_id}', content_type='multipart/form-data', data={
+            'prompt_template': 'Q {{text}}', 'shards': '8', 'file': (io.BytesIO(data), 'input.jsonl')})
+    # 执行（含续跑）时不再按当前机器的CPU核数重新计算
+    monkeypatch.setattr(pf.os, 'cpu_count', lambda: 1)
+    events = [json.loads(line[5:]) for line in response.get_data(as_text=True).splitlines() if line.startswith('data:')]
+    done = events[-1]
+    assert done['type'] == 'done', done
+    assert pf.load_job_record(done['job_id'])['job_config']['shards'] == 2
+    assert used == [2]
+    assert [row['response'] for row in download_rows(client, done)] == [f'echo:Q r{i}' for i in range(40)]
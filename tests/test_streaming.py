@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+import json
+
+import pytest
+
+
+def chunk(**fields):
+    return 'data: ' + json.dumps(fields, ensure_ascii=False)
+
+
+def test_sse_lines_are_accumulated(pf):
+    deltas = []
+    accumulator = pf.StreamAccumulator(5, 60, deltas.append)
+    lines = [
+        ': keep-alive',
+        '',
+        'event: message',
+        chunk(id='c1', model='m', choices=[{'index': 0, 'delta': {'role': 'assistant'}}]),
+        chunk(choices=[{'index': 0, 'delta': {'content': '你好'}}]),
+        # 传输层按字节产出的行
+        chunk(choices=[{'index': 0, 'delta': {'content': '，世界'}, 'finish_reason': 'stop'}]).encode('utf-8'),
+        chunk(choices=[], usage={'prompt_tokens': 3, 'completion_tokens': 2, 'total_tokens': 5}),
+        'data: [DONE]'
+    ]
+    for line in lines:
+        accumulator.feed(line)
+    result = accumulator.result()
+    assert deltas == ['你好', '，世界']
+    assert pf.parse_llm_response(result) == '你好，世界'
+    assert result['choices'][0]['finish_reason'] == 'stop'
+    assert result['usage']['total_tokens'] == 5
+    assert result['id'] == 'c1'
+
+
+def test_truncated_stream_is_an_error(pf):
+    accumulator = pf.StreamAccumulator(5, 60)
+    accumulator.feed(chunk(choices=[{'index': 0, 'delta': {'content': 'par'}}]))
+    with pytest.raises(pf.StreamError):
+        accumulator.result()
+    with pytest.raises(ValueError):
+        pf.StreamAccumulator(5, 60).feed(chunk(error={'message': 'overloaded'}))
+
+
+def test_streamed_call_retries_an_interrupted_stream(pf, llm_server):
+    llm_server.respond = lambda prompt, n: {'chunks': ['Hel', 'lo'], 'done': n > 1}
+    config = {'api_url': llm_server.url, 'response_cache': False, 'stream': True, 'retry_backoff_base': 0.01}
+    deltas = []
+    meta = {}
+    processed_item, error = pf.call_llm_api({'text': 'a'}, '{{text}}', config, 'out', meta, deltas.append)
+    assert error is None
+    assert processed_item['out'] == 'Hello'
+    assert meta['attempts'] == 2
+    # 重试前以 None 通知丢弃已推送的部分输出
+    assert deltas == ['Hel', 'lo', None, 'Hel', 'lo']
+
+
+def test_async_engine_streams_partial_output(pf, llm_server):
+    llm_server.respond = lambda prompt, n: {'chunks': ['Hel', 'lo']}
+    config = {'api_url': llm_server.url, 'response_cache': False, 'stream': True}
+    results, partials = {}, {}
+
+    def on_result(idx, item, processed_item, error, meta):
+        results[idx] = (processed_item['out'], error)
+
+    def on_partial(idx, delta):
+        partials.setdefault(idx, []).append(delta)
+
+    pf.run_async_engine(enumerate([{'text': 'a'}, {'text': 'b'}]), '{{text}}', config, 'out', 2, on_result, on_partial)
+    assert results == {0: ('Hello', None), 1: ('Hello', None)}
+    assert partials == {0: ['Hel', 'lo'], 1: ['Hel', 'lo']}
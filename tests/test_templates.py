@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+import threading
+
+
+def test_concurrent_if_match_writes_admit_one(client):
+    template_id = client.post('/api/templates', json={'name': 'a', 'content': 'x'}).json['id']
+    etag = client.get('/api/templates').headers['ETag']
+    barrier = threading.Barrier(8)
+    codes = []
+
+    def put(n):
+        own = client.application.test_client()
+        barrier.wait()
+        response = own.put(f'/api/templates/{template_id}', json={'name': f'n{n}', 'content': 'y'}, headers={'If-Match': etag})
+        codes.append(response.status_code)
+
+    threads = [threading.Thread(target=put, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(codes) == [200] + [412] * 7
+
+
+def test_stale_if_match_delete_is_rejected(client):
+    template_id = client.post('/api/templates', json={'name': 'a', 'content': 'x'}).json['id']
+    stale = client.get('/api/templates').headers['ETag']
+    assert client.put(f'/api/templates/{template_id}', json={'name': 'b', 'content': 'x'}).status_code == 200
+    assert client.delete(f'/api/templates/{template_id}', headers={'If-Match': stale}).status_code == 412
+    current = client.get('/api/templates').headers['ETag']
+    assert client.delete(f'/api/templates/{template_id}', headers={'If-Match': current}).status_code == 200
+
+
+def test_stores_sharing_a_file_keep_each_others_writes(pf, tmp_path, monkeypatch):
+    monkeypatch.setattr(pf, 'TEMPLATE_COMPACT_MIN_OPS', 5)
+    path = str(tmp_path / 'templates.jsonl')
+    # 两个模板库实例模拟共用同一文件的两个进程，写入交替触发重写快照
+    stores = [pf.TemplateStore(path), pf.TemplateStore(path)]
+
+    def write(store, prefix):
+        for n in range(20):
+            store.put({'id': f'{prefix}{n % 4}', 'name': f'{prefix}{n}', 'content': ''})
+
+    threads = [threading.Thread(target=write, args=(store, prefix)) for store, prefix in zip(stores, 'ab')]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    names = {template['id']: template['name'] for template in pf.TemplateStore(path).list()}
+    assert names == {f'{prefix}{n}': f'{prefix}{16 + n}' for prefix in 'ab' for n in range(4)}